@@ -0,0 +1,142 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from omop import group_domains
+
+# Asyncio drivers used for the engines of the `omop_engine` setting
+async_drivers = {
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(settings):
+    """
+    Determine the database URL of the asyncio engine.
+
+    :param settings: The OMOP settings (see config.omop_settings).
+    :return: The `omop_async_url` setting or, if it is empty, the URL of the connection
+        settings with the asyncio driver of the engine, e.g., postgresql+asyncpg.
+    """
+    if settings.get('omop_async_url'):
+        return settings['omop_async_url']
+    engine = settings.get('omop_engine', 'postgresql')
+    return "{0}://{1}:{2}@{3}:{4}/{5}".format(
+        async_drivers.get(engine, engine), settings['omop_user'], settings['omop_passwd'],
+        settings['omop_host'], settings['omop_port'], settings['omop_db'])
+
+
+class AsyncOMOP:
+    def __init__(self, omop, settings):
+        """
+        Retrieve patients with SQLAlchemy's asyncio engine, so one process can wait for the
+        queries of many patients at once. The queries are run by the methods of `omop` on
+        the synchronous facade of asyncio connections (AsyncConnection.run_sync), so rows
+        are turned into events and dictionary entries exactly as in OMOP. The queries of a
+        patient run concurrently, each on a pooled connection of its own. Patients should
+        be extracted into a snapshot of the dictionary (see
+        dictionary_store.DictionarySnapshot), as resolving the hierarchies of new entries
+        queries the database while other patients are extracted.
+
+        :param omop: The OMOP instance.
+        :param settings: The OMOP settings (see config.omop_settings).
+        """
+        self.omop = omop
+        self.db = create_async_engine(
+            async_url(settings),
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=int(settings.get('omop_pool_size', 5)),
+            max_overflow=int(settings.get('omop_max_overflow', 10)),
+            pool_timeout=float(settings.get('omop_pool_timeout', 30)),
+            pool_recycle=int(settings.get('omop_pool_recycle', -1)),
+            pool_pre_ping=bool(settings.get('omop_pool_pre_ping', False)))
+
+    async def run(self, fn, *args):
+        """
+        Call a synchronous method of the OMOP instance with all of its queries on one
+        pooled asyncio connection.
+
+        :param fn: The method, e.g., `omop.get_dictionary_sources`.
+        :param *args: The arguments of the method.
+        :return: The result of the method.
+        """
+        async with self.db.connect() as connection:
+            return await connection.run_sync(self._call, fn, *args)
+
+    def _call(self, connection, fn, *args):
+        with self.omop.connection(connection):
+            return fn(*args)
+
+    async def get_patient(self, pid, dictionary, line_file, class_file, group=None, intervals=False, watermarks=None):
+        """
+        Retrieve and assemble a patient's data like OMOP.get_patient with `parallel=True`.
+
+        :param pid: The person_id of the patient.
+        :param dictionary: The dictionary to update with new entries.
+        :param line_file: Path to a line file for additional data (used by util.add_files).
+        :param class_file: Path to a class file for additional data (used by util.add_files).
+        :param group: The specific group of data to retrieve. If None, all groups are retrieved.
+        :param intervals: Boolean indicating whether multi-day conditions and drug exposures are
+            returned as a single event with an 'end' time instead of one event per day.
+        :param watermarks: Optional dict that is filled with the highest row id of each domain.
+        :return: A structured object containing the patient's data.
+        """
+        obj = self.omop._create_patient(line_file, class_file)
+        (domains, rows) = await self._fetch_domains(pid, obj, group, watermarks)
+        await self.run(self._assemble, pid, obj, dictionary, domains, rows, intervals, watermarks)
+        return obj
+
+    async def update_patient(self, pid, patient, dictionary, watermarks, group=None, intervals=False):
+        """
+        Add the rows that were added since a patient was retrieved like OMOP.update_patient
+        with `parallel=True`.
+
+        :param pid: The person_id of the patient.
+        :param patient: The patient object to update. Its events must be a list of events.
+        :param dictionary: The dictionary to update with new entries.
+        :param watermarks: The watermarks filled by `get_patient`. They are updated to the
+            highest row ids retrieved now.
+        :param group: The group the patient was retrieved with.
+        :param intervals: Boolean indicating whether the patient was retrieved with interval
+            events.
+        :return: The number of new events.
+        """
+        obj = {
+            "info": [],
+            "events": [],
+            "v_spans": [],
+            "classes": patient["classes"]
+        }
+        (domains, rows) = await self._fetch_domains(pid, obj, group, watermarks)
+        return await self.run(self._assemble_update, pid, patient, obj, dictionary, domains, rows, intervals, watermarks)
+
+    async def _fetch_domains(self, pid, obj, group, watermarks):
+        omop = self.omop
+        domains = [ d for (g, ds) in group_domains if group is None or group == g for d in ds ]
+        classes = obj["classes"]
+        class_ids = await self.run(omop.get_class_ids, classes.keys()) if classes else []
+        queries = omop.patient_queries(pid, domains, class_ids, watermarks)
+        results = await asyncio.gather(*[ self.run(omop.fetch_domain, domain, args) for (domain, args) in queries ])
+        return (domains, dict(zip((domain for (domain, _) in queries), results)))
+
+    def _assemble(self, pid, obj, dictionary, domains, rows, intervals, watermarks):
+        new_dict_entries = set()
+        self.omop.add_domains(pid, obj, dictionary, new_dict_entries, domains, rows, watermarks)
+        self.omop._finish_patient(pid, obj, intervals)
+        self.omop.update_hierarchies(dictionary, new_dict_entries)
+
+    def _assemble_update(self, pid, patient, obj, dictionary, domains, rows, intervals, watermarks):
+        new_dict_entries = set()
+        self.omop.add_domains(pid, obj, dictionary, new_dict_entries, domains, rows, watermarks)
+        count = self.omop._add_update(pid, patient, obj, intervals)
+        self.omop.update_hierarchies(dictionary, new_dict_entries)
+        return count
+
+    async def close(self):
+        """
+        Close the connections of the pool.
+        """
+        await self.db.dispose()
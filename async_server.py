@@ -0,0 +1,289 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from async_omop import AsyncOMOP
+from config import omop_settings
+from dictionary_store import DictionaryStore
+from omop import OMOP
+from patient_cache import PatientCache, cached_patient, store_patient
+from payload import BINARY_MIMETYPE, RAW_MIMETYPE, compress, encode_patient, encrypt_bytes, negotiate_encoding
+import util
+
+# Asynchronous counterpart of server.py for /get_patient_data and /get_dictionary_by_type,
+# e.g., `uvicorn async_server:app`. Queries use SQLAlchemy's asyncio engine, so a single
+# process serves many patients at once while their queries are running.
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Ensure if "json" folder exists; if not creates one
+if not os.path.exists("json"):
+    os.makedirs("json")
+
+# Load settings from environment variables
+settings = omop_settings()
+# Compression level (1-9) and minimum size in bytes of compressed payloads and responses
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# The OMOP instance turns rows into patients; all of its queries run on the asyncio engine
+omop = OMOP(settings, True)
+async_omop = AsyncOMOP(omop, settings)
+
+# Dictionary shared by all requests; it must only be used while holding dictionary_store.lock,
+# which is only taken in threads (asyncio.to_thread) as it is held while writing its files
+dictionary_store = DictionaryStore(
+    "json/dictionary.json",
+    compact_after=int(os.getenv("DICTIONARY_COMPACT_AFTER", "10000")),
+)
+
+# The event loop of the app; background refreshes of the patient cache run on it
+loop = None
+
+
+async def extract_patient(person_id, group, entry=None):
+    """
+    Retrieves a patient with interval events and the dictionary entries it refers to from
+    the database and stores it in the patient cache like patient_cache.retrieve_patient.
+    The patient is extracted into a snapshot of the dictionary; the files of the
+    dictionary and the patient cache are written by a thread.
+    """
+    snapshot = await asyncio.to_thread(dictionary_store.snapshot)
+    (patient, watermarks) = cached_patient(entry, snapshot)
+    if patient is not None:
+        await async_omop.update_patient(person_id, patient, snapshot.dictionary, watermarks, group, intervals=True)
+    else:
+        patient = await async_omop.get_patient(person_id, snapshot.dictionary, None, None, group, intervals=True, watermarks=watermarks)
+    return await asyncio.to_thread(store_patient, patient_cache, person_id, group, patient, snapshot, watermarks)
+
+
+def refresh_patient(person_id, group):
+    """
+    Updates a cached patient on the event loop (see server.refresh_patient); called by the
+    workers of the patient cache.
+    """
+    entry = patient_cache.load(person_id, group) if PATIENT_CACHE_INCREMENTAL else None
+    asyncio.run_coroutine_threadsafe(extract_patient(person_id, group, entry), loop).result()
+
+
+# Patients are cached in PATIENT_CACHE_DIR (empty to disable) and refreshed in the
+# background once they are older than PATIENT_CACHE_TTL seconds; refreshes only retrieve
+# new rows unless PATIENT_CACHE_INCREMENTAL is false
+PATIENT_CACHE_DIR = os.getenv("PATIENT_CACHE_DIR", "json/patients")
+PATIENT_CACHE_INCREMENTAL = os.getenv("PATIENT_CACHE_INCREMENTAL", "true").lower() == "true"
+patient_cache = PatientCache(
+    PATIENT_CACHE_DIR,
+    int(os.getenv("PATIENT_CACHE_TTL", "3600")),
+    refresh_patient,
+    workers=int(os.getenv("PATIENT_CACHE_WORKERS", "1")),
+) if PATIENT_CACHE_DIR else None
+
+# Seconds between checks of the vocabulary versions and CCS files (0 checks every request)
+SOURCES_CHECK_INTERVAL = int(os.getenv("SOURCES_CHECK_INTERVAL", "300"))
+sources_checked = None
+
+
+def update_sources(sources):
+    omop.update_sources(sources)
+    return dictionary_store.update_sources(sources)
+
+
+async def check_dictionary_sources():
+    """
+    Removes dictionary and hierarchy entries of vocabularies that changed since they were
+    added (see server.check_dictionary_sources).
+    """
+    global sources_checked
+    now = time.time()
+    if sources_checked is not None and now - sources_checked < SOURCES_CHECK_INTERVAL:
+        return
+    sources_checked = now
+    try:
+        sources = await async_omop.run(omop.get_dictionary_sources)
+        # both rewrite files (the hierarchy cache and the dictionary) while holding a lock
+        changed = await asyncio.to_thread(update_sources, sources)
+        if changed:
+            logger.info(f"Dictionary sources changed: {', '.join(sorted(changed))}")
+    except Exception as e:
+        logger.error(f"Error checking the dictionary sources: {e}")
+
+
+class Request:
+    def __init__(self, scope):
+        """
+        The query arguments and headers of an HTTP request.
+
+        :param scope: The ASGI scope of the request.
+        """
+        self.path = scope["path"]
+        self.method = scope["method"]
+        self.args = {}
+        for (key, value) in parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True):
+            self.args.setdefault(key, value)
+        self.headers = dict((key.decode("latin-1").lower(), value.decode("latin-1")) for (key, value) in scope["headers"])
+
+
+# Returns a JSON response as tuple (status, body, headers).
+def json_response(obj, status=200):
+    return (status, json.dumps(obj).encode(), { "Content-Type": "application/json" })
+
+
+# Returns the media type of the patient payload negotiated via the Accept header.
+def negotiate_payload(request):
+    accept = parse_accept_header(request.headers.get("accept"), MIMEAccept)
+    return accept.best_match(["application/json", BINARY_MIMETYPE, RAW_MIMETYPE], "application/json")
+
+
+# Returns the compression encoding of the patient payload negotiated via the
+# X-Accept-Payload-Encoding header. The payload is compressed before it is encrypted.
+def payload_encoding(request):
+    return negotiate_encoding(request.headers.get("x-accept-payload-encoding"))
+
+
+def encode_patient_response(patient_data, intervals, columnar, payload_type, encoding):
+    """
+    Encodes, compresses and encrypts a patient like server.get_patient_data.
+
+    :return: The response as tuple (status, body, headers).
+    """
+    binary = payload_type == BINARY_MIMETYPE
+    if not intervals:
+        patient_data["events"] = omop.expand_intervals([ dict(e) for e in patient_data["events"] ])
+    if columnar or binary:
+        patient_data["events"] = util.columnar_events(patient_data["events"])
+    (patient_bytes, encoding) = encode_patient(patient_data, binary, encoding, COMPRESS_LEVEL, COMPRESS_MIN_SIZE)
+    if payload_type == "application/json":
+        encrypted_data = base64.b64encode(encrypt_bytes(patient_bytes)).decode("utf-8")
+        (status, body, headers) = json_response({"encrypted_data": encrypted_data})
+    else:
+        (status, body, headers) = (200, encrypt_bytes(patient_bytes), { "Content-Type": payload_type })
+    headers["Vary"] = "Accept, X-Accept-Payload-Encoding"
+    headers["X-Payload-Type"] = BINARY_MIMETYPE if binary else "application/json"
+    headers["X-Payload-Cipher"] = "AES-CBC"
+    if encoding is not None:
+        headers["X-Payload-Encoding"] = encoding
+    return (status, body, headers)
+
+
+async def get_patient_data(request):
+    """
+    Fetches patient's detail based on the patient id and group parameter with the
+    arguments and headers of server.get_patient_data. Patients are not streamed; the
+    `stream` argument is ignored.
+    """
+    person_id = request.args.get("id")
+    group = request.args.get("group")
+    # Multi-day conditions and drugs as a single event with an "end" time
+    intervals = request.args.get("intervals") == "1"
+    # Events as parallel arrays instead of event objects
+    columnar = request.args.get("format") == "columnar"
+
+    if not person_id:
+        return json_response({"error": "No patient ID provided"}, 400)
+
+    if person_id.startswith("json/") and person_id.endswith(".json"):
+        person_id = person_id[5:-5]
+
+    try:
+        patient_data = None
+        if patient_cache is not None:
+            patient_data = await asyncio.to_thread(patient_cache.get, person_id, group, dictionary_store.version)
+        if patient_data is None:
+            patient_data = await extract_patient(person_id, group)
+        return await asyncio.to_thread(encode_patient_response, patient_data, intervals, columnar,
+                                       negotiate_payload(request), payload_encoding(request))
+    except Exception as e:
+        logger.error(f"Error fetching patient data: {e}")
+        return json_response({"error": f"Failed to fetch patient data: {str(e)}"}, 500)
+
+
+async def get_dictionary_by_type(request):
+    """
+    Fetches and returns the dictionary data filtered by a specific event type.
+    """
+    event_type = request.args.get("type")
+    if not event_type:
+        return json_response({"error": "No event type provided"}, 400)
+
+    def lookup():
+        with dictionary_store.lock:
+            if event_type not in dictionary_store.dictionary:
+                return json_response({}, 404)
+            return json_response({event_type: dictionary_store.dictionary[event_type]})
+
+    return await asyncio.to_thread(lookup)
+
+
+routes = {
+    "/get_patient_data": get_patient_data,
+    "/get_dictionary_by_type": get_dictionary_by_type,
+}
+
+
+def compress_response(request, status, body, headers):
+    """
+    Compresses JSON responses with the encoding negotiated via the Accept-Encoding header
+    (see server.compress_response).
+    """
+    if status != 200 or headers.get("Content-Type") != "application/json" or "X-Payload-Encoding" in headers:
+        return body
+    headers["Vary"] = ", ".join(v for v in (headers.get("Vary"), "Accept-Encoding") if v)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return body
+    headers["Content-Encoding"] = encoding
+    return compress(body, encoding, COMPRESS_LEVEL)
+
+
+async def lifespan(receive, send):
+    global loop
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            loop = asyncio.get_running_loop()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_omop.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+    """
+    global loop
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    request = Request(scope)
+    handler = routes.get(request.path)
+    if handler is None:
+        (status, body, headers) = json_response({"error": "Not found"}, 404)
+    elif request.method != "GET":
+        (status, body, headers) = json_response({"error": "Method not allowed"}, 405)
+    else:
+        await check_dictionary_sources()
+        (status, body, headers) = await handler(request)
+        body = compress_response(request, status, body, headers)
+    headers["Content-Length"] = str(len(body))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [ (key.lower().encode("latin-1"), value.encode("latin-1")) for (key, value) in headers.items() ],
+    })
+    await send({ "type": "http.response.body", "body": body })
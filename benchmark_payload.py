@@ -0,0 +1,122 @@
+from __future__ import print_function
+import argparse
+import json
+import random
+import time
+
+from payload import compress, encrypt_blocks, encrypt_bytes, encrypt_data
+
+
+def synthetic_patient(n_events, seed=0):
+    """
+    Create a patient object with the shape of OMOP.get_patient's output.
+
+    :param n_events: The number of events.
+    :param seed: The seed of the random generator.
+    :return: The patient object.
+    """
+    rnd = random.Random(seed)
+    groups = [ "Condition", "Procedure", "Drug", "Measurement", "Observation" ]
+    events = []
+    for ix in range(n_events):
+        group = rnd.choice(groups)
+        event = {
+            "id": "SNOMED{0}".format(rnd.randrange(2000)),
+            "group": group,
+            "row_id": "c{0}".format(ix),
+            "time": rnd.randrange(10000, 20000) * 86400,
+        }
+        if group == "Measurement":
+            event["flag_value"] = str(round(rnd.uniform(0, 200), 1))
+            event["flag"] = rnd.choice([ "", "L", "H" ])
+        events.append(event)
+    return {
+        "info": [ { "id": "pid", "name": "Patient", "value": "1" } ],
+        "events": events,
+        "h_bars": [],
+        "v_bars": [ "auto" ],
+        "v_spans": [],
+        "classes": {},
+        "start": min(e["time"] for e in events) if events else 0,
+        "end": max(e["time"] for e in events) if events else 0,
+    }
+
+
+def legacy_path(patient):
+    # json.dumps, str encryption, base64, and jsonify as done before
+    return json.dumps({ "encrypted_data": encrypt_data(json.dumps(patient)) }).encode()
+
+
+def bytes_path(patient):
+    # the raw response body of `Accept: application/octet-stream`
+    return encrypt_bytes(json.dumps(patient).encode())
+
+
+def stream_path(patient, chunk_size=1000):
+    # the raw streamed response body; the events are serialized in chunks
+    def chunks():
+        yield '{"events": ['
+        sep = ""
+        events = patient["events"]
+        for ix in range(0, len(events), chunk_size):
+            yield sep + json.dumps(events[ix:ix + chunk_size])[1:-1]
+            sep = ", "
+        rest = dict(patient)
+        del rest["events"]
+        yield "], " + json.dumps(rest)[1:]
+    return b"".join(encrypt_blocks(chunks()))
+
+
+def gzip_path(patient):
+    # the raw response body with gzip compression before encryption
+    return encrypt_bytes(compress(json.dumps(patient).encode(), "gzip", 6))
+
+
+benchmarks = [
+    ("legacy (str + base64 + jsonify)", legacy_path),
+    ("bytes (raw body)", bytes_path),
+    ("stream (raw body)", stream_path),
+    ("bytes + gzip (raw body)", gzip_path),
+]
+
+
+def run(patient, repeat):
+    """
+    Time the payload paths for a patient and print the results.
+
+    :param patient: The patient object.
+    :param repeat: The number of runs of each path; the fastest run is reported.
+    """
+    size = len(json.dumps(patient))
+    print("patient: {0} events, {1:.1f} MB JSON".format(len(patient["events"]), size / 1e6))
+    base = None
+    for (name, fn) in benchmarks:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = fn(patient)
+            best = min(best, time.perf_counter() - start)
+        if base is None:
+            base = best
+        print("{0:<34} {1:8.1f} ms {2:8.1f} MB/s {3:10d} bytes  x{4:.2f}".format(
+            name, best * 1000, size / best / 1e6, len(out), base / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the serialization and encryption paths of patient payloads.")
+    parser.add_argument("--events", type=int, default=100000, help="number of events of the synthetic patient")
+    parser.add_argument("--pid", help="benchmark this patient from the OMOP database instead")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs per path")
+    args = parser.parse_args()
+
+    if args.pid:
+        from config import omop_settings
+        from omop import OMOP
+        patient = OMOP(omop_settings(), False).get_patient(args.pid, {}, None, None)
+    else:
+        patient = synthetic_patient(args.events)
+    run(patient, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+
+class ConceptCache:
+    def __init__(self, max_size=100000):
+        """
+        In-memory cache of the attributes of concepts, i.e., the tuple (domain_id,
+        concept_name, vocabulary_id, concept_code), so domain queries do not need to join
+        the concept table. The least recently used concepts are evicted once more than
+        `max_size` concepts are cached. Concepts added with `preload` are never evicted;
+        `preloaded` is reset when the cache is cleared. Concepts that do not exist are
+        cached as None.
+
+        :param max_size: The maximum number of cached concepts besides preloaded ones.
+        """
+        self.max_size = max_size
+        self.preloaded = False
+        self.sources = {}
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, concept_ids):
+        """
+        Look up concepts.
+
+        :param concept_ids: Iterable of concept ids.
+        :return: A tuple (dict of concept id to attributes or None, list of the concept ids
+            that are not cached).
+        """
+        res = {}
+        missing = []
+        with self._lock:
+            for cid in concept_ids:
+                if cid in self._pinned:
+                    res[cid] = self._pinned[cid]
+                elif cid in self._entries:
+                    self._entries.move_to_end(cid)
+                    res[cid] = self._entries[cid]
+                else:
+                    missing.append(cid)
+        return (res, missing)
+
+    def add(self, concept_ids, rows):
+        """
+        Cache the concept rows that were looked up in the database.
+
+        :param concept_ids: The concept ids that were looked up.
+        :param rows: The concept rows with the columns concept_id, domain_id, concept_name,
+            vocabulary_id and concept_code.
+        :return: Dict of concept id to attributes or None for each of `concept_ids`.
+        """
+        res = dict((cid, None) for cid in concept_ids)
+        for row in rows:
+            res[row['concept_id']] = (row['domain_id'], row['concept_name'], row['vocabulary_id'], row['concept_code'])
+        with self._lock:
+            for (cid, attrs) in res.items():
+                self._entries[cid] = attrs
+                self._entries.move_to_end(cid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return res
+
+    def preload(self, rows):
+        """
+        Cache concept rows permanently, e.g., all concepts of frequently used vocabularies.
+
+        :param rows: The concept rows as for `add`.
+        :return: The number of preloaded concepts.
+        """
+        count = 0
+        with self._lock:
+            for row in rows:
+                self._pinned[row['concept_id']] = (row['domain_id'], row['concept_name'], row['vocabulary_id'], row['concept_code'])
+                self._entries.pop(row['concept_id'], None)
+                count += 1
+        return count
+
+    def update_sources(self, sources):
+        """
+        Forget all concepts if a vocabulary version changed since the concepts were cached.
+
+        :param sources: Dict of source to version as returned by OMOP.get_dictionary_sources.
+        :return: Boolean indicating whether the cache was cleared.
+        """
+        sources = dict((key, value) for (key, value) in sources.items() if key.startswith("vocabulary:"))
+        with self._lock:
+            cleared = bool(self.sources) and sources != self.sources
+            if cleared:
+                self._entries.clear()
+                self._pinned.clear()
+                self.preloaded = False
+            self.sources = sources
+        return cleared
@@ -0,0 +1,49 @@
+import os
+
+
+def omop_settings():
+    """
+    Load the OMOP settings from environment variables.
+    Shared by the server and the command line tools.
+    """
+    return {
+        "omop_user": os.getenv("OMOP_USER", "etl_viz"),
+        "omop_passwd": os.getenv("OMOP_PASSWD", "prem123"),
+        "omop_host": os.getenv("OMOP_HOST", "localhost"),
+        "omop_port": os.getenv("OMOP_PORT", "5432"),
+        "omop_db": os.getenv("OMOP_DB", "synthea10"),
+        "omop_schema": os.getenv("OMOP_SCHEMA", "cdm_synthea10"),
+        "omop_engine": os.getenv("OMOP_ENGINE", "postgresql"),
+        "omop_batched": os.getenv("OMOP_BATCHED", "false").lower() == "true",
+        "omop_pool_size": int(os.getenv("OMOP_POOL_SIZE", "5")),
+        "omop_max_overflow": int(os.getenv("OMOP_MAX_OVERFLOW", "10")),
+        "omop_pool_timeout": float(os.getenv("OMOP_POOL_TIMEOUT", "30")),
+        "omop_pool_recycle": int(os.getenv("OMOP_POOL_RECYCLE", "-1")),
+        "omop_pool_pre_ping": os.getenv("OMOP_POOL_PRE_PING", "true").lower() == "true",
+        "omop_url": os.getenv("OMOP_URL", ""),
+        "omop_async_url": os.getenv("OMOP_ASYNC_URL", ""),
+        "omop_fetch_size": int(os.getenv("OMOP_FETCH_SIZE", "1000")),
+        "omop_parallel": os.getenv("OMOP_PARALLEL", "false").lower() == "true",
+        "omop_parallel_workers": int(os.getenv("OMOP_PARALLEL_WORKERS", "7")),
+        "omop_hierarchy_cache": os.getenv("OMOP_HIERARCHY_CACHE", ""),
+        "omop_concept_cache_size": int(os.getenv("OMOP_CONCEPT_CACHE_SIZE", "100000")),
+        "omop_concept_preload": os.getenv("OMOP_CONCEPT_PRELOAD", ""),
+        "omop_use_alt_hierarchies": True,
+        "use_cache": True,
+        "ccs_diag": os.getenv("CCS_DIAG", "path/to/ccs_diag/file"),
+        "ccs_proc": os.getenv("CCS_PROC", "path/to/ccs_proc/file"),
+    }
+
+
+def cache_settings():
+    """
+    Load the Flask-Caching configuration from environment variables.
+    The default backend is a SQLite file shared by all worker processes
+    (see payload_cache.SQLiteCache); CACHE_TYPE=SimpleCache keeps a cache per process.
+    """
+    return {
+        "CACHE_TYPE": os.getenv("CACHE_TYPE", "payload_cache.SQLiteCache"),
+        "CACHE_DEFAULT_TIMEOUT": int(os.getenv("CACHE_DEFAULT_TIMEOUT", "300")),
+        "CACHE_SQLITE_PATH": os.getenv("CACHE_SQLITE_PATH", "json/cache.sqlite"),
+        "CACHE_MAX_BYTES": int(os.getenv("CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+    }
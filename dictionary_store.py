@@ -0,0 +1,516 @@
+from __future__ import print_function
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def slice_dictionary(dictionary, patient, refs=None):
+    """
+    Extract the part of the dictionary a patient needs: the entries referenced by its
+    events and horizontal bars, the ancestor chains of those entries (following the
+    'parent' links) and the root entries of their groups.
+
+    :param dictionary: The dictionary to slice.
+    :param patient: The patient object as returned by OMOP.get_patient.
+    :param refs: Optional set of (group, id) tuples of events that are not in the patient
+        object anymore, e.g., because they were already streamed to the client.
+    :return: The dictionary slice.
+    """
+    refs = set(refs) if refs is not None else set()
+    events = patient["events"]
+    if isinstance(events, dict):
+        # columnar format (see util.columnar_events)
+        strings = events["strings"]
+        refs.update((strings[g], strings[i]) for (g, i) in zip(events["group"], events["id"]))
+    else:
+        refs.update((e["group"], e["id"]) for e in events)
+    refs.update((b["group"], b["id"]) for b in patient.get("h_bars", []))
+    res = {}
+    for (group, id) in refs:
+        g = dictionary.get(group)
+        if g is None:
+            continue
+        s = res.get(group)
+        if s is None:
+            s = res[group] = {}
+            if "" in g:
+                s[""] = g[""]
+        key = id
+        while key not in s and key in g:
+            entry = g[key]
+            s[key] = entry
+            key = entry.get("parent", "")
+    return res
+
+
+def dictionary_delta(dictionary, sizes):
+    """
+    Yield the entries added to a dictionary since the sizes of its groups were recorded.
+    Entries are never removed and dicts keep their insertion order so new entries are
+    the ones after the recorded size of their group.
+
+    :param dictionary: The dictionary.
+    :param sizes: Dict of group to the number of entries already seen. It is updated to
+        the current sizes while iterating.
+    """
+    for (group, entries) in dictionary.items():
+        size = sizes.get(group, 0)
+        if len(entries) == size:
+            continue
+        for (key, entry) in itertools.islice(entries.items(), size, None):
+            yield (group, key, entry)
+        sizes[group] = len(entries)
+
+
+def entry_vocabulary(key, entry):
+    """
+    Determine the vocabulary of a dictionary entry from its key, which is the vocabulary
+    followed by the concept id of the entry.
+
+    :param key: The key of the entry.
+    :param entry: The entry.
+    :return: The vocabulary, an empty string for entries of CCS hierarchies, or None for
+        the root entry of a group.
+    """
+    id = str(entry.get("id", ""))
+    if not id or not key.endswith(id):
+        return None
+    return key[:-len(id)]
+
+
+def prune_dictionary(dictionary, changed):
+    """
+    Remove the entries derived from sources whose version changed, so they are added
+    again from the current sources when patients refer to them. Entries of a changed
+    vocabulary are removed together with the entries whose chain of parents passes
+    through a removed entry. A group with a changed CCS hierarchy is removed as a whole
+    as the hierarchy is added when the group is created.
+
+    :param dictionary: The dictionary to prune.
+    :param changed: Set of changed sources as keys of OMOP.get_dictionary_sources, e.g.,
+        "vocabulary:SNOMED" or "ccs:Condition_ICD9CM".
+    :return: The number of removed entries.
+    """
+    vocabs = set(s[len("vocabulary:"):] for s in changed if s.startswith("vocabulary:"))
+    groups = set(s[len("ccs:"):].split("_", 1)[0] for s in changed if s.startswith("ccs:"))
+    count = 0
+    for group in list(dictionary.keys()):
+        entries = dictionary[group]
+        if group in groups:
+            count += len(entries)
+            del dictionary[group]
+            continue
+        removed = set(key for (key, entry) in entries.items() if entry_vocabulary(key, entry) in vocabs)
+        while True:
+            children = [ key for (key, entry) in entries.items() if key and key not in removed and entry.get("parent") in removed ]
+            if not children:
+                break
+            removed.update(children)
+        for key in removed:
+            del entries[key]
+        count += len(removed)
+    return count
+
+
+class DictionaryStore:
+    def __init__(self, path, compact_after=10000):
+        """
+        Process-resident dictionary that is loaded once and persisted incrementally.
+        The dictionary is kept in memory and must only be iterated or mutated while
+        holding `lock`. Entries added since the last `persist` are appended to a journal
+        next to the dictionary file which is folded back into the dictionary file once it
+        holds `compact_after` entries. Entries other processes append to the journal are
+        read when this process persists its own entries or takes a snapshot (see
+        `refresh`). The versions of the sources the entries were derived from (see
+        `update_sources`) are kept next to the dictionary file as well. The version
+        identifies the dictionary for caches of payloads that embed dictionary entries; it
+        changes whenever the dictionary is created anew or sources change.
+
+        :param path: Path of the dictionary file, e.g., json/dictionary.json.
+        :param compact_after: Number of journal entries that triggers a compaction.
+        """
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.version_path = os.path.splitext(path)[0] + ".version"
+        self.compact_after = compact_after
+        self.lock = threading.RLock()
+        self.dictionary = {}
+        self.sources = {}
+        self.version = None
+        self._generation = None
+        self._sizes = {}
+        self._journal_entries = 0
+        # the part of the journal that is in the dictionary and the files it was read from
+        self._journal_offset = 0
+        self._file_stat = None
+        self._version_stat = None
+        self._load()
+
+    def _load(self):
+        """
+        Load the dictionary file and replay the journal.
+        """
+        self._load_version(not os.path.exists(self.path) and not os.path.exists(self.journal_path))
+        self.dictionary = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                self.dictionary = json.load(file)
+        self._file_stat = _file_stat(self.path)
+        self._journal_offset = 0
+        self._journal_entries = self._replay(overwrite=True)
+        self._update_sizes()
+        if self._journal_entries >= self.compact_after:
+            self.compact()
+
+    def _load_version(self, new):
+        """
+        Read the versions of the dictionary or create a version for a new dictionary.
+
+        :param new: Boolean indicating whether the dictionary is created anew.
+        """
+        self._version_stat = _file_stat(self.version_path)
+        if not new and os.path.exists(self.version_path):
+            try:
+                with open(self.version_path, "r") as file:
+                    obj = json.load(file)
+                self._set_version(obj["generation"], obj["sources"])
+                return
+            except (ValueError, KeyError, TypeError):
+                print("ignoring invalid version file {0}".format(self.version_path), file=sys.stderr)
+        self._set_version(uuid.uuid4().hex, {})
+        self._write_version()
+
+    def _set_version(self, generation, sources):
+        self._generation = generation
+        self.sources = sources
+        key = generation + json.dumps(sources, sort_keys=True)
+        self.version = hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _write_version(self):
+        tmp_path = self.version_path + ".tmp"
+        dirname = os.path.dirname(self.version_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(tmp_path, "w") as file:
+            json.dump({ "generation": self._generation, "sources": self.sources }, file, sort_keys=True)
+        os.replace(tmp_path, self.version_path)
+        self._version_stat = _file_stat(self.version_path)
+
+    def update_sources(self, sources):
+        """
+        Remove the entries derived from sources whose version changed (see
+        `prune_dictionary`) from the dictionary, its file and the journal, and record the
+        new versions. If no versions were recorded yet the dictionary is assumed to be up
+        to date.
+
+        :param sources: Dict of source to version as returned by OMOP.get_dictionary_sources.
+        :return: The set of changed sources.
+        """
+        with self.lock:
+            if sources == self.sources:
+                return set()
+            changed = set(
+                key for key in set(sources) | set(self.sources)
+                if self.sources and sources.get(key) != self.sources.get(key)
+            )
+            if changed:
+                count = self._rewrite(lambda: prune_dictionary(self.dictionary, changed))
+                print("dictionary: removed {0} entries of changed sources {1}".format(count, ", ".join(sorted(changed))), file=sys.stderr)
+            self._set_version(self._generation, sources)
+            self._write_version()
+            return changed
+
+    def _replay(self, overwrite):
+        """
+        Read the journal into the dictionary.
+
+        :param overwrite: Boolean indicating whether journal entries replace existing entries.
+        :return: The number of entries in the journal.
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+        with open(self.journal_path, "r") as journal:
+            return self._read_journal(journal, 0, overwrite)
+
+    def _read_journal(self, journal, offset, overwrite):
+        """
+        Read the journal from an offset to its end into the dictionary.
+
+        :param journal: The open journal file.
+        :param offset: The offset to start reading at.
+        :param overwrite: Boolean indicating whether journal entries replace existing entries.
+        :return: The number of entries read.
+        """
+        journal.seek(offset)
+        count = 0
+        while True:
+            line = journal.readline()
+            if not line.endswith("\n"):
+                # the end of the journal or a partially written last line
+                break
+            self._journal_offset = journal.tell()
+            if not line.strip():
+                continue
+            try:
+                (group, key, entry) = json.loads(line)
+            except ValueError:
+                # a partially written line of a crashed process
+                print("skipping invalid journal line in {0}".format(self.journal_path), file=sys.stderr)
+                continue
+            g = self.dictionary.setdefault(group, {})
+            if overwrite or key not in g:
+                g[key] = entry
+            count += 1
+        return count
+
+    def _update_sizes(self):
+        self._sizes = dict((group, len(entries)) for (group, entries) in self.dictionary.items())
+
+    def merge(self, entries):
+        """
+        Add entries, e.g., computed by another process, that are not in the dictionary yet.
+        Call `persist` afterwards to write them to the journal.
+
+        :param entries: Iterable of (group, key, entry) tuples as produced by `dictionary_delta`.
+        """
+        with self.lock:
+            for (group, key, entry) in entries:
+                self.dictionary.setdefault(group, {}).setdefault(key, entry)
+
+    def snapshot(self):
+        """
+        Take a snapshot of the dictionary so a patient can be extracted without holding
+        `lock` (see DictionarySnapshot). Entries of other processes are read first.
+
+        :return: The DictionarySnapshot.
+        """
+        self.refresh()
+        return DictionarySnapshot(self)
+
+    def refresh(self):
+        """
+        Read the changes other processes made to the files of the dictionary: the whole
+        dictionary is loaded again if its version changed, otherwise new entries of the
+        dictionary file and the journal are added. Only the sizes of the files are
+        compared unless they changed.
+        """
+        with self.lock:
+            if _file_stat(self.version_path) != self._version_stat:
+                (generation, sources) = (self._generation, self.sources)
+                self._load_version(False)
+                if (generation, sources) != (self._generation, self.sources):
+                    self._load()
+                    return
+            size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+            if size != self._journal_offset or _file_stat(self.path) != self._file_stat:
+                self.persist()
+
+    def persist(self):
+        """
+        Append the entries added since the last call to the journal.
+        Entries are written as they are at this point, so this should be called once the
+        hierarchies of the new entries are resolved. Entries that other processes appended
+        to the journal (or compacted into the dictionary file) since it was last read are
+        added to the dictionary first.
+
+        :return: The number of new entries.
+        """
+        with self.lock:
+            lines = [ json.dumps(list(e)) + "\n" for e in dictionary_delta(self.dictionary, self._sizes) ]
+            with open(self.journal_path, "a+") as journal:
+                if fcntl is not None:
+                    fcntl.flock(journal, fcntl.LOCK_EX)
+                journal.seek(0, os.SEEK_END)
+                if journal.tell() < self._journal_offset or _file_stat(self.path) != self._file_stat:
+                    # another process compacted the journal into the dictionary file
+                    self._merge_file()
+                    self._journal_offset = 0
+                    self._journal_entries = 0
+                self._journal_entries += self._read_journal(journal, self._journal_offset, overwrite=False)
+                # the entries of other processes are in their journal already
+                self._update_sizes()
+                if not lines:
+                    return 0
+                journal.seek(0, os.SEEK_END)
+                journal.write("".join(lines))
+                journal.flush()
+                self._journal_offset = journal.tell()
+            self._journal_entries += len(lines)
+            if self._journal_entries >= self.compact_after:
+                self.compact()
+            return len(lines)
+
+    def _merge_file(self):
+        """
+        Add the entries of the dictionary file that are not in the dictionary yet.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                for (group, entries) in json.load(file).items():
+                    g = self.dictionary.setdefault(group, {})
+                    for (key, entry) in entries.items():
+                        g.setdefault(key, entry)
+        self._file_stat = _file_stat(self.path)
+
+    def compact(self):
+        """
+        Write the whole dictionary to the dictionary file and truncate the journal.
+        Entries that other processes wrote to the dictionary file or the journal are
+        merged in first.
+        """
+        self._rewrite(None)
+
+    def _rewrite(self, update):
+        """
+        Merge the dictionary file and the journal into the dictionary, optionally update
+        it, and write it to the dictionary file while holding the journal lock.
+
+        :param update: Function that is called after merging or None.
+        :return: The result of `update`.
+        """
+        res = None
+        with self.lock:
+            with open(self.journal_path, "a+") as journal:
+                if fcntl is not None:
+                    fcntl.flock(journal, fcntl.LOCK_EX)
+                self._merge_file()
+                self._read_journal(journal, 0, overwrite=False)
+                if update is not None:
+                    res = update()
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as file:
+                    json.dump(self.dictionary, file)
+                os.replace(tmp_path, self.path)
+                journal.truncate(0)
+                self._file_stat = _file_stat(self.path)
+                self._journal_offset = 0
+            self._update_sizes()
+            self._journal_entries = 0
+        return res
+
+
+class DictionarySnapshot:
+    def __init__(self, store):
+        """
+        Copy-on-write view of the dictionary of a DictionaryStore. Patients are extracted
+        into the view while other threads keep using the store; only `merge` takes the lock
+        of the store. Lookups fall through to the dictionary of the store while new groups
+        and entries are kept in the view, so taking a snapshot copies nothing. Entries of
+        the store are not changed through the view as hierarchies are only resolved for
+        the entries an extraction adds.
+
+        :param store: The DictionaryStore.
+        """
+        self.store = store
+        with store.lock:
+            self.version = store.version
+            self.dictionary = _Overlay(store.dictionary)
+        self._sizes = {}
+
+    def is_current(self):
+        """
+        Check whether the store still has the version the snapshot was taken of.
+
+        :return: Boolean indicating whether entries of the snapshot can be merged.
+        """
+        return self.store.version == self.version
+
+    def merge(self):
+        """
+        Add the entries added to the view since the last merge to the store and append them
+        to its journal. Entries are dropped if the version of the store changed in the
+        meantime, e.g., because a vocabulary changed, as they may be derived from outdated
+        sources.
+
+        :return: The number of entries added to the store.
+        """
+        delta = list(dictionary_delta(self.dictionary.local, self._sizes))
+        with self.store.lock:
+            if not self.is_current():
+                return 0
+            self.store.merge(delta)
+            self.store.persist()
+        return len(delta)
+
+
+class _Overlay:
+    """
+    Dictionary of groups whose lookups fall through to a shared dictionary that is only
+    read, never iterated, so it can grow concurrently. New groups and entries are kept in
+    `local`.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.local = {}
+        self._groups = {}
+
+    def _group(self, group):
+        g = self._groups.get(group)
+        if g is None:
+            base = self.base.get(group)
+            if base is None:
+                return None
+            g = self._groups[group] = _OverlayGroup(base, self.local.setdefault(group, {}))
+        return g
+
+    def __contains__(self, group):
+        return group in self._groups or group in self.base
+
+    def __getitem__(self, group):
+        g = self._group(group)
+        if g is None:
+            raise KeyError(group)
+        return g
+
+    def get(self, group, default=None):
+        g = self._group(group)
+        return default if g is None else g
+
+    def __setitem__(self, group, entries):
+        local = self.local[group] = dict(entries)
+        self._groups[group] = _OverlayGroup({}, local)
+
+
+class _OverlayGroup:
+    """
+    The entries of a group of an _Overlay.
+    """
+    def __init__(self, base, local):
+        self.base = base
+        self.local = local
+
+    def __contains__(self, key):
+        return key in self.local or key in self.base
+
+    def __getitem__(self, key):
+        entry = self.local.get(key)
+        return self.base[key] if entry is None else entry
+
+    def get(self, key, default=None):
+        entry = self.local.get(key)
+        return self.base.get(key, default) if entry is None else entry
+
+    def __setitem__(self, key, entry):
+        self.local[key] = entry
+
+
+def _file_stat(path):
+    """
+    Identify a version of a file that is replaced (os.replace) or appended to.
+
+    :return: A tuple (inode, size, modification time) or None if the file does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
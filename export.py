@@ -0,0 +1,193 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import omop_settings
+from dictionary_store import DictionaryStore, dictionary_delta
+from omop import OMOP
+
+# State of a worker process, set up by _init_worker
+_omop = None
+_dictionary = None
+_sizes = None
+
+
+def _init_worker(settings, dictionary):
+    """
+    Set up the OMOP connection and a private copy of the dictionary of a worker process.
+
+    :param settings: The OMOP settings.
+    :param dictionary: The dictionary at the start of the export.
+    """
+    global _omop, _dictionary, _sizes
+    _omop = OMOP(settings, False)
+    _dictionary = dictionary
+    _sizes = dict((group, len(entries)) for (group, entries) in dictionary.items())
+
+
+def write_json(path, obj):
+    """
+    Write a JSON file atomically so interrupted exports never leave partial files.
+
+    :param path: The path of the file.
+    :param obj: The object to write.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def export_batch(pids, out_dir):
+    """
+    Export a batch of patients in a worker process. The batch is retrieved as a cohort with
+    one query per domain. If that fails the patients are retrieved one by one so a single
+    bad patient only fails itself.
+
+    :param pids: The person_ids of the batch.
+    :param out_dir: The directory to write the <pid>.json files to.
+    :return: A tuple (exported pids, list of (pid, error message), new dictionary entries).
+    """
+    done = []
+    failed = []
+    with _omop.connection():
+        try:
+            patients = _omop.get_patients(pids, _dictionary, None, None)
+        except Exception as e:
+            print("batch of {0} patients generated an exception, retrying one by one: {1}".format(len(pids), e), file=sys.stderr)
+            patients = None
+        for pid in pids:
+            try:
+                if patients is None:
+                    patient = _omop.get_patient(pid, _dictionary, None, None)
+                elif pid in patients:
+                    patient = patients[pid]
+                else:
+                    raise ValueError("no person row for person_id {0}".format(pid))
+                write_json(os.path.join(out_dir, "{0}.json".format(pid)), patient)
+                done.append(pid)
+            except Exception as e:
+                failed.append((pid, str(e)))
+    return (done, failed, list(dictionary_delta(_dictionary, _sizes)))
+
+
+def read_manifest(path):
+    """
+    Read the person_ids that were exported by earlier runs.
+
+    :param path: The path of the manifest file.
+    :return: The set of exported person_ids.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def read_pids(path):
+    """
+    Read person_ids from a file with one id per line (or the first column of a CSV file).
+
+    :param path: The path of the file or '-' for stdin.
+    :return: The list of person_ids.
+    """
+    f = sys.stdin if path == "-" else open(path, "r")
+    try:
+        pids = []
+        for line in f:
+            pid = line.split(",", 1)[0].strip()
+            if pid and pid.isdigit():
+                pids.append(pid)
+        return pids
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def export_patients(settings, pids, out_dir, workers, batch_size, force=False):
+    """
+    Export patients to <out_dir>/<pid>.json using a pool of worker processes.
+    Each worker extracts into its own copy of the dictionary and returns the entries it
+    added, which are merged into the dictionary store of the export directory. Entries of
+    vocabularies that changed since the last export are removed first. Exported
+    person_ids are appended to <out_dir>/export.manifest so an interrupted export can be
+    resumed by running it again.
+
+    :param settings: The OMOP settings.
+    :param pids: The person_ids to export.
+    :param out_dir: The output directory.
+    :param workers: The number of worker processes.
+    :param batch_size: The number of patients per task.
+    :param force: Boolean indicating whether to export patients listed in the manifest again.
+    :return: The number of failed patients.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    manifest_path = os.path.join(out_dir, "export.manifest")
+    if not force:
+        exported = read_manifest(manifest_path)
+        skipped = len(pids)
+        pids = [ pid for pid in pids if pid not in exported ]
+        skipped -= len(pids)
+        if skipped:
+            print("skipping {0} patients that are in the manifest".format(skipped), file=sys.stderr)
+    store = DictionaryStore(os.path.join(out_dir, "dictionary.json"))
+    omop = OMOP(settings, False)
+    sources = omop.get_dictionary_sources()
+    omop.update_sources(sources)
+    changed = store.update_sources(sources)
+    if changed:
+        print("dictionary sources changed: {0}".format(", ".join(sorted(changed))), file=sys.stderr)
+    batches = [ pids[ix:ix + batch_size] for ix in range(0, len(pids), batch_size) ]
+    total = len(pids)
+    count = 0
+    failures = 0
+    start = time.time()
+    with open(manifest_path, "a") as manifest:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings, store.dictionary)) as executor:
+            futures = [ executor.submit(export_batch, batch, out_dir) for batch in batches ]
+            for future in as_completed(futures):
+                (done, failed, delta) = future.result()
+                store.merge(delta)
+                store.persist()
+                manifest.write("".join(pid + "\n" for pid in done))
+                manifest.flush()
+                for (pid, msg) in failed:
+                    print("{0} generated an exception: {1}".format(pid, msg), file=sys.stderr)
+                count += len(done) + len(failed)
+                failures += len(failed)
+                elapsed = time.time() - start
+                print("exported {0}/{1} patients ({2:.1f} patients/sec)".format(count, total, count / elapsed if elapsed > 0 else 0), file=sys.stderr)
+    store.compact()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export patients from the OMOP database to JSON files.")
+    parser.add_argument("pids", nargs="*", help="person_ids to export (default: all patients)")
+    parser.add_argument("--pids-file", help="file with one person_id per line ('-' for stdin)")
+    parser.add_argument("--limit", type=int, default=None, help="export at most this many patients when listing all")
+    parser.add_argument("--out", default="json", help="output directory (default: json)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=100, help="patients per worker task")
+    parser.add_argument("--force", action="store_true", help="export patients already listed in the manifest")
+    args = parser.parse_args()
+
+    settings = omop_settings()
+    pids = list(args.pids)
+    if args.pids_file:
+        pids.extend(read_pids(args.pids_file))
+    if not pids:
+        patients = set()
+        OMOP(settings, False).list_patients(patients, limit=args.limit)
+        pids = sorted(patients, key=int)
+    failures = export_patients(settings, pids, args.out, args.workers, args.batch_size, args.force)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from __future__ import print_function
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import closing
+
+
+class HierarchyCache:
+    def __init__(self, path):
+        """
+        Persistent cache of the nearest parent of each concept in the concept hierarchy.
+        Entries are kept in memory and in a SQLite file so they survive restarts and can be
+        shared between processes. Each entry maps a concept id to its domain and vocabulary
+        and the id, distance (dos), name, vocabulary and code of its nearest ancestor within
+        the same domain. Concepts without such an ancestor are cached with a parent of None.
+
+        :param path: Path of the SQLite file, e.g., json/hierarchy.sqlite.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self._entries = {}
+        self.complete = False
+        self.sources = {}
+        with closing(self._connect()) as db:
+            with db:
+                db.execute("""CREATE TABLE IF NOT EXISTS hierarchy (
+                    concept_id TEXT PRIMARY KEY,
+                    domain TEXT,
+                    vocab TEXT,
+                    parent_id TEXT,
+                    dos INTEGER,
+                    parent_name TEXT,
+                    parent_vocab TEXT,
+                    parent_code TEXT
+                )""")
+                db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            for row in db.execute("SELECT * FROM hierarchy"):
+                self._entries[row[0]] = row
+            self.complete = db.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone() is not None
+            row = db.execute("SELECT value FROM meta WHERE key = 'sources'").fetchone()
+            if row is not None:
+                self.sources = json.loads(row[0])
+
+    def _connect(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, concept_id):
+        """
+        Look up the cached entry of a concept.
+
+        :param concept_id: The concept id as string.
+        :return: The tuple (concept_id, domain, vocab, parent_id, dos, parent_name, parent_vocab,
+            parent_code) or None if the concept is not cached. If the cache is complete every
+            concept without entry is reported as having no parent.
+        """
+        res = self._entries.get(concept_id)
+        if res is None and self.complete:
+            return (concept_id, None, None, None, None, None, None, None)
+        return res
+
+    def missing(self, concept_ids):
+        """
+        Filter the concepts that are not cached.
+
+        :param concept_ids: Iterable of concept ids as strings.
+        :return: The sorted list of concept ids that need to be looked up in the database.
+        """
+        if self.complete:
+            return []
+        return sorted(cid for cid in concept_ids if cid not in self._entries)
+
+    def add_ancestor_rows(self, concept_ids, rows):
+        """
+        Fill the cache for the given concepts from rows of the concept_ancestor query in
+        OMOP.get_ancestors. The nearest ancestor in the same domain becomes the parent.
+
+        :param concept_ids: The concept ids that were looked up.
+        :param rows: The ancestor rows of those concepts.
+        """
+        best = {}
+        for row in rows:
+            desc_id = str(row['c_desc_id'])
+            parent_id = str(row['c_id'])
+            if parent_id == desc_id or row['c_domain'] != row['c_desc_domain']:
+                continue
+            dos = int(row['c_distance'])
+            cur = best.get(desc_id)
+            if cur is None or cur[4] > dos:
+                best[desc_id] = (desc_id, row['c_desc_domain'], row['c_desc_vocab'], parent_id, dos, row['c_name'], row['c_vocab'], row['c_num'])
+        entries = [ best.get(cid, (cid, None, None, None, None, None, None, None)) for cid in concept_ids ]
+        self._store(entries)
+
+    def _store(self, entries):
+        with self.lock:
+            for e in entries:
+                self._entries[e[0]] = e
+            with closing(self._connect()) as db:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO hierarchy VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+
+    def update_sources(self, sources):
+        """
+        Drop the entries of concepts or parents whose vocabulary version changed and
+        record the new versions. The dropped concepts are looked up again when needed.
+        A cache without recorded versions is assumed to be up to date.
+
+        :param sources: Dict of source to version as returned by OMOP.get_dictionary_sources.
+        """
+        sources = dict((key, value) for (key, value) in sources.items() if key.startswith("vocabulary:"))
+        if sources == self.sources:
+            return
+        changed = set(
+            key[len("vocabulary:"):] for key in set(sources) | set(self.sources)
+            if self.sources and sources.get(key) != self.sources.get(key)
+        )
+        with self.lock:
+            stale = [ (e[0],) for e in self._entries.values() if e[2] in changed or e[6] in changed ]
+            for (cid,) in stale:
+                del self._entries[cid]
+            with closing(self._connect()) as db:
+                with db:
+                    db.executemany("DELETE FROM hierarchy WHERE concept_id = ?", stale)
+                    if stale:
+                        db.execute("DELETE FROM meta WHERE key = 'complete'")
+                    db.execute("INSERT OR REPLACE INTO meta VALUES ('sources', ?)", (json.dumps(sources, sort_keys=True),))
+            if stale:
+                self.complete = False
+                print("hierarchy cache: dropped {0} concepts of changed vocabularies".format(len(stale)), file=sys.stderr)
+            self.sources = sources
+
+    def bulk_load(self, omop, batch_size=10000):
+        """
+        Compute the nearest parent of every concept in the database at once. Afterwards
+        lookups never hit the database. On PostgreSQL the database picks the nearest
+        parent of each concept (DISTINCT ON); other databases send all ancestors ordered
+        by distance and the first one of each concept is kept.
+
+        :param omop: The OMOP instance to query.
+        :param batch_size: Number of rows fetched and stored at a time.
+        """
+        distinct = "DISTINCT ON (ca.descendant_concept_id)" if omop.db.dialect.name == "postgresql" else ""
+        query = """SELECT {distinct}
+             ca.descendant_concept_id as c_desc_id,
+             cc.domain_id as c_desc_domain,
+             cc.vocabulary_id as c_desc_vocab,
+             c.concept_id as c_id,
+             ca.min_levels_of_separation as c_distance,
+             c.concept_name as c_name,
+             c.vocabulary_id as c_vocab,
+             c.concept_code as c_num
+            FROM
+             {schema}.concept_ancestor as ca
+            INNER JOIN {schema}.concept as c ON (
+             c.concept_id = ca.ancestor_concept_id
+            ) INNER JOIN {schema}.concept as cc ON (
+             cc.concept_id = ca.descendant_concept_id
+            ) WHERE
+             ca.descendant_concept_id != 0
+             AND ca.ancestor_concept_id != 0
+             AND ca.ancestor_concept_id != ca.descendant_concept_id
+             AND c.domain_id = cc.domain_id
+            ORDER BY
+             ca.descendant_concept_id,
+             ca.min_levels_of_separation
+        """.format(distinct=distinct, schema=omop.schema)
+        total = 0
+        last = None
+        with omop.connection() as connection:
+            result = connection.exec_driver_sql(query, execution_options={ "stream_results": True }).mappings()
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                entries = []
+                for r in rows:
+                    if r['c_desc_id'] == last:
+                        continue
+                    last = r['c_desc_id']
+                    entries.append((str(r['c_desc_id']), r['c_desc_domain'], r['c_desc_vocab'], str(r['c_id']), int(r['c_distance']), r['c_name'], r['c_vocab'], r['c_num']))
+                self._store(entries)
+                total += len(entries)
+                print("hierarchy cache: {0} concepts".format(total), file=sys.stderr)
+        with closing(self._connect()) as db:
+            with db:
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
+        self.complete = True
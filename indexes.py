@@ -0,0 +1,258 @@
+from __future__ import print_function
+import argparse
+import sys
+import time
+
+import sqlalchemy
+
+from config import omop_settings
+from export import read_pids
+from omop import OMOP, domain_queries
+
+
+def required_indexes():
+    """
+    List the indexes the queries of OMOP rely on: an index on person_id for every table
+    of `domain_queries`, an index on concept_ancestor.descendant_concept_id for the
+    hierarchy queries and an index on concept.concept_id for the concept cache. Each
+    index lists the columns the queries select from its table, which a covering index
+    includes so the rows can be read from the index alone.
+
+    :return: List of tuples (table, key column, covered columns).
+    """
+    res = []
+    tables = {}
+    for spec in domain_queries.values():
+        table = spec["from"].split()[0].split(".")[1]
+        if table not in tables:
+            tables[table] = []
+            res.append((table, "person_id", tables[table]))
+        for column in spec["columns"].values():
+            if column.startswith("o.") and column[2:] != "person_id" and column[2:] not in tables[table]:
+                tables[table].append(column[2:])
+    res.append(("concept_ancestor", "descendant_concept_id", [ "ancestor_concept_id", "min_levels_of_separation" ]))
+    res.append(("concept", "concept_id", [ "domain_id", "concept_name", "vocabulary_id", "concept_code" ]))
+    return res
+
+
+def invalid_indexes(omop):
+    """
+    Find the indexes of OMOP_SCHEMA that queries do not use because building them
+    failed, e.g., an interrupted CREATE INDEX CONCURRENTLY (PostgreSQL only).
+
+    :param omop: The OMOP instance.
+    :return: The set of index names.
+    """
+    if omop.db.dialect.name != "postgresql":
+        return set()
+    query = sqlalchemy.text("""
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND NOT i.indisvalid
+    """)
+    with omop.db.connect() as connection:
+        return set(row[0] for row in connection.execute(query, { "schema": omop.schema }))
+
+
+def inspect_indexes(omop, required):
+    """
+    Find the existing indexes (or primary keys) whose first column is the key column of
+    a required index. Invalid indexes (see `invalid_indexes`) do not count as they are
+    not used by queries.
+
+    :param omop: The OMOP instance.
+    :param required: The indexes as returned by `required_indexes`.
+    :return: List of tuples (table, key column, covered columns, status, name of the
+        supporting index or None, boolean indicating whether it covers the columns) where
+        the status is "ok", "missing", "invalid" (the name is the one of the invalid
+        index) or "no table".
+    """
+    inspector = sqlalchemy.inspect(omop.db)
+    tables = set(inspector.get_table_names(schema=omop.schema))
+    invalid = invalid_indexes(omop)
+    res = []
+    for (table, column, covered) in required:
+        if table not in tables:
+            res.append((table, column, covered, "no table", None, False))
+            continue
+        found = None
+        covering = False
+        broken = None
+        pk = inspector.get_pk_constraint(table, schema=omop.schema)
+        if pk and pk.get("constrained_columns", [])[:1] == [ column ]:
+            found = pk.get("name") or "primary key"
+            covering = set(covered) <= set(pk["constrained_columns"])
+        for index in inspector.get_indexes(table, schema=omop.schema):
+            columns = [ c for c in index.get("column_names", []) if c is not None ]
+            if columns[:1] != [ column ]:
+                continue
+            if index["name"] in invalid:
+                broken = index["name"]
+                continue
+            columns.extend(index.get("dialect_options", {}).get("postgresql_include", []))
+            if found is None or (not covering and set(covered) <= set(columns)):
+                found = index["name"]
+                covering = set(covered) <= set(columns)
+        if found is not None:
+            res.append((table, column, covered, "ok", found, covering))
+        elif broken is not None:
+            res.append((table, column, covered, "invalid", broken, False))
+        else:
+            res.append((table, column, covered, "missing", None, False))
+    return res
+
+
+def index_name(table, column, covering):
+    """
+    Name the index `create_index` creates; covering indexes get a name of their own so
+    they can be created next to an existing index on the key column.
+    """
+    return "idx_{0}_{1}{2}".format(table, column, "_covering" if covering else "")
+
+
+def create_index(omop, table, column, covered, covering=False, concurrently=False):
+    """
+    Create an index on the key column of a table and update the statistics of the table.
+    On PostgreSQL covering indexes include the covered columns (INCLUDE); on other
+    databases they are appended to the key.
+
+    :param omop: The OMOP instance.
+    :param table: The table.
+    :param column: The key column.
+    :param covered: The columns of a covering index.
+    :param covering: Boolean indicating whether to create a covering index.
+    :param concurrently: Boolean indicating whether to build the index without blocking
+        writes to the table (PostgreSQL only).
+    :return: The CREATE INDEX statement.
+    """
+    dialect = omop.db.dialect.name
+    name = index_name(table, column, covering and bool(covered))
+    columns = "({0})".format(column)
+    if covering and covered:
+        if dialect == "postgresql":
+            columns += " INCLUDE ({0})".format(", ".join(covered))
+        else:
+            columns = "({0})".format(", ".join([ column ] + covered))
+    if dialect == "sqlite":
+        # the schema of an attached database qualifies the index, not the table
+        query = "CREATE INDEX {0}.{1} ON {2} {3}".format(omop.schema, name, table, columns)
+    else:
+        query = "CREATE INDEX {0}{1} ON {2}.{3} {4}".format(
+            "CONCURRENTLY " if concurrently and dialect == "postgresql" else "", name, omop.schema, table, columns)
+    analyze = "ANALYZE TABLE {0}.{1}" if dialect == "mysql" else "ANALYZE {0}.{1}"
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with omop.db.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(query)
+        connection.exec_driver_sql(analyze.format(omop.schema, table))
+    return query
+
+
+def drop_index(omop, name, concurrently=False):
+    """
+    Drop an index, e.g., an invalid one before building it again.
+
+    :param omop: The OMOP instance.
+    :param name: The name of the index.
+    :param concurrently: Boolean indicating whether to drop the index without blocking
+        the table (PostgreSQL only).
+    :return: The DROP INDEX statement.
+    """
+    query = "DROP INDEX {0}{1}.{2}".format(
+        "CONCURRENTLY " if concurrently and omop.db.dialect.name == "postgresql" else "", omop.schema, name)
+    with omop.db.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(query)
+    return query
+
+
+def benchmark(settings, pids):
+    """
+    Time the extraction of patients. The hierarchy cache is not used and every patient
+    starts with an empty dictionary, so all queries of OMOP.get_patient reach the database.
+
+    :param settings: The OMOP settings.
+    :param pids: The person_ids to extract.
+    :return: List of the seconds each patient took.
+    """
+    omop = OMOP(dict(settings, omop_hierarchy_cache=""), False)
+    times = []
+    try:
+        for pid in pids:
+            start = time.time()
+            omop.get_patient(pid, {}, None, None)
+            times.append(time.time() - start)
+    finally:
+        omop.db.dispose()
+    return times
+
+
+def print_benchmark(label, times):
+    if not times:
+        return
+    times = sorted(times)
+    print("{0}: median {1:.0f} ms, max {2:.0f} ms, total {3:.2f}s for {4} patients".format(
+        label, 1000 * times[len(times) // 2], 1000 * times[-1], sum(times), len(times)))
+
+
+def print_report(status):
+    for (table, column, covered, state, name, covering) in status:
+        if state == "ok":
+            detail = "{0}{1}".format(name, "" if covering else " (not covering)")
+        elif state == "invalid":
+            detail = "missing ({0} is invalid)".format(name)
+        else:
+            detail = state
+        print("{0}.{1}: {2}".format(table, column, detail))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and create the indexes the patient queries rely on in OMOP_SCHEMA.")
+    parser.add_argument("--create", action="store_true", help="create the missing indexes and rebuild invalid ones")
+    parser.add_argument("--covering", action="store_true", help="create covering indexes that include the selected columns, also next to existing indexes that do not cover them")
+    parser.add_argument("--concurrently", action="store_true", help="build indexes without blocking writes (PostgreSQL only)")
+    parser.add_argument("--benchmark", type=int, default=0, metavar="N", help="time the extraction of N patients before and after creating indexes")
+    parser.add_argument("--pids-file", help="file with the person_ids to benchmark ('-' for stdin)")
+    args = parser.parse_args()
+
+    settings = omop_settings()
+    omop = OMOP(settings, False)
+    status = inspect_indexes(omop, required_indexes())
+    print_report(status)
+    missing = [ s for s in status if s[3] in ("missing", "invalid") ]
+
+    pids = []
+    if args.benchmark:
+        if args.pids_file:
+            pids = read_pids(args.pids_file)[:args.benchmark]
+        else:
+            patients = set()
+            omop.list_patients(patients, limit=args.benchmark)
+            pids = sorted(patients, key=int)
+        print_benchmark("before", benchmark(settings, pids))
+
+    create = list(missing)
+    if args.covering:
+        create.extend(s for s in status if s[3] == "ok" and not s[5])
+    if args.create and create:
+        for (table, column, covered, state, name, _) in create:
+            start = time.time()
+            try:
+                if state == "invalid":
+                    print(drop_index(omop, name, args.concurrently), file=sys.stderr)
+                query = create_index(omop, table, column, covered, args.covering, args.concurrently)
+                print("{0} ({1:.1f}s)".format(query, time.time() - start), file=sys.stderr)
+                if state == "ok":
+                    print("the covering index supersedes {0} which can be dropped unless it is a primary key or used otherwise".format(name), file=sys.stderr)
+            except Exception as e:
+                print("creating the index on {0}.{1} failed: {2}".format(table, column, e), file=sys.stderr)
+        status = inspect_indexes(omop, required_indexes())
+        print_report(status)
+        missing = [ s for s in status if s[3] in ("missing", "invalid") ]
+        if args.benchmark:
+            print_benchmark("after", benchmark(settings, pids))
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == "__main__":
+    main()
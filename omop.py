@@ -3,9 +3,12 @@ from __future__ import print_function
 import json
 import os
 import sys
+import threading
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 from venv import logger
 import sqlalchemy
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 # Mapping for gender labels to CSS classes for styling 
@@ -40,8 +43,123 @@ measure_flag_map = {
     }
 }
 
+# Unified row shape of the domain queries together with the SQL types used to pad
+# the columns a domain does not provide when queries are combined with UNION ALL.
+# The attributes of the concepts are not selected but added from the concept cache
+# (see OMOP._resolve_concepts)
+row_columns = [
+    ("id_row", "BIGINT"),
+    ("date_start", "DATE"),
+    ("date_end", "DATE"),
+    ("c_id", "BIGINT"),
+    ("c_orig", "VARCHAR"),
+    ("v_concept_id", "BIGINT"),
+    ("v_string", "VARCHAR"),
+    ("v_number", "NUMERIC"),
+    ("v_low", "NUMERIC"),
+    ("v_high", "NUMERIC"),
+]
+# Source tables, selected columns and extra filters of the per-person queries.
+# Every query is additionally filtered by `o.person_id = :pid` (or `o.person_id IN :pids`
+# for cohorts)
+domain_queries = {
+    "person": {
+        "from": "{schema}.person as o",
+        "columns": {
+            "c_id": "o.gender_concept_id",
+            "c_orig": "o.person_source_value",
+            "v_number": "o.year_of_birth",
+        },
+    },
+    "condition": {
+        "from": "{schema}.condition_occurrence as o",
+        "columns": {
+            "id_row": "o.condition_occurrence_id",
+            "date_start": "o.condition_start_date",
+            "date_end": "o.condition_end_date",
+            "c_id": "o.condition_concept_id",
+            "c_orig": "o.condition_source_value",
+        },
+    },
+    "observation": {
+        "from": "{schema}.observation as o",
+        "columns": {
+            "id_row": "o.observation_id",
+            "date_start": "o.observation_date",
+            "c_id": "o.observation_concept_id",
+            "c_orig": "o.observation_source_value",
+            "v_concept_id": "o.value_as_concept_id",
+            "v_string": "o.value_as_string",
+            "v_number": "o.value_as_number",
+        },
+        "where": [ "(o.value_as_concept_id IS NOT NULL OR o.value_as_string IS NOT NULL OR o.value_as_number IS NOT NULL)" ],
+    },
+    "procedure": {
+        "from": "{schema}.procedure_occurrence as o",
+        "columns": {
+            "id_row": "o.procedure_occurrence_id",
+            "date_start": "o.procedure_date",
+            "c_id": "o.procedure_concept_id",
+            "c_orig": "o.procedure_source_value",
+        },
+    },
+    "drug": {
+        "from": "{schema}.drug_exposure as o",
+        "columns": {
+            "id_row": "o.drug_exposure_id",
+            "date_start": "o.drug_exposure_start_date",
+            "date_end": "o.drug_exposure_end_date",
+            "c_id": "o.drug_concept_id",
+            "c_orig": "o.drug_source_value",
+        },
+    },
+    "measurement": {
+        "from": "{schema}.measurement as o",
+        "columns": {
+            "id_row": "o.measurement_id",
+            "date_start": "o.measurement_date",
+            "c_id": "o.measurement_concept_id",
+            "c_orig": "o.measurement_source_value",
+            "v_number": "o.value_as_number",
+            "v_low": "o.range_low",
+            "v_high": "o.range_high",
+        },
+    },
+    "visit": {
+        "from": "{schema}.visit_occurrence as o",
+        "columns": {
+            "date_start": "o.visit_start_date",
+            "date_end": "o.visit_end_date",
+            "c_id": "o.visit_concept_id",
+        },
+        "where": [ "o.visit_concept_id IN :class_ids" ],
+    },
+}
+# Event domains of each group in the order their events are emitted
+group_domains = [
+    ("Condition", [ "condition" ]),
+    ("Observation", [ "observation" ]),
+    ("Procedure", [ "procedure" ]),
+    ("Drug", [ "drug" ]),
+    ("Measurement", [ "measurement" ]),
+]
+# Names of the row handlers of the event domains
+domain_handlers = {
+    "condition": "add_condition",
+    "observation": "add_observation",
+    "procedure": "add_procedure",
+    "drug": "add_drug",
+    "measurement": "add_measurement",
+}
+# Order of the events of an observation row by result flag. Each row yields an event per
+# kind of value and the events of a patient are ordered by kind first, as they were when
+# each kind was retrieved by a query of its own.
+observation_flags = { "C": 0, "S": 1, "N": 2 }
+
 # Importing custom utilities 
 import util
+from hierarchy_cache import HierarchyCache
+from concept_cache import ConceptCache
 
 class OMOP:
     def __init__(self, settings, debug_output):
@@ -59,16 +177,102 @@ class OMOP:
         engine = settings.get('omop_engine', 'postgresql')
 
         self.schema = settings['omop_schema']
-        self.db = sqlalchemy.create_engine(f'{engine}://{username}:{password}@{host}:{port}/{database}')
+        # the engine is created when it is first used (see `db`), so instances whose queries
+        # all run on given connections, e.g., of async_omop.AsyncOMOP, never create one
+        self._url = settings.get('omop_url') or f'{engine}://{username}:{password}@{host}:{port}/{database}'
+        self._engine_options = {
+            "pool_size": int(settings.get('omop_pool_size', 5)),
+            "max_overflow": int(settings.get('omop_max_overflow', 10)),
+            "pool_timeout": float(settings.get('omop_pool_timeout', 30)),
+            "pool_recycle": int(settings.get('omop_pool_recycle', -1)),
+            "pool_pre_ping": bool(settings.get('omop_pool_pre_ping', False)),
+        }
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._connection = ContextVar('omop_connection', default=None)
+        self._batched = settings.get('omop_batched', False)
+        self._fetch_size = int(settings.get('omop_fetch_size', 1000))
+        self._parallel = settings.get('omop_parallel', False)
+        self._parallel_workers = int(settings.get('omop_parallel_workers', 7))
+        # the threads of parallel queries are started when they are first used (see `executor`)
+        self._executor = None
+        pool_capacity = self._engine_options["pool_size"] + self._engine_options["max_overflow"]
+        if self._parallel and self._parallel_workers >= pool_capacity:
+            print("WARNING: {0} parallel workers exhaust the pool of {1} connections (omop_pool_size + omop_max_overflow), queries of requests will wait for connections".format(
+                self._parallel_workers, pool_capacity), file=sys.stderr)
+        self._hierarchy = HierarchyCache(settings['omop_hierarchy_cache']) if settings.get('omop_hierarchy_cache') else None
+        self._concepts = ConceptCache(int(settings.get('omop_concept_cache_size', 100000)))
+        self._concept_preload = [ v for v in settings.get('omop_concept_preload', '').split(',') if v ]
+        self._class_ids = {}
         self._parents = {}
         self._codes = {}
+        self._ccs_versions = {}
         if settings['omop_use_alt_hierarchies']:
             if 'ccs_diag' in settings:
-                self._codes['Condition_ICD9CM'] = {}
-                self._parents['Condition_ICD9CM'] = util.read_CCS(util.get_file(settings['ccs_diag'], debug_output), self._codes['Condition_ICD9CM'])
+                self._read_CCS('Condition_ICD9CM', util.get_file(settings['ccs_diag'], debug_output))
             if 'ccs_proc' in settings:
-                self._codes['Procedure_ICD9CM'] = {}
-                self._parents['Procedure_ICD9CM'] = util.read_CCS(util.get_file(settings['ccs_proc'], debug_output), self._codes['Procedure_ICD9CM'])
+                self._read_CCS('Procedure_ICD9CM', util.get_file(settings['ccs_proc'], debug_output))
+
+    @property
+    def db(self):
+        """
+        The SQLAlchemy engine of the connection settings, created on first use.
+        """
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = sqlalchemy.create_engine(self._url, **self._engine_options)
+        return self._db
+
+    @property
+    def executor(self):
+        """
+        The thread pool of `get_domains_parallel` with `omop_parallel_workers` threads,
+        created on first use.
+        """
+        if self._executor is None:
+            with self._db_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._parallel_workers)
+        return self._executor
+
+    def _read_CCS(self, alt_hierarchies, path):
+        """
+        Read the alternative hierarchy of a group from a CCS file and record the
+        modification time of the file as its version.
+
+        :param alt_hierarchies: The group and prefix of the hierarchy, e.g., Condition_ICD9CM.
+        :param path: The path of the CCS file.
+        """
+        self._ccs_versions[alt_hierarchies] = str(os.path.getmtime(path)) if os.path.isfile(path) else ""
+        self._codes[alt_hierarchies] = {}
+        self._parents[alt_hierarchies] = util.read_CCS(path, self._codes[alt_hierarchies])
+
+    @contextmanager
+    def connection(self, connection=None):
+        """
+        Scope in which all queries of the current thread (or task, see async_omop) share
+        one pooled connection. Nested scopes reuse the connection of the outermost scope
+        which is returned to the pool when that scope ends.
+
+        :param connection: Optional connection to use instead of a pooled one, e.g., the
+            synchronous facade of an asyncio connection. It is not closed by the scope.
+        :return: The connection of the scope.
+        """
+        current = self._connection.get()
+        if current is not None:
+            yield current
+            return
+        owned = connection is None
+        if owned:
+            connection = self.db.connect()
+        self._connection.set(connection)
+        try:
+            yield connection
+        finally:
+            self._connection.set(None)
+            if owned:
+                connection.close()
 
     def _exec(self, query, **args):
         """
@@ -76,18 +280,76 @@ class OMOP:
 
         :param query: The SQL query to be executed
         :param **args: Arguments to bind to the query.
-        :return: Returns the result of the SQL query
+        :return: Returns the rows of the SQL query
         """
-        connection = None
-        try:
-            connection = self.db.connect()
-            q = query.format(schema=self.schema)
-            stmt = sqlalchemy.text(q).bindparams(**args)
-            result = connection.execute(stmt)
-            return result.mappings()
-        finally:
-            if connection:
-                connection.close()
+        with self.connection() as connection:
+            return connection.execute(self._statement(query, **args)).mappings().all()
+
+    def _stream(self, query, batch_size=None, **args):
+        """
+        Execute a SQL query on a server-side cursor and hand out its rows in batches, so
+        the driver never buffers the whole result.
+
+        :param query: The SQL query to be executed
+        :param batch_size: The number of rows per batch. If None, the `omop_fetch_size`
+            setting is used.
+        :param **args: Arguments to bind to the query.
+        :return: A generator of lists of rows.
+        """
+        if batch_size is None:
+            batch_size = self._fetch_size
+        with self.connection() as connection:
+            # the options apply to this statement only; Connection.execution_options would
+            # change the shared connection for all later queries
+            result = connection.execute(self._statement(query, **args), execution_options={ "stream_results": True, "yield_per": batch_size })
+            try:
+                for rows in result.mappings().partitions(batch_size):
+                    yield rows
+            finally:
+                result.close()
+
+    def _statement(self, query, **args):
+        """
+        Build the statement of a SQL query.
+
+        :param query: The SQL query with a `{schema}` placeholder.
+        :param **args: Arguments to bind to the query.
+        :return: The statement.
+        """
+        q = query.format(schema=self.schema)
+        # lists are bound as expanding parameters, i.e., `IN :param`
+        return sqlalchemy.text(q).bindparams(*[
+            sqlalchemy.bindparam(key, value, expanding=isinstance(value, (list, tuple)))
+            for (key, value) in args.items()
+        ])
+
+    def _stream_domain(self, domain, batch_size=None, **args):
+        """
+        Execute the query of a domain (see `_domain_query`) on a server-side cursor and hand
+        out its rows in batches together with the attributes of their concepts.
+
+        :param domain: The key of the domain in `domain_queries`.
+        :param batch_size: The number of rows per batch. If None, the `omop_fetch_size`
+            setting is used.
+        :param **args: Arguments to bind to the query. A cohort is queried if `pids` is
+            bound and only the rows above `since` are selected if it is bound.
+        :return: A generator of lists of rows as returned by `_resolve_concepts`.
+        """
+        query = self._domain_query(domain, cohort="pids" in args, since="since" in args)
+        for rows in self._stream(query, batch_size=batch_size, **args):
+            yield self._resolve_concepts(rows)
+
+    def _domain_rows(self, domain, **args):
+        """
+        Execute the query of a domain like `_stream_domain` and hand out its rows one by one.
+
+        :param domain: The key of the domain in `domain_queries`.
+        :param **args: Arguments to bind to the query (see `_stream_domain`).
+        :return: A generator of rows.
+        """
+        for rows in self._stream_domain(domain, **args):
+            for row in rows:
+                yield row
 
     def _exec_one(self, query, **args):
         """
@@ -98,7 +360,7 @@ class OMOP:
         :return: The single result row.
         """
         result = self._exec(query, **args)
-        res = result.first()
+        res = result[0] if result else None
         if res is None:
             raise ValueError(f"expected one result row got 0\n{query}\n")
         return res
@@ -162,22 +424,20 @@ class OMOP:
         :param pid: The person_id of the patient.
         :param obj: The object to add information to.
         """
-        query = """SELECT
-             concept_name as gender_concept_name,
-             person_source_value,
-             year_of_birth
-            FROM
-             {schema}.person
-            LEFT JOIN {schema}.concept ON (
-             gender_concept_id = concept_id
-            ) WHERE
-             person_id = :pid
+        result = self._exec_one(self._domain_query("person"), pid=str(pid))
+        self.add_person(self._resolve_concepts([ result ])[0], obj)
+
+    def add_person(self, row, obj):
+        """
+        Add the demographic information of a person row to the provided object.
+
+        :param row: The person row.
+        :param obj: The object to add information to.
         """
-        result = self._exec_one(query, pid=str(pid))
-        # if result['person_source_value']:
-        #     self.add_info(obj, 'id_alt', 'ID', str(result['person_source_value']) + ".json")
-        self.add_info(obj, 'born', 'Born', int(result['year_of_birth']))
-        gender = str(result['gender_concept_name'])
+        # if row['c_orig']:
+        #     self.add_info(obj, 'id_alt', 'ID', str(row['c_orig']) + ".json")
+        self.add_info(obj, 'born', 'Born', int(row['v_number']))
+        gender = str(row['c_name'])
         # defaults to 'U' for "unknown"
         self.add_info(obj, 'gender', 'Gender', gender_map.get(gender.upper(), 'U'), True, gender_label.get(gender, 'U'))
 
@@ -188,7 +448,7 @@ class OMOP:
         :param value: The date value to convert.
         :return: The converted time value.
         """
-        return util.toTime(value.strftime("%Y%m%d"))
+        return util.date_to_time(value)
 
     def create_event(self, group, id, claim_id, has_result=False, result_flag="", result=""):
         """
@@ -297,294 +557,494 @@ class OMOP:
         full_id = str(prefix) + str(id)
         return dict[group].get(full_id, None)
 
+    def get_ancestors(self, concept_ids):
+        """
+        Retrieve all ancestors of the given concepts from the concept_ancestor table.
+
+        :param concept_ids: Iterable of concept ids as strings.
+        :return: The ancestor rows.
+        """
+        query = """SELECT
+             c.concept_id as c_id,
+             c.domain_id as c_domain,
+             c.concept_name as c_name,
+             c.vocabulary_id as c_vocab,
+             c.concept_code as c_num,
+             ca.min_levels_of_separation as c_distance,
+             ca.descendant_concept_id as c_desc_id,
+             cc.domain_id as c_desc_domain,
+             cc.vocabulary_id as c_desc_vocab
+            FROM
+             {schema}.concept_ancestor as ca
+            LEFT JOIN {schema}.concept as c ON (
+             c.concept_id = ca.ancestor_concept_id
+            ) LEFT JOIN {schema}.concept as cc ON (
+             cc.concept_id = ca.descendant_concept_id
+            ) WHERE
+             ca.descendant_concept_id != 0
+             AND ca.ancestor_concept_id != 0
+             AND ca.descendant_concept_id IN ( {id_list} )
+        """.format(schema=self.schema, id_list=','.join(sorted(list(concept_ids))))
+        return self._exec(query)
+
     def update_hierarchies(self, dict, new_dict_entries):
         """
         Update the hierarchies in the dictionary based on new entries.
 
+        :param dict: The dictionary to update.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        """
+        if self._hierarchy is not None:
+            self.update_hierarchies_cached(dict, new_dict_entries)
+            return
+        with self.connection():
+            while new_dict_entries:
+                result = self.get_ancestors(new_dict_entries)
+                new_dict_entries.clear()
+                for row in result:
+                    parent_id = str(row['c_id'])
+                    parent_group = row['c_domain']
+                    parent_name = row['c_name']
+                    parent_vocab = row['c_vocab']
+                    parent_code = row['c_num']
+                    unmapped = False
+                    if parent_code == 0:
+                        parent_code = row['c_orig']
+                        unmapped = True
+                    parent_desc = "{0} ({1} {2})".format(parent_name, parent_vocab, parent_code)
+                    self.add_dict(dict, new_dict_entries, parent_group, parent_vocab, parent_id, parent_name, parent_desc, parent_code, unmapped)
+                    dos = int(row['c_distance'])
+                    desc_id = str(row['c_desc_id'])
+                    desc_vocab = row['c_desc_vocab']
+                    desc_group = row['c_desc_domain']
+                    if desc_group != parent_group:
+                        print("WARNING: intra group inheritance: {0} << {1}".format(parent_group, desc_group), file=sys.stderr)
+                    else:
+                        desc_entry = self.get_dict_entry(dict, desc_group, desc_vocab, desc_id)
+                        if desc_entry is not None and parent_id != desc_id and ('dos' not in desc_entry or desc_entry['dos'] > dos):
+                            desc_entry['dos'] = dos
+                            desc_entry['parent'] = str(parent_vocab) + str(parent_id)
+                new_dict_entries.clear()
+
+    def preload_hierarchy(self):
+        """
+        Fill the hierarchy cache with the nearest parent of every concept unless it is already
+        complete. Does nothing if no hierarchy cache is configured.
+        """
+        if self._hierarchy is not None and not self._hierarchy.complete:
+            self._hierarchy.bulk_load(self)
+
+    def get_vocabulary_versions(self):
+        """
+        Retrieve the version of each vocabulary from the vocabulary table.
+
+        :return: Dict of vocabulary_id to vocabulary_version.
+        """
+        query = "SELECT vocabulary_id, vocabulary_version FROM {schema}.vocabulary"
+        return dict((str(r['vocabulary_id']), str(r['vocabulary_version'])) for r in self._exec(query))
+
+    def get_dictionary_sources(self):
+        """
+        Determine the versions of the sources of dictionary entries: the version of each
+        vocabulary ("vocabulary:<vocabulary_id>") and the modification time of each CCS
+        file the alternative hierarchies were read from ("ccs:<group>_<prefix>").
+        The CCS versions are those of the files as they were read at startup.
+
+        :return: Dict of source to version.
+        """
+        res = dict(("vocabulary:" + vocab, version) for (vocab, version) in self.get_vocabulary_versions().items())
+        for (alt_hierarchies, version) in self._ccs_versions.items():
+            res["ccs:" + alt_hierarchies] = version
+        return res
+
+    def update_sources(self, sources):
+        """
+        Drop the cached concepts and the entries of the hierarchy cache that belong to
+        vocabularies whose version changed since they were cached.
+
+        :param sources: The current versions as returned by `get_dictionary_sources`.
+        """
+        if self._concepts.update_sources(sources):
+            self._class_ids = {}
+        if self._hierarchy is not None:
+            self._hierarchy.update_sources(sources)
+
+    def update_hierarchies_cached(self, dict, new_dict_entries):
+        """
+        Update the hierarchies in the dictionary based on new entries using the hierarchy cache.
+        Only concepts missing from the cache are looked up in the database (in one query per
+        level of new parents). Each entry gets its nearest ancestor in the same domain as
+        parent which is added to the dictionary in turn.
+
         :param dict: The dictionary to update.
         :param new_dict_entries: Set of new dictionary entries to be updated.
         """
         while new_dict_entries:
-            query = """SELECT
-                 c.concept_id as c_id,
-                 c.domain_id as c_domain,
-                 c.concept_name as c_name,
-                 c.vocabulary_id as c_vocab,
-                 c.concept_code as c_num,
-                 ca.min_levels_of_separation as c_distance,
-                 ca.descendant_concept_id as c_desc_id,
-                 cc.domain_id as c_desc_domain,
-                 cc.vocabulary_id as c_desc_vocab
-                FROM
-                 {schema}.concept_ancestor as ca
-                LEFT JOIN {schema}.concept as c ON (
-                 c.concept_id = ca.ancestor_concept_id
-                ) LEFT JOIN {schema}.concept as cc ON (
-                 cc.concept_id = ca.descendant_concept_id
-                ) WHERE
-                 ca.descendant_concept_id != 0
-                 AND ca.ancestor_concept_id != 0
-                 AND ca.descendant_concept_id IN ( {id_list} )
-            """.format(schema=self.schema, id_list=','.join(sorted(list(new_dict_entries))))
-            result = self._exec(query)
+            missing = self._hierarchy.missing(new_dict_entries)
+            if missing:
+                self._hierarchy.add_ancestor_rows(missing, self.get_ancestors(missing))
+            pending = sorted(new_dict_entries)
             new_dict_entries.clear()
-            for row in result:
-                parent_id = str(row['c_id'])
-                parent_group = row['c_domain']
-                parent_name = row['c_name']
-                parent_vocab = row['c_vocab']
-                parent_code = row['c_num']
-                unmapped = False
-                if parent_code == 0:
-                    parent_code = row['c_orig']
-                    unmapped = True
+            for desc_id in pending:
+                (_, desc_group, desc_vocab, parent_id, dos, parent_name, parent_vocab, parent_code) = self._hierarchy.get(desc_id)
+                if parent_id is None:
+                    continue
                 parent_desc = "{0} ({1} {2})".format(parent_name, parent_vocab, parent_code)
-                self.add_dict(dict, new_dict_entries, parent_group, parent_vocab, parent_id, parent_name, parent_desc, parent_code, unmapped)
-                dos = int(row['c_distance'])
-                desc_id = str(row['c_desc_id'])
-                desc_vocab = row['c_desc_vocab']
-                desc_group = row['c_desc_domain']
-                if desc_group != parent_group:
-                    print("WARNING: intra group inheritance: {0} << {1}".format(parent_group, desc_group), file=sys.stderr)
-                else:
-                    desc_entry = self.get_dict_entry(dict, desc_group, desc_vocab, desc_id)
-                    if desc_entry is not None and parent_id != desc_id and ('dos' not in desc_entry or desc_entry['dos'] > dos):
-                        desc_entry['dos'] = dos
-                        desc_entry['parent'] = str(parent_vocab) + str(parent_id)
-            new_dict_entries.clear()
+                self.add_dict(dict, new_dict_entries, desc_group, parent_vocab, parent_id, parent_name, parent_desc, parent_code, False)
+                desc_entry = self.get_dict_entry(dict, desc_group, desc_vocab, desc_id)
+                if desc_entry is not None and ('dos' not in desc_entry or desc_entry['dos'] > dos):
+                    desc_entry['dos'] = dos
+                    desc_entry['parent'] = str(parent_vocab) + str(parent_id)
 
-    def get_diagnoses(self, pid, obj, dict, new_dict_entries):
+    def _domain_query(self, domain, padded=False, cohort=False, since=False):
         """
-        Retrieve diagnoses for a patient and add them to the object and dictionary.
+        Build the SQL query of a domain from its entry in `domain_queries`.
 
-        :param pid: The person_id of the patient.
-        :param obj: The object to add events to.
-        :param dict: The dictionary to update with new entries.
-        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :param domain: The key of the domain in `domain_queries`.
+        :param padded: Boolean indicating whether to select every column of `row_columns`,
+            filling the ones the domain does not provide with typed NULLs. Padded queries
+            also select the domain key so they can be combined with UNION ALL.
+        :param cohort: Boolean indicating whether to query a list of persons. The persons are
+            bound to `:pids` and the person_id of each row is selected as `person_id`.
+        :param since: Boolean indicating whether to select only the rows whose id is greater
+            than `:since`.
+        :return: The SQL query with the person filter bound to `:pid` (or `:pids`).
         """
+        spec = domain_queries[domain]
+        columns = []
+        if padded:
+            columns.append("'{0}' as domain".format(domain))
+        if cohort:
+            columns.append("o.person_id as person_id")
+        for (name, sql_type) in row_columns:
+            if name in spec["columns"]:
+                columns.append("{0} as {1}".format(spec["columns"][name], name))
+            elif padded:
+                columns.append("CAST(NULL AS {0}) as {1}".format(sql_type, name))
+        where = [ "o.person_id IN :pids" if cohort else "o.person_id = :pid" ] + spec.get("where", [])
+        if since:
+            where.append("{0} > :since".format(spec["columns"]["id_row"]))
+        return """SELECT
+            {columns}
+           FROM
+            {source}
+           WHERE
+            {where}
+        """.format(columns=",\n            ".join(columns), source=spec["from"], where="\n            AND ".join(where))
+
+    def get_concepts(self, concept_ids):
+        """
+        Look up the attributes of concepts in the concept cache. Concepts that are not
+        cached are retrieved from the concept table and added to the cache. The concepts of
+        the vocabularies of the `omop_concept_preload` setting are loaded completely on
+        first use.
+
+        :param concept_ids: Iterable of concept ids.
+        :return: Dict of concept id to the tuple (domain_id, concept_name, vocabulary_id,
+            concept_code) or None if the concept does not exist.
+        """
+        if self._concept_preload and not self._concepts.preloaded:
+            self.preload_concepts()
+        (res, missing) = self._concepts.lookup(concept_ids)
         query = """SELECT
-            o.condition_occurrence_id as id_row,
-            o.condition_start_date as date_start,
-            o.condition_end_date as date_end,
-            o.condition_concept_id as d_id,
-            o.condition_source_value as d_orig,
-            c.domain_id as d_domain,
-            c.concept_name as d_name,
-            c.vocabulary_id as d_vocab,
-            c.concept_code as d_num
+            concept_id,
+            domain_id,
+            concept_name,
+            vocabulary_id,
+            concept_code
            FROM
-            {schema}.condition_occurrence as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.condition_concept_id
-           )
+            {schema}.concept
            WHERE
-            o.person_id = :pid
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['d_num']
-            unmapped = False
-            if code == 0:
-                code = row['d_orig']
-                unmapped = True
-            id_row = 'c' + str(row['id_row'])
-            d_id = row['d_id']
-            name = row['d_name']
-            vocab = row['d_vocab']
-            group = "Condition" if row['d_domain'] is None else row['d_domain']
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            date_start = self.to_time(row['date_start'])
-            date_end = self.to_time(row['date_end']) if row['date_end'] else date_start
-            date_cur = date_start
-            while date_cur <= date_end:
-                event = self.create_event(group, str(vocab) + str(d_id), id_row)
-                event['time'] = date_cur
-                obj['events'].append(event)
-                date_cur = util.nextDay(date_cur)
+            concept_id IN :concept_ids
+        """
+        for ix in range(0, len(missing), self._fetch_size):
+            chunk = missing[ix:ix + self._fetch_size]
+            res.update(self._concepts.add(chunk, self._exec(query, concept_ids=chunk)))
+        return res
 
-    def get_procedures(self, pid, obj, dict, new_dict_entries):
+    def preload_concepts(self):
         """
-        Retrieve procedures for a patient and add them to the object and dictionary.
+        Load all concepts of the vocabularies of the `omop_concept_preload` setting into the
+        concept cache where they are never evicted.
 
-        :param pid: The person_id of the patient.
-        :param obj: The object to add events to.
-        :param dict: The dictionary to update with new entries.
-        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :return: The number of preloaded concepts.
         """
         query = """SELECT
-            o.procedure_occurrence_id as id_row,
-            o.procedure_date as p_date,
-            o.procedure_concept_id as p_id,
-            o.procedure_source_value as p_orig,
-            c.domain_id as p_domain,
-            c.concept_name as p_name,
-            c.vocabulary_id as p_vocab,
-            c.concept_code as p_num
+            concept_id,
+            domain_id,
+            concept_name,
+            vocabulary_id,
+            concept_code
            FROM
-            {schema}.procedure_occurrence as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.procedure_concept_id
-           )
+            {schema}.concept
            WHERE
-            o.person_id = :pid
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['p_num']
-            unmapped = False
-            if code == 0:
-                code = row['p_orig']
-                unmapped = True
-            id_row = 'p' + str(row['id_row'])
-            d_id = row['p_id']
-            name = row['p_name']
-            vocab = row['p_vocab']
-            group = "Procedure" if row['p_domain'] is None else row['p_domain']
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            event = self.create_event(group, str(vocab) + str(d_id), id_row)
-            event['time'] = self.to_time(row['p_date'])
-            # if 'p_cost' in row and row['p_cost']:
-            #     event['cost'] = float(row['p_cost'])
-            obj['events'].append(event)
-
-    def get_observations_concept_valued(self, pid, obj, dict, new_dict_entries):
-        """
-        Retrieve concept-valued observations for a patient and add them to the object and dictionary.
+            vocabulary_id IN :vocabs
+        """
+        count = 0
+        with self.connection():
+            for rows in self._stream(query, vocabs=self._concept_preload):
+                count += self._concepts.preload(rows)
+        self._concepts.preloaded = True
+        return count
+
+    def _resolve_concepts(self, rows):
+        """
+        Add the attributes of the concepts to domain rows: `c_domain`, `c_name`, `c_vocab`
+        and `c_num` of the concept `c_id`, and `v_concept`, the name of the value concept
+        `v_concept_id`. The attributes of concepts that do not exist are None and so is
+        `v_concept_id` then, as if the concept table was joined.
+
+        :param rows: The domain rows.
+        :return: List of the rows as dicts.
+        """
+        rows = [ dict(row) for row in rows ]
+        concept_ids = set()
+        for row in rows:
+            for key in ('c_id', 'v_concept_id'):
+                if row.get(key) is not None:
+                    concept_ids.add(row[key])
+        concepts = self.get_concepts(concept_ids) if concept_ids else {}
+        for row in rows:
+            concept = concepts.get(row.get('c_id')) or (None, None, None, None)
+            (row['c_domain'], row['c_name'], row['c_vocab'], row['c_num']) = concept
+            if 'v_concept_id' in row:
+                value = concepts.get(row['v_concept_id'])
+                row['v_concept'] = value[1] if value is not None else None
+                if value is None:
+                    row['v_concept_id'] = None
+        return rows
+
+    def get_class_ids(self, classes):
+        """
+        Look up the ids of the visit concepts named like the visit classes of the class file.
+
+        :param classes: The names of the classes.
+        :return: List of concept ids.
+        """
+        names = tuple(sorted(classes))
+        res = self._class_ids.get(names)
+        if res is None:
+            query = "SELECT concept_id FROM {schema}.concept WHERE concept_name IN :names"
+            res = self._class_ids[names] = [ row['concept_id'] for row in self._exec(query, names=list(names)) ]
+        return res
+
+    def _concept(self, row, default_group, default_name=None):
+        """
+        Extract the concept attributes shared by all domain rows.
+
+        :param row: The domain row.
+        :param default_group: The group to use if the concept has no domain.
+        :param default_name: The name to use if the concept has no name.
+        :return: A tuple (group, vocab, d_id, name, code, unmapped).
+        """
+        code = row['c_num']
+        unmapped = False
+        if code == 0:
+            code = row['c_orig']
+            unmapped = True
+        name = row['c_name']
+        if name is None and default_name is not None:
+            name = default_name
+        group = default_group if row['c_domain'] is None else row['c_domain']
+        return (group, row['c_vocab'], row['c_id'], name, code, unmapped)
+
+    def add_condition(self, row, obj, dict, new_dict_entries):
+        """
+        Add the interval event of a condition row to the object and dictionary.
+
+        :param row: The condition row.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        """
+        (group, vocab, d_id, name, code, unmapped) = self._concept(row, "Condition")
+        id_row = 'c' + str(row['id_row'])
+        desc = "{0} ({1} {2})".format(name, vocab, code)
+        self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
+        date_start = self.to_time(row['date_start'])
+        date_end = self.to_time(row['date_end']) if row['date_end'] else date_start
+        if date_end < date_start:
+            # rows that end before they start cover no days
+            return
+        event = self.create_event(group, str(vocab) + str(d_id), id_row)
+        event['time'] = date_start
+        if date_end > date_start:
+            event['end'] = date_end
+        obj['events'].append(event)
+
+    def add_procedure(self, row, obj, dict, new_dict_entries):
+        """
+        Add the event of a procedure row to the object and dictionary.
+
+        :param row: The procedure row.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        """
+        (group, vocab, d_id, name, code, unmapped) = self._concept(row, "Procedure")
+        id_row = 'p' + str(row['id_row'])
+        desc = "{0} ({1} {2})".format(name, vocab, code)
+        self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
+        event = self.create_event(group, str(vocab) + str(d_id), id_row)
+        event['time'] = self.to_time(row['date_start'])
+        obj['events'].append(event)
+
+    def _add_observation(self, row, obj, dict, new_dict_entries, flag, value):
+        """
+        Add the event of an observation row to the object and dictionary.
+
+        :param row: The observation row.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :param flag: The result flag of the observation ("C", "S", or "N").
+        :param value: The result value of the observation.
+        """
+        (group, vocab, d_id, name, code, unmapped) = self._concept(row, "Observation", "unknown")
+        id_row = 'p' + str(row['id_row'])
+        desc = "{0} ({1} {2})".format(name, vocab, code)
+        self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
+        event = self.create_event(group, str(vocab) + str(d_id), id_row, True, flag, value)
+        event['time'] = self.to_time(row['date_start'])
+        obj['events'].append(event)
+
+    def add_observation(self, row, obj, dict, new_dict_entries):
+        """
+        Add the events of an observation row to the object and dictionary: one event for
+        each of its concept ("C"), string ("S") and number ("N") values. Call
+        `_order_observations` once all rows are added.
+
+        :param row: The observation row.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        """
+        if row['v_concept_id'] is not None:
+            self._add_observation(row, obj, dict, new_dict_entries, "C", str(row['v_concept']))
+        if row['v_string'] is not None:
+            self._add_observation(row, obj, dict, new_dict_entries, "S", row['v_string'])
+        if row['v_number'] is not None:
+            self._add_observation(row, obj, dict, new_dict_entries, "N", str(row['v_number']))
+
+    def _order_observations(self, events, start=0):
+        """
+        Order the observation events by kind of value (see `observation_flags`). The sort
+        is stable so the events of each kind stay in the order of their rows.
+
+        :param events: The list of events; it is sorted in place.
+        :param start: The index of the first observation event in the list.
+        """
+        events[start:] = sorted(events[start:], key=lambda e: observation_flags[e['flag']])
+
+    def add_drug(self, row, obj, dict, new_dict_entries):
+        """
+        Add the interval event of a drug exposure row to the object and dictionary.
+
+        :param row: The drug exposure row.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        """
+        (group, vocab, d_id, name, code, unmapped) = self._concept(row, "Drug")
+        id_row = 'm' + str(row['id_row'])
+        desc = "{0} ({1} {2})".format(name, vocab, code)
+        self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
+        date_start = self.to_time(row['date_start'])
+        date_end = self.to_time(row['date_end']) if row['date_end'] else date_start
+        if date_end < date_start:
+            # rows that end before they start cover no days
+            return
+        event = self.create_event(group, str(vocab) + str(d_id), id_row)
+        event['time'] = date_start
+        if date_end > date_start:
+            event['end'] = date_end
+        obj['events'].append(event)
+
+    def add_measurement(self, row, obj, dict, new_dict_entries):
+        """
+        Add the event of a measurement row to the object and dictionary.
+
+        :param row: The measurement row.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        """
+        (group, vocab, d_id, name, code, unmapped) = self._concept(row, "Measurement")
+        id_row = 'l' + str(row['id_row'])
+        lab_value = row['v_number']
+        lab_low = row['v_low']
+        lab_high = row['v_high']
+
+        lab_value = float(lab_value) if lab_value is not None and isinstance(lab_value, (int, float, Decimal)) else float('-inf')
+        lab_low = float(lab_low) if lab_low is not None and isinstance(lab_low, (int, float, Decimal)) else float('-inf')
+        lab_high = float(lab_high) if lab_high is not None and isinstance(lab_high, (int, float, Decimal)) else float('inf')
+
+        lab_flag = ""
+        if lab_value is not None and lab_value != float('-inf'):
+            if lab_value <= lab_low:
+                lab_flag = "L"
+            elif lab_value >= lab_high:
+                lab_flag = "H"
+        else:
+            lab_value = "n/a"
+        desc = "{0} ({1} {2})".format(name, vocab, code)
+        self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
+        event = self.create_event(group, str(vocab) + str(d_id), id_row, True, lab_flag, str(lab_value))
+        event['time'] = self.to_time(row['date_start'])
+        obj['events'].append(event)
+
+    def add_visit(self, row, obj):
+        """
+        Add the span of a visit row to the object.
+
+        :param row: The visit row.
+        :param obj: The object to add the span to.
+        """
+        if row['date_start'] is None:
+            return
+        span = {"class": str(row['c_name']), "from": self.to_time(row['date_start'])}
+        if row['date_end'] is not None:
+            span["to"] = self.to_time(row['date_end'])
+        obj["v_spans"].append(span)
+
+    def get_diagnoses(self, pid, obj, dict, new_dict_entries):
+        """
+        Retrieve diagnoses for a patient and add them to the object and dictionary.
 
         :param pid: The person_id of the patient.
         :param obj: The object to add events to.
         :param dict: The dictionary to update with new entries.
         :param new_dict_entries: Set of new dictionary entries to be updated.
         """
-        query = """SELECT
-            o.observation_id as id_row,
-            o.observation_date as o_date,
-            o.observation_concept_id as o_id,
-            o.observation_source_value as o_orig,
-            o.value_as_concept_id as o_val_concept,
-            c_val.concept_name as o_val_concept_name,
-            c.domain_id as o_domain,
-            c.concept_name as o_name,
-            c.vocabulary_id as o_vocab,
-            c.concept_code as o_num
-           FROM
-            {schema}.observation as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.observation_concept_id
-           )
-           INNER JOIN {schema}.concept as c_val ON (
-	        c_val.concept_id = o.value_as_concept_id
-	       )
-           WHERE
-            o.person_id = :pid
-            AND o.value_as_concept_id IS NOT NULL
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['o_num']
-            unmapped = False
-            if code == 0:
-                code = row['o_orig']
-                unmapped = True
-            id_row = 'p' + str(row['id_row'])
-            d_id = row['o_id']
-            name = "unknown" if row['o_name'] is None else row['o_name']
-            vocab = row['o_vocab']
-            group  = "Observation" if row['o_domain'] is None else row['o_domain']
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            event = self.create_event(group, str(vocab) + str(d_id), id_row, True, "C",str(row['o_val_concept_name']))
-            event['time'] = self.to_time(row['o_date'])
-            obj['events'].append(event)
-
-    def get_observations_string_valued(self, pid, obj, dict, new_dict_entries):
-        """
-        Retrieve string-valued observations for a patient and add them to the object and dictionary.
+        for row in self._domain_rows("condition", pid=pid):
+            self.add_condition(row, obj, dict, new_dict_entries)
+
+    def get_procedures(self, pid, obj, dict, new_dict_entries):
+        """
+        Retrieve procedures for a patient and add them to the object and dictionary.
 
         :param pid: The person_id of the patient.
         :param obj: The object to add events to.
         :param dict: The dictionary to update with new entries.
         :param new_dict_entries: Set of new dictionary entries to be updated.
         """
-        query = """SELECT
-            o.observation_id as id_row,
-            o.observation_date as o_date,
-            o.observation_concept_id as o_id,
-            o.observation_source_value as o_orig,
-            o.value_as_string  as o_val_string,
-            c.domain_id as o_domain,
-            c.concept_name as o_name,
-            c.vocabulary_id as o_vocab,
-            c.concept_code as o_num
-           FROM
-            {schema}.observation as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.observation_concept_id
-           )
-           WHERE
-            o.person_id = :pid
-            AND o.value_as_string IS NOT NULL
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['o_num']
-            unmapped = False
-            if code == 0:
-                code = row['o_orig']
-                unmapped = True
-            id_row = 'p' + str(row['id_row'])
-            d_id = row['o_id']
-            name = "unknown" if row['o_name'] is None else row['o_name']
-            vocab = row['o_vocab']
-            group  = "Observation" if row['o_domain'] is None else row['o_domain']
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            event = self.create_event(group, str(vocab) + str(d_id), id_row, True, "S", row['o_val_string'])
-            event['time'] = self.to_time(row['o_date'])
-            obj['events'].append(event)
-
-    def get_observations_number_valued(self, pid, obj, dict, new_dict_entries):
-        """
-        Retrieve number-valued observations for a patient and add them to the object and dictionary.
+        for row in self._domain_rows("procedure", pid=pid):
+            self.add_procedure(row, obj, dict, new_dict_entries)
+
+    def get_observations(self, pid, obj, dict, new_dict_entries):
+        """
+        Retrieve the observations for a patient with a single scan of the observation table
+        and add them to the object and dictionary.
 
         :param pid: The person_id of the patient.
         :param obj: The object to add events to.
         :param dict: The dictionary to update with new entries.
         :param new_dict_entries: Set of new dictionary entries to be updated.
         """
-        query = """SELECT
-            o.observation_id as id_row,
-            o.observation_date as o_date,
-            o.observation_concept_id as o_id,
-            o.observation_source_value as o_orig,
-            o.value_as_number as o_val_number,
-            c.domain_id as o_domain,
-            c.concept_name as o_name,
-            c.vocabulary_id as o_vocab,
-            c.concept_code as o_num
-           FROM
-            {schema}.observation as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.observation_concept_id
-           )
-           WHERE
-            o.person_id = :pid
-            AND o.value_as_number IS NOT NULL
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['o_num']
-            unmapped = False
-            if code == 0:
-                code = row['o_orig']
-                unmapped = True
-            id_row = 'p' + str(row['id_row'])
-            d_id = row['o_id']
-            name = "unknown" if row['o_name'] is None else row['o_name']
-            vocab = row['o_vocab']
-            group  = "Observation" if row['o_domain'] is None else row['o_domain']
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            event = self.create_event(group, str(vocab) + str(d_id), id_row, True, "N",str(row['o_val_number']))
-            event['time'] = self.to_time(row['o_date'])
-            obj['events'].append(event)
+        start = len(obj['events'])
+        for row in self._domain_rows("observation", pid=pid):
+            self.add_observation(row, obj, dict, new_dict_entries)
+        self._order_observations(obj['events'], start)
 
     def get_drugs(self, pid, obj, dict, new_dict_entries):
         """
@@ -595,49 +1055,8 @@ class OMOP:
         :param dict: The dictionary to update with new entries.
         :param new_dict_entries: Set of new dictionary entries to be updated.
         """
-        query = """SELECT
-            o.drug_exposure_id as id_row,
-            o.drug_exposure_start_date as date_start,
-            o.drug_exposure_end_date as date_end,
-            o.drug_concept_id as m_id,
-            o.drug_source_value as m_orig,
-            c.domain_id as m_domain,
-            c.concept_name as m_name,
-            c.vocabulary_id as m_vocab,
-            c.concept_code as m_num
-           FROM
-            {schema}.drug_exposure as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.drug_concept_id
-           )
-           WHERE
-            o.person_id = :pid
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['m_num']
-            unmapped = False
-            if code == 0:
-                code = row['m_orig']
-                unmapped = True
-            id_row = 'm' + str(row['id_row'])
-            d_id = row['m_id']
-            name = row['m_name']
-            vocab = row['m_vocab']
-            group = "Drug" if row['m_domain'] is None else row['m_domain']
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            date_start = self.to_time(row['date_start'])
-            date_end = self.to_time(row['date_end']) if row['date_end'] else date_start
-            date_cur = date_start
-            # cost = row['m_cost'] if 'm_cost' in row else None
-            while date_cur <= date_end:
-                event = self.create_event(group, str(vocab) + str(d_id), id_row)
-                event['time'] = date_cur
-                # if cost:
-                #     event['cost'] = float(cost)
-                #     cost = None
-                obj['events'].append(event)
-                date_cur = util.nextDay(date_cur)
+        for row in self._domain_rows("drug", pid=pid):
+            self.add_drug(row, obj, dict, new_dict_entries)
 
     def get_measurements(self, pid, obj, dict, new_dict_entries):
         """
@@ -648,63 +1067,8 @@ class OMOP:
         :param dict: The dictionary to update with new entries.
         :param new_dict_entries: Set of new dictionary entries to be updated.
         """
-        query = """SELECT
-            o.measurement_id as id_row,
-            o.measurement_date as m_date,
-            o.measurement_concept_id as m_id,
-            o.measurement_source_value as m_orig,
-            o.value_source_value as m_orig_value,
-            o.value_as_number as m_value,
-            o.range_low as m_low,
-            o.range_high as m_high,
-            c.domain_id as m_domain,
-            c.concept_name as m_name,
-            c.vocabulary_id as m_vocab,
-            c.concept_code as m_num
-           FROM
-            {schema}.measurement as o
-           LEFT JOIN {schema}.concept as c ON (
-            c.concept_id = o.measurement_concept_id
-           )
-           WHERE
-            o.person_id = :pid
-        """
-        for row in self._exec(query, pid=pid):
-            code = row['m_num']
-            unmapped = False
-            if code == 0:
-                code = row['m_orig']
-                unmapped = True
-            id_row = 'l' + str(row['id_row'])
-            d_id = row['m_id']
-            name = row['m_name']
-            vocab = row['m_vocab']
-            group = "Measurement" if row['m_domain'] is None else row['m_domain']
-            lab_value = row['m_value']
-            lab_low = row['m_low']
-            lab_high = row['m_high']
-
-            #print(f"Processing row: {row}")
-            #print(f"Initial lab_value: {lab_value}, lab_low: {lab_low}, lab_high: {lab_high}")
-            lab_value = float(lab_value) if lab_value is not None and isinstance(lab_value, (int, float, Decimal)) else float('-inf')
-            lab_low = float(lab_low) if lab_low is not None and isinstance(lab_low, (int, float, Decimal)) else float('-inf')
-            lab_high = float(lab_high) if lab_high is not None and isinstance(lab_high, (int, float, Decimal)) else float('inf')
-            #print(f"Converted lab_value: {lab_value}, lab_low: {lab_low}, lab_high: {lab_high}")
-
-            lab_flag = ""
-            if lab_value is not None and lab_value != float('-inf'):
-                if lab_value <= lab_low:
-                    lab_flag = "L"
-                elif lab_value >= lab_high:
-                    lab_flag = "H"
-            else:
-                lab_value = "n/a"
-            #print(f"Final lab_value: {lab_value}, lab_flag: {lab_flag}")
-            desc = "{0} ({1} {2})".format(name, vocab, code)
-            self.add_dict(dict, new_dict_entries, group, vocab, d_id, name, desc, code, unmapped)
-            event = self.create_event(group, str(vocab) + str(d_id), id_row, True, lab_flag, str(lab_value))
-            event['time'] = self.to_time(row['m_date'])
-            obj['events'].append(event)
+        for row in self._domain_rows("measurement", pid=pid):
+            self.add_measurement(row, obj, dict, new_dict_entries)
 
     def get_visits(self, pid, obj):
         """
@@ -713,37 +1077,218 @@ class OMOP:
         :param pid: The person_id of the patient.
         :param obj: The object to add events to.
         """
-
         classes = obj["classes"]
-        if not classes:
+        class_ids = self.get_class_ids(classes.keys()) if classes else []
+        if not class_ids:
             return
-        query = f"""
-            SELECT v.visit_start_date as date_start, v.visit_end_date as date_end, c.concept_name as c_name
-            FROM {self.schema}.visit_occurrence as v
-            LEFT JOIN {self.schema}.concept as c ON (v.visit_concept_id = c.concept_id)
-            WHERE v.person_id = :pid AND c.concept_name IN ({','.join([f"'{k}'" for k in classes.keys()])})
-        """
-        v_spans = obj["v_spans"]
-        for row in self._exec(query, pid=pid):
-            visit_name = str(row['c_name'])
-            date_start_dt = self.to_time(row['date_start'])
-            date_end_dt = self.to_time(row['date_end'])
-
-            if date_start_dt is None:
-                continue
-            
-            v_spans.append({"class": visit_name, "from": self.format_time(date_start_dt), "to": self.format_time(date_end_dt)})
-    
-    def get_patient(self, pid, dictionary, line_file, class_file, group=None):
+        for row in self._domain_rows("visit", pid=pid, class_ids=class_ids):
+            self.add_visit(row, obj)
+
+    def get_domains_batched(self, pid, obj, dict, new_dict_entries, domains, watermarks=None):
         """
-        Retrieve and assemble a patient's data into a structured object.
+        Retrieve the info, visits and the given domains of a patient in a single round trip.
+        All domain queries are combined with UNION ALL into one statement with the unified
+        row shape of `row_columns`. The rows are then handed to the same row handlers that
+        the per-domain getters use, domain by domain in the order of `domains`.
 
         :param pid: The person_id of the patient.
-        :param dictionary: The dictionary to update with new entries.
+        :param obj: The object to add information and events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :param domains: The keys of the domains to retrieve, in emitting order.
+        :param watermarks: Optional dict that is filled with the highest row id of each
+            domain (see `_get_domains`).
+        """
+        classes = obj["classes"]
+        args = { "pid": str(pid) }
+        queries = [ "person" ] + list(domains)
+        class_ids = self.get_class_ids(classes.keys()) if classes else []
+        if class_ids:
+            queries.append("visit")
+            args["class_ids"] = class_ids
+        query = "\n           UNION ALL\n".join(self._domain_query(d, padded=True) for d in queries)
+        rows = {}
+        for row in self._resolve_concepts(self._exec(query, **args)):
+            rows.setdefault(row['domain'], []).append(row)
+        person = rows.get("person", [])
+        if not person:
+            raise ValueError(f"expected one result row got 0\n{query}\n")
+        self.add_person(person[0], obj)
+        self.add_info(obj, "pid", "Patient", pid)
+        for domain in domains:
+            handler = getattr(self, domain_handlers[domain])
+            start = len(obj['events'])
+            for row in rows.get(domain, []):
+                handler(row, obj, dict, new_dict_entries)
+                if watermarks is not None:
+                    self._update_watermark(watermarks, domain, row)
+            self._finish_domain(domain, obj['events'], start)
+        for row in rows.get("visit", []):
+            self.add_visit(row, obj)
+
+    def get_domains_parallel(self, pid, obj, dict, new_dict_entries, domains, watermarks=None):
+        """
+        Retrieve the info, visits and the given domains of a patient with concurrent queries,
+        each on a pooled connection of its own (at most `omop_parallel_workers` at a time
+        across all callers). Callers should not hold a connection scope meanwhile as its
+        connection would be idle while the queries wait for connections of the pool.
+        The rows of every query are collected and handed to the row handlers once all
+        queries are done, domain by domain in the order of `domains`, so the patient and
+        the dictionary are the same as when the domains are retrieved one after another.
+
+        :param pid: The person_id of the patient.
+        :param obj: The object to add information and events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :param domains: The keys of the domains to retrieve, in emitting order.
+        :param watermarks: Optional dict of domain to the highest row id retrieved so far
+            (see `_get_domains`). It is updated with the rows retrieved now.
+        """
+        classes = obj["classes"]
+        class_ids = self.get_class_ids(classes.keys()) if classes else []
+        queries = self.patient_queries(pid, domains, class_ids, watermarks)
+        futures = [ (domain, self.executor.submit(self.fetch_domain, domain, args)) for (domain, args) in queries ]
+        rows = { domain: future.result() for (domain, future) in futures }
+        self.add_domains(pid, obj, dict, new_dict_entries, domains, rows, watermarks)
+
+    def patient_queries(self, pid, domains, class_ids, watermarks=None):
+        """
+        List the queries of a patient that `get_domains_parallel` runs concurrently.
+
+        :param pid: The person_id of the patient.
+        :param domains: The keys of the domains to retrieve.
+        :param class_ids: The ids of the visit concepts (see `get_class_ids`).
+        :param watermarks: Optional dict of domain to the highest row id retrieved so far.
+        :return: List of tuples (domain, arguments of `fetch_domain`).
+        """
+        queries = [ ("person", { "pid": str(pid) }) ]
+        for domain in domains:
+            args = { "pid": pid }
+            if watermarks is not None and domain in watermarks:
+                args["since"] = watermarks[domain]
+            queries.append((domain, args))
+        if class_ids:
+            queries.append(("visit", { "pid": pid, "class_ids": class_ids }))
+        return queries
+
+    def add_domains(self, pid, obj, dict, new_dict_entries, domains, rows, watermarks=None):
+        """
+        Add the rows retrieved for the queries of `patient_queries` to the object and
+        dictionary, domain by domain in the order of `domains`.
+
+        :param pid: The person_id of the patient.
+        :param obj: The object to add information and events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :param domains: The keys of the domains, in emitting order.
+        :param rows: Dict of domain to its list of rows.
+        :param watermarks: Optional dict of domain to the highest row id retrieved so far.
+            It is updated with the rows.
+        """
+        person = rows["person"]
+        if not person:
+            raise ValueError(f"expected one result row got 0\n{self._domain_query('person')}\n")
+        self.add_person(person[0], obj)
+        self.add_info(obj, "pid", "Patient", pid)
+        for domain in domains:
+            handler = getattr(self, domain_handlers[domain])
+            start = len(obj['events'])
+            for row in rows[domain]:
+                handler(row, obj, dict, new_dict_entries)
+                if watermarks is not None:
+                    self._update_watermark(watermarks, domain, row)
+            self._finish_domain(domain, obj['events'], start)
+        for row in rows.get("visit", []):
+            self.add_visit(row, obj)
+
+    def fetch_domain(self, domain, args):
+        """
+        Retrieve all rows of a domain on a connection of the current thread.
+
+        :param domain: The key of the domain in `domain_queries`.
+        :param args: Arguments to bind to the query (see `_stream_domain`).
+        :return: List of rows.
+        """
+        with self.connection():
+            rows = []
+            for batch in self._stream_domain(domain, **args):
+                rows.extend(batch)
+            return rows
+
+    def _update_watermark(self, watermarks, domain, row):
+        """
+        Raise the watermark of a domain to the id of a row.
+
+        :param watermarks: Dict of domain to the highest row id retrieved so far.
+        :param domain: The key of the domain.
+        :param row: The domain row.
+        """
+        if row['id_row'] is not None and (domain not in watermarks or row['id_row'] > watermarks[domain]):
+            watermarks[domain] = int(row['id_row'])
+
+    def _get_domains(self, pid, obj, dict, new_dict_entries, domains, watermarks):
+        """
+        Retrieve the given domains of a patient one by one and record the highest row id of
+        each domain. Of domains that have a watermark only the rows above it are retrieved.
+
+        :param pid: The person_id of the patient.
+        :param obj: The object to add events to.
+        :param dict: The dictionary to update with new entries.
+        :param new_dict_entries: Set of new dictionary entries to be updated.
+        :param domains: The keys of the domains to retrieve, in emitting order.
+        :param watermarks: Dict of domain to the highest row id retrieved so far. It is
+            updated with the rows retrieved now.
+        """
+        for domain in domains:
+            handler = getattr(self, domain_handlers[domain])
+            args = { "pid": pid }
+            if domain in watermarks:
+                args["since"] = watermarks[domain]
+            start = len(obj['events'])
+            for row in self._domain_rows(domain, **args):
+                handler(row, obj, dict, new_dict_entries)
+                self._update_watermark(watermarks, domain, row)
+            self._finish_domain(domain, obj['events'], start)
+
+    def _finish_domain(self, domain, events, start):
+        """
+        Bring the events of a domain into their final order once all its rows are added.
+
+        :param domain: The key of the domain.
+        :param events: The list of events of the patient.
+        :param start: The index of the first event of the domain.
+        """
+        if domain == "observation":
+            self._order_observations(events, start)
+
+    def expand_intervals(self, events):
+        """
+        Expand interval events, i.e., events with an 'end' time, into one event per day.
+
+        :param events: The list of events.
+        :return: The list of events without interval events.
+        """
+        res = []
+        for e in events:
+            end = e.pop('end', None)
+            if end is None:
+                res.append(e)
+                continue
+            date_cur = e['time']
+            while date_cur <= end:
+                event = e.copy()
+                event['time'] = date_cur
+                res.append(event)
+                date_cur = util.nextDay(date_cur)
+        return res
+
+    def _create_patient(self, line_file, class_file):
+        """
+        Create an empty patient object.
+
         :param line_file: Path to a line file for additional data (used by util.add_files).
         :param class_file: Path to a class file for additional data (used by util.add_files).
-        :param group: The specific group of data to retrieve. If None, all groups are retrieved.
-        :return: A structured object containing the patient's data.
+        :return: The patient object without information and events.
         """
         obj = {
             "info": [],
@@ -753,135 +1298,303 @@ class OMOP:
             "v_spans": [],
             "classes": {}
         }
-        new_dict_entries = set()
         util.add_files(obj, line_file, class_file)
-        self.get_info(pid, obj)
-        self.add_info(obj, "pid", "Patient", pid)
+        return obj
+
+    def _finish_patient(self, pid, obj, intervals):
+        """
+        Compute the time range and the event count of a patient whose events are complete.
+
+        :param pid: The person_id of the patient.
+        :param obj: The patient object.
+        :param intervals: Boolean indicating whether to keep interval events instead of
+            expanding them into one event per day.
+        """
+        if not intervals:
+            obj["events"] = self.expand_intervals(obj["events"])
+        stats = [ float('inf'), float('-inf'), 0 ]
+        self._count_events(obj["events"], stats)
+        self._set_time_range(pid, obj, stats)
+
+    def _count_events(self, events, stats):
+        """
+        Update the time range and the event count of a patient with some of its events.
 
-         # Depending on the group, retrieve specific types of data for the patient
-        if group is None or group == "Condition":
-            self.get_diagnoses(pid, obj, dictionary, new_dict_entries)
-        if group is None or group == "Observation":
-            self.get_observations_concept_valued(pid, obj, dictionary, new_dict_entries)
-            self.get_observations_string_valued(pid, obj, dictionary, new_dict_entries)
-            self.get_observations_number_valued(pid, obj, dictionary, new_dict_entries)
-        if group is None or group == "Procedure":
-            self.get_procedures(pid, obj, dictionary, new_dict_entries)
-        if group is None or group == "Drug":
-            self.get_drugs(pid, obj, dictionary, new_dict_entries)
-        if group is None or group == "Measurement":
-            self.get_measurements(pid, obj, dictionary, new_dict_entries)
-
-        self.get_visits(pid, obj)
-
-        min_time = float('inf') # Start with infinity to find the minimum time
-        max_time = float('-inf') # Start with negative infinity to find the maximum time
-        for e in obj["events"]:
+        :param events: The events.
+        :param stats: The list [min_time, max_time, event_count] to update. Start with
+            [inf, -inf, 0] to find the minimum and maximum time.
+        """
+        for e in events:
             time = e["time"]
-            if time < min_time:
-                min_time = time # Update min_time if a smaller time is found
-            if time > max_time:
-                max_time = time # Update max_time if a larger time is found
+            end = e.get("end", time)
+            if time < stats[0]:
+                stats[0] = time # Update min_time if a smaller time is found
+            if end > stats[1]:
+                stats[1] = end # Update max_time if a larger time is found
+            stats[2] += util.count_days(time, end) # Interval events count once per day
+
+    def _set_time_range(self, pid, obj, stats):
+        """
+        Set the time range and the event count of a patient.
+
+        :param pid: The person_id of the patient.
+        :param obj: The patient object.
+        :param stats: The list [min_time, max_time, event_count] of all events of the patient.
+        """
+        (min_time, max_time, event_count) = stats
         obj["start"] = min_time if min_time != float('inf') else 0
         obj["end"] = max_time if max_time != float('-inf') else 0
         logger.debug(f"Patient {pid} time range: {obj['start']} - {obj['end']}")
-        self.add_info(obj, "event_count", "Events", len(obj["events"]))
-        self.update_hierarchies(dictionary, new_dict_entries)
-        return obj
-    
+        self.add_info(obj, "event_count", "Events", event_count)
 
-# For generating the json files
-# Uncomment and adjust the following functions if needed to generate patient files
-    
-# def generate_patient_files(batch_size=10):
-#     """
-#     Generate JSON files for patients in batches.
-    
-#     :param batch_size: Number of patients to process in each batch.
-#     """
-    # settings = {
-    #     'omop_user': 'etl_viz',
-    #     'omop_passwd': 'prem123',
-    #     'omop_host': 'localhost',
-    #     'omop_port': '5432',
-    #     'omop_db': 'synthea10',
-    #     'omop_schema': 'cdm_synthea10',
-    #     'omop_engine': 'postgresql',
-    #     'omop_use_alt_hierarchies': True,
-    #     'use_cache': True,
-    #     'ccs_diag': 'path/to/ccs_diag/file',
-    #     'ccs_proc': 'path/to/ccs_proc/file',
-    # }
-#     settings = {
-#         'omop_user': 'patien_viz_user',
-#         'omop_passwd': 's0382292',
-#         'omop_host': 'localhost',
-#         'omop_port': '5432',
-#         'omop_db': 'omop',
-#         'omop_schema': 'omop_schema',
-#         'omop_engine': 'postgresql',
-#         'omop_use_alt_hierarchies': True,
-#         'use_cache': True,
-#         'ccs_diag': 'path/to/ccs_diag/file',
-#         'ccs_proc': 'path/to/ccs_proc/file',
-#         }
-
-#     omop = OMOP(settings, True)
-#     patients = set()
-#     if os.path.isfile('patients.txt'):
-#         with open('patients.txt', 'r') as pf:
-#             patients = set(pf.read().splitlines())
-
-#     omop.list_patients(patients, prefix="json/")
-#     save_patients(patients)
-#     use_cache = settings.get('use_cache', True)
-
-#     dictionary = {}
-#     if os.path.isfile('json/dictionary.json'):
-#         with open('json/dictionary.json', 'r') as df:
-#             dictionary = json.load(df)
-
-#     # Ensure the 'json' directory exists
-#     if not os.path.exists('json'):
-#         os.makedirs('json')
-
-#     patient_list = list(patients)
-#     total_patients = len(patient_list)
-
-#     def process_patient(patient):
-#         pid = patient.split('/')[-1].replace('.json', '')
-#         cache_file = os.path.join('json', f"{pid}.json")
-        
-#         if not os.path.isfile(cache_file) or not use_cache:
-#             patient_data = omop.get_patient(pid, dictionary, None, None)
-#             with open(cache_file, 'w') as cf:
-#                 json.dump(patient_data, cf)
-        
-#         return dictionary
-
-#     with ThreadPoolExecutor(max_workers=4) as executor:
-#         future_to_patient = {executor.submit(process_patient, patient): patient for patient in patient_list}
-#         for future in as_completed(future_to_patient):
-#             patient = future_to_patient[future]
-#             try:
-#                 result = future.result()
-#                 dictionary.update(result)
-#             except Exception as exc:
-#                 print(f'{patient} generated an exception: {exc}')
-
-#     with open('json/dictionary.json', 'w') as df:
-#         json.dump(dictionary, df)
-
-# def save_patients(patients):
-#     """
-#     Save the list of patients to a file.
-
-#     :param patients: Set of patient IDs.
-#     """
-#     with open('patients.txt', 'w') as pf:
-#         pf.write('\n'.join(sorted(list(patients))))
-#         pf.flush()
-
-# if __name__ == '__main__':
-#     generate_patient_files(batch_size=10)
+    def get_patient(self, pid, dictionary, line_file, class_file, group=None, batched=None, intervals=False, columnar=False, watermarks=None, parallel=None):
+        """
+        Retrieve and assemble a patient's data into a structured object.
+
+        :param pid: The person_id of the patient.
+        :param dictionary: The dictionary to update with new entries.
+        :param line_file: Path to a line file for additional data (used by util.add_files).
+        :param class_file: Path to a class file for additional data (used by util.add_files).
+        :param group: The specific group of data to retrieve. If None, all groups are retrieved.
+        :param batched: Boolean indicating whether to retrieve all domains in a single round trip.
+            If None, the `omop_batched` setting is used.
+        :param intervals: Boolean indicating whether multi-day conditions and drug exposures are
+            returned as a single event with an 'end' time instead of one event per day.
+        :param columnar: Boolean indicating whether to return the events as parallel arrays
+            (see util.columnar_events) instead of a list of event objects.
+        :param watermarks: Optional dict that is filled with the highest row id of each
+            domain for `update_patient`.
+        :param parallel: Boolean indicating whether to run the queries concurrently (see
+            `get_domains_parallel`). It takes precedence over `batched`. If None, the
+            `omop_parallel` setting is used.
+        :return: A structured object containing the patient's data.
+        """
+        if parallel is None:
+            parallel = self._parallel
+        # parallel queries run on connections of their own; one held here would sit idle
+        with nullcontext() if parallel else self.connection():
+            obj = self._create_patient(line_file, class_file)
+            new_dict_entries = set()
+            if batched is None:
+                batched = self._batched
+            domains = [ d for (g, ds) in group_domains if group is None or group == g for d in ds ]
+
+            if parallel:
+                self.get_domains_parallel(pid, obj, dictionary, new_dict_entries, domains, watermarks)
+            elif batched:
+                self.get_domains_batched(pid, obj, dictionary, new_dict_entries, domains, watermarks)
+            elif watermarks is not None:
+                self.get_info(pid, obj)
+                self.add_info(obj, "pid", "Patient", pid)
+                self._get_domains(pid, obj, dictionary, new_dict_entries, domains, watermarks)
+                self.get_visits(pid, obj)
+            else:
+                self.get_info(pid, obj)
+                self.add_info(obj, "pid", "Patient", pid)
+
+                 # Depending on the group, retrieve specific types of data for the patient
+                if group is None or group == "Condition":
+                    self.get_diagnoses(pid, obj, dictionary, new_dict_entries)
+                if group is None or group == "Observation":
+                    self.get_observations(pid, obj, dictionary, new_dict_entries)
+                if group is None or group == "Procedure":
+                    self.get_procedures(pid, obj, dictionary, new_dict_entries)
+                if group is None or group == "Drug":
+                    self.get_drugs(pid, obj, dictionary, new_dict_entries)
+                if group is None or group == "Measurement":
+                    self.get_measurements(pid, obj, dictionary, new_dict_entries)
+
+                self.get_visits(pid, obj)
+
+            self._finish_patient(pid, obj, intervals)
+            if columnar:
+                obj["events"] = util.columnar_events(obj["events"])
+            self.update_hierarchies(dictionary, new_dict_entries)
+            return obj
+
+    def update_patient(self, pid, patient, dictionary, watermarks, group=None, intervals=False):
+        """
+        Add the rows that were added to the domain tables since a patient was retrieved by
+        `get_patient` with `watermarks`. Only rows with ids above the watermarks are
+        retrieved. Their events are appended to the events of the patient and the time
+        range, the event count, the demographic information and the visits are computed
+        again. Rows that were changed or deleted in the meantime are not noticed.
+
+        :param pid: The person_id of the patient.
+        :param patient: The patient object to update. Its events must be a list of events.
+        :param dictionary: The dictionary to update with new entries.
+        :param watermarks: The watermarks filled by `get_patient`. They are updated to the
+            highest row ids retrieved now.
+        :param group: The group the patient was retrieved with.
+        :param intervals: Boolean indicating whether the patient was retrieved with interval
+            events.
+        :return: The number of new events.
+        """
+        with nullcontext() if self._parallel else self.connection():
+            obj = {
+                "info": [],
+                "events": [],
+                "v_spans": [],
+                "classes": patient["classes"]
+            }
+            new_dict_entries = set()
+            domains = [ d for (g, ds) in group_domains if group is None or group == g for d in ds ]
+            if self._parallel:
+                self.get_domains_parallel(pid, obj, dictionary, new_dict_entries, domains, watermarks)
+            else:
+                self.get_info(pid, obj)
+                self.add_info(obj, "pid", "Patient", pid)
+                self._get_domains(pid, obj, dictionary, new_dict_entries, domains, watermarks)
+                self.get_visits(pid, obj)
+            count = self._add_update(pid, patient, obj, intervals)
+            self.update_hierarchies(dictionary, new_dict_entries)
+            return count
+
+    def _add_update(self, pid, patient, obj, intervals):
+        """
+        Add the events of the new rows of a patient to the patient (see `update_patient`).
+
+        :param pid: The person_id of the patient.
+        :param patient: The patient object to update.
+        :param obj: The object with the information, visits and events of the new rows.
+        :param intervals: Boolean indicating whether the patient has interval events.
+        :return: The number of new events.
+        """
+        events = obj["events"] if intervals else self.expand_intervals(obj["events"])
+        patient["info"] = obj["info"]
+        patient["v_spans"] = obj["v_spans"]
+        patient["events"].extend(events)
+        stats = [ float('inf'), float('-inf'), 0 ]
+        self._count_events(patient["events"], stats)
+        self._set_time_range(pid, patient, stats)
+        return len(events)
+
+    def iter_patient(self, pid, dictionary, line_file, class_file, group=None, intervals=False, chunk_size=None):
+        """
+        Retrieve a patient's data like `get_patient` but hand out the events in chunks as
+        the rows of the domains are processed, so a patient can be sent without keeping all
+        of its events in memory. The events and their order are the same as in `get_patient`.
+        The dictionary is updated while iterating, so callers that share a dictionary
+        should iterate into a copy of it (see dictionary_store.DictionarySnapshot).
+
+        :param pid: The person_id of the patient.
+        :param dictionary: The dictionary to update with new entries.
+        :param line_file: Path to a line file for additional data (used by util.add_files).
+        :param class_file: Path to a class file for additional data (used by util.add_files).
+        :param group: The specific group of data to retrieve. If None, all groups are retrieved.
+        :param intervals: Boolean indicating whether multi-day conditions and drug exposures are
+            returned as a single event with an 'end' time instead of one event per day.
+        :param chunk_size: The number of rows processed per chunk of events. If None, the
+            `omop_fetch_size` setting is used.
+        :return: A generator of tuples ("events", list of events), one per chunk, followed by
+            the tuple ("patient", patient object) whose 'events' list is empty.
+        """
+        with self.connection():
+            obj = self._create_patient(line_file, class_file)
+            new_dict_entries = set()
+            self.get_info(pid, obj)
+            self.add_info(obj, "pid", "Patient", pid)
+            stats = [ float('inf'), float('-inf'), 0 ]
+            for (g, domains) in group_domains:
+                if group is not None and group != g:
+                    continue
+                for domain in domains:
+                    handler = getattr(self, domain_handlers[domain])
+                    deferred = []
+                    for rows in self._stream_domain(domain, batch_size=chunk_size, pid=pid):
+                        for row in rows:
+                            handler(row, obj, dictionary, new_dict_entries)
+                        events = obj["events"]
+                        obj["events"] = []
+                        if domain == "observation":
+                            # only concept-valued observations can be sent before all rows
+                            # are seen (see _order_observations)
+                            deferred.extend(e for e in events if e['flag'] != "C")
+                            events = [ e for e in events if e['flag'] == "C" ]
+                        yield ("events", self._chunk_events(events, intervals, stats))
+                    if deferred:
+                        self._order_observations(deferred)
+                        yield ("events", self._chunk_events(deferred, intervals, stats))
+            self.get_visits(pid, obj)
+            self._set_time_range(pid, obj, stats)
+            self.update_hierarchies(dictionary, new_dict_entries)
+            yield ("patient", obj)
+
+    def _chunk_events(self, events, intervals, stats):
+        """
+        Prepare a chunk of events of `iter_patient`.
+
+        :param events: The events of the chunk.
+        :param intervals: Boolean indicating whether to keep interval events.
+        :param stats: The list [min_time, max_time, event_count] to update.
+        :return: The events of the chunk.
+        """
+        if not intervals:
+            events = self.expand_intervals(events)
+        self._count_events(events, stats)
+        return events
+
+    def get_patients(self, pids, dictionary, line_file, class_file, group=None, intervals=False):
+        """
+        Retrieve and assemble the data of a cohort of patients. Each domain table is queried
+        once for the whole cohort (`o.person_id IN :pids`) and the rows are partitioned by
+        person, so a cohort takes a fixed number of queries instead of a number per patient.
+        The patient objects are the same as the ones returned by `get_patient`. Large cohorts
+        should be retrieved in batches of a few hundred patients.
+
+        :param pids: Iterable of the person_ids of the cohort, e.g., a list or a range.
+        :param dictionary: The dictionary to update with new entries.
+        :param line_file: Path to a line file for additional data (used by util.add_files).
+        :param class_file: Path to a class file for additional data (used by util.add_files).
+        :param group: The specific group of data to retrieve. If None, all groups are retrieved.
+        :param intervals: Boolean indicating whether multi-day conditions and drug exposures are
+            returned as a single event with an 'end' time instead of one event per day.
+        :return: Dict of person_id (as string) to patient object in the order of `pids`.
+            Person_ids without a person row are omitted.
+        """
+        pids = list(dict.fromkeys(str(pid) for pid in pids))
+        if not pids:
+            return {}
+        with self.connection():
+            objs = {}
+            new_dict_entries = set()
+            for row in self._resolve_concepts(self._exec(self._domain_query("person", cohort=True), pids=pids)):
+                pid = str(row['person_id'])
+                obj = self._create_patient(line_file, class_file)
+                self.add_person(row, obj)
+                self.add_info(obj, "pid", "Patient", pid)
+                objs[pid] = obj
+            if not objs:
+                return {}
+
+            for (g, domains) in group_domains:
+                if group is not None and group != g:
+                    continue
+                for domain in domains:
+                    handler = getattr(self, domain_handlers[domain])
+                    starts = dict((pid, len(obj['events'])) for (pid, obj) in objs.items())
+                    for row in self._domain_rows(domain, pids=pids):
+                        obj = objs.get(str(row['person_id']))
+                        if obj is not None:
+                            handler(row, obj, dictionary, new_dict_entries)
+                    for (pid, obj) in objs.items():
+                        self._finish_domain(domain, obj['events'], starts[pid])
+
+            # all patients share the classes of the class file
+            classes = next(iter(objs.values()))["classes"]
+            class_ids = self.get_class_ids(classes.keys()) if classes else []
+            if class_ids:
+                for row in self._domain_rows("visit", pids=pids, class_ids=class_ids):
+                    obj = objs.get(str(row['person_id']))
+                    if obj is not None:
+                        self.add_visit(row, obj)
 
+            res = {}
+            for pid in pids:
+                obj = objs.get(pid)
+                if obj is None:
+                    continue
+                self._finish_patient(pid, obj, intervals)
+                res[pid] = obj
+            self.update_hierarchies(dictionary, new_dict_entries)
+            return res
@@ -0,0 +1,208 @@
+from __future__ import print_function
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dictionary_store import slice_dictionary
+
+
+def retrieve_patient(omop, store, cache, pid, group, entry=None, snapshot=None):
+    """
+    Retrieve a patient with interval events and the dictionary entries it refers to from
+    the database and store it in the patient cache. If a cache entry of the current
+    dictionary version is given only the rows added since are retrieved. The patient is
+    extracted into a snapshot of the dictionary, so the lock of the store is only held
+    while the new entries are merged.
+
+    :param omop: The OMOP instance.
+    :param store: The DictionaryStore.
+    :param cache: The PatientCache or None.
+    :param pid: The person_id.
+    :param group: The group or None for all groups.
+    :param entry: Optional cache entry of the patient as returned by `PatientCache.load`.
+    :param snapshot: Optional DictionarySnapshot of the store to extract into, e.g., one
+        that is reused for several patients. If None, a snapshot is taken.
+    :return: The patient object including its dictionary slice.
+    """
+    if snapshot is None:
+        snapshot = store.snapshot()
+    (patient, watermarks) = cached_patient(entry, snapshot)
+    if patient is not None:
+        omop.update_patient(pid, patient, snapshot.dictionary, watermarks, group, intervals=True)
+    else:
+        patient = omop.get_patient(pid, snapshot.dictionary, None, None, group, intervals=True, watermarks=watermarks)
+    return store_patient(cache, pid, group, patient, snapshot, watermarks)
+
+
+def cached_patient(entry, snapshot):
+    """
+    Determine whether a cache entry can be updated incrementally (see `retrieve_patient`).
+
+    :param entry: The cache entry of the patient or None.
+    :param snapshot: The DictionarySnapshot the patient is extracted into.
+    :return: A tuple (patient, watermarks) with the cached patient and its watermarks if
+        the entry has watermarks and the version of the snapshot, or else None and empty
+        watermarks to be filled by the extraction.
+    """
+    if entry is not None and entry.get("watermarks") is not None and entry.get("version") == snapshot.version:
+        return (entry["patient"], entry["watermarks"])
+    return (None, {})
+
+
+def store_patient(cache, pid, group, patient, snapshot, watermarks):
+    """
+    Merge the dictionary entries a patient was extracted with into the store, add the
+    entries the patient refers to to it, and store it in the patient cache (see
+    `retrieve_patient`).
+
+    :param cache: The PatientCache or None.
+    :param pid: The person_id.
+    :param group: The group or None for all groups.
+    :param patient: The patient object.
+    :param snapshot: The DictionarySnapshot the patient was extracted into.
+    :param watermarks: The watermarks of the patient.
+    :return: The patient object including its dictionary slice.
+    """
+    # Only the entries added by this patient are merged and written to disk
+    snapshot.merge()
+
+    # Include only the dictionary entries the patient refers to
+    patient["dictionary"] = slice_dictionary(snapshot.dictionary, patient)
+    if cache is not None:
+        cache.put(pid, group, patient, snapshot.version, watermarks)
+    return patient
+
+
+class PatientCache:
+    def __init__(self, directory, ttl, refresh, workers=1):
+        """
+        Persistent cache of patient objects with one JSON file per patient and group, so
+        patients survive restarts and are shared between processes. Entries older than
+        `ttl` seconds are still served but refreshed in the background
+        (stale-while-revalidate). Each entry records the version of the dictionary it was
+        created with; entries of other versions are never served.
+
+        :param directory: The directory of the files, e.g., json/patients.
+        :param ttl: The age in seconds after which entries are refreshed.
+        :param refresh: Function (pid, group) that retrieves a patient again (or only its
+            changes, see `load`) and stores it with `put`. It is called by the background
+            workers.
+        :param workers: The number of background workers.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self._refresh = refresh
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = set()
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, pid, group):
+        """
+        Compute the file of an entry.
+
+        :param pid: The person_id.
+        :param group: The group or None for all groups.
+        :return: The path of the file or None if the person_id or group cannot be used
+            as file name.
+        """
+        name = str(pid) if group is None else "{0}.{1}".format(pid, group)
+        if not all(part.isalnum() for part in name.split(".")):
+            return None
+        return os.path.join(self.directory, name + ".json")
+
+    def load(self, pid, group):
+        """
+        Read an entry regardless of its age and version.
+
+        :param pid: The person_id.
+        :param group: The group or None for all groups.
+        :return: The entry with the keys "version", "created", "watermarks" and "patient"
+            or None if there is no entry.
+        """
+        path = self.path(pid, group)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            print("ignoring invalid patient cache file {0}: {1}".format(path, e), file=sys.stderr)
+            return None
+
+    def get(self, pid, group, version):
+        """
+        Look up a patient. Stale entries are returned as well and scheduled for a refresh.
+
+        :param pid: The person_id.
+        :param group: The group or None for all groups.
+        :param version: The current version of the dictionary.
+        :return: The patient object or None if there is no entry of the given version.
+        """
+        entry = self.load(pid, group)
+        if entry is None or entry.get("version") != version:
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            self.schedule(pid, group)
+        return entry["patient"]
+
+    def is_fresh(self, pid, group, version):
+        """
+        Check whether a patient is cached with the given version and not older than the TTL.
+
+        :param pid: The person_id.
+        :param group: The group or None for all groups.
+        :param version: The current version of the dictionary.
+        :return: Boolean indicating whether the entry can be served without refresh.
+        """
+        path = self.path(pid, group)
+        if path is None or not os.path.exists(path) or time.time() - os.path.getmtime(path) > self.ttl:
+            return False
+        entry = self.load(pid, group)
+        return entry is not None and entry.get("version") == version
+
+    def put(self, pid, group, patient, version, watermarks=None):
+        """
+        Store a patient. The file is replaced atomically, so readers never see partial entries.
+
+        :param pid: The person_id.
+        :param group: The group or None for all groups.
+        :param patient: The patient object.
+        :param version: The version of the dictionary the patient was created with.
+        :param watermarks: The highest row id of each domain (see OMOP.get_patient) or None.
+        """
+        path = self.path(pid, group)
+        if path is None:
+            return
+        tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as file:
+            json.dump({ "version": version, "created": time.time(), "watermarks": watermarks, "patient": patient }, file)
+        os.replace(tmp_path, path)
+
+    def schedule(self, pid, group):
+        """
+        Refresh an entry in the background unless a refresh of it is already pending.
+
+        :param pid: The person_id.
+        :param group: The group or None for all groups.
+        :return: The future of the refresh or None if it is already pending.
+        """
+        key = (pid, group)
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending.add(key)
+        return self._executor.submit(self._run, key)
+
+    def _run(self, key):
+        try:
+            self._refresh(*key)
+        except Exception as e:
+            print("refreshing patient {0} (group {1}) failed: {2}".format(key[0], key[1], e), file=sys.stderr)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
@@ -0,0 +1,287 @@
+import base64
+import json
+import struct
+import zlib
+import numpy as np
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Key and initialization vector of the payload encryption
+ENCRYPTION_KEY = b"ThisIsA16ByteKey"
+IV = b"ThisIsA16ByteIV!"
+
+# Media type of the binary patient payload
+BINARY_MIMETYPE = "application/x-patient-viz"
+# Media type of raw (not base64 encoded) encrypted payloads
+RAW_MIMETYPE = "application/octet-stream"
+# Magic bytes and version of the binary patient payload
+BINARY_MAGIC = b"PVZ1"
+# Event columns of the columnar format (see util.columnar_events) that are packed as
+# little-endian int32 arrays
+binary_columns = [ "time", "end", "group", "id", "row_id", "flag", "flag_value" ]
+
+
+def pack_patient(patient):
+    """
+    Encode a patient whose events are in the columnar format as binary payload.
+    The payload consists of the magic bytes, the length of a JSON header as little-endian
+    uint32, the JSON header padded with spaces to a multiple of 4 bytes, and the event
+    columns as little-endian int32 arrays that can be used as typed arrays without parsing.
+    The header is the patient without the event columns. Instead, its events object maps
+    each column to its [byte offset, number of values] in the payload.
+
+    :param patient: The patient object as returned by OMOP.get_patient with columnar=True.
+    :return: The payload as bytes.
+    """
+    events = patient["events"]
+    arrays = [ (name, np.asarray(events[name], dtype="<i4")) for name in binary_columns ]
+    header = dict(patient)
+    header["events"] = dict((key, value) for (key, value) in events.items() if key not in binary_columns)
+    header["events"]["format"] = "binary"
+    # the offsets depend on the header length, so the header is encoded with offsets
+    # of fixed width first and again with the actual offsets which fit the same width
+    columns = dict((name, [ 0, len(arr) ]) for (name, arr) in arrays)
+    header["events"]["columns"] = columns
+    start = len(BINARY_MAGIC) + 4 + _padded_length(json.dumps(header).encode("utf-8"), 12 * len(arrays))
+    offset = start
+    for (name, arr) in arrays:
+        columns[name][0] = offset
+        offset += arr.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (start - len(BINARY_MAGIC) - 4 - len(header_bytes))
+    parts = [ BINARY_MAGIC, struct.pack("<I", len(header_bytes)), header_bytes ]
+    parts.extend(arr.tobytes() for (_, arr) in arrays)
+    return b"".join(parts)
+
+
+def encode_patient(patient, binary, encoding, level, min_size):
+    """
+    Encode a patient as JSON or binary payload and compress it unless it is small.
+
+    :param patient: The patient object. Its events must be in the columnar format if
+        `binary` is set.
+    :param binary: Boolean indicating whether to encode the patient with `pack_patient`.
+    :param encoding: The negotiated compression encoding or None.
+    :param level: The compression level.
+    :param min_size: The minimum size in bytes of compressed payloads.
+    :return: A tuple (payload bytes, encoding or None if the payload is not compressed).
+    """
+    data = pack_patient(patient) if binary else json.dumps(patient).encode()
+    if encoding is None or len(data) < min_size:
+        return (data, None)
+    return (compress(data, encoding, level), encoding)
+
+
+def _padded_length(header_bytes, reserve):
+    """
+    Compute the length of the header including room for the digits of the offsets,
+    rounded up to a multiple of 4 bytes.
+
+    :param header_bytes: The encoded header with zero offsets.
+    :param reserve: The number of bytes to reserve for the offsets.
+    :return: The padded header length.
+    """
+    length = len(header_bytes) + reserve
+    return length + (-length) % 4
+
+
+def encrypt_data(data):
+    """
+    Encrypts the provided data using AES encryption in CBC mode.
+
+    :param data: The string to encrypt.
+    :return: The base64 encoded ciphertext as string.
+    """
+    return base64.b64encode(encrypt_bytes(data.encode())).decode("utf-8")
+
+
+def encrypt_bytes(data):
+    """
+    Encrypts bytes using AES encryption in CBC mode without copying the input.
+    Only the last partial block is copied for padding.
+
+    :param data: The bytes to encrypt.
+    :return: The raw ciphertext.
+    """
+    cipher = AES.new(ENCRYPTION_KEY, AES.MODE_CBC, IV)
+    size = len(data) - len(data) % AES.block_size
+    with memoryview(data) as view:
+        head = cipher.encrypt(view[:size]) if size else b""
+        return head + cipher.encrypt(pad(view[size:].tobytes(), AES.block_size))
+
+
+def encrypt_blocks(chunks, align=AES.block_size, min_size=65536):
+    """
+    Encrypts a stream of strings or bytes like `encrypt_bytes` encrypts their concatenation.
+    CBC is applied incrementally to whole multiples of `align` bytes so the concatenated
+    output is the same as the output of `encrypt_bytes`. Only the last block is padded.
+    Small chunks are collected until `min_size` bytes are available, as every call of the
+    cipher has a fixed overhead.
+
+    :param chunks: The generator of chunks to encrypt. It is closed when the encrypted
+        stream is closed.
+    :param align: The size of the ciphertext blocks, a multiple of the AES block size.
+    :param min_size: The minimum number of bytes encrypted at a time (except at the end).
+    :return: A generator of ciphertext blocks.
+    """
+    cipher = AES.new(ENCRYPTION_KEY, AES.MODE_CBC, IV)
+    buffer = bytearray()
+    try:
+        for chunk in chunks:
+            buffer += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+            if len(buffer) < min_size:
+                continue
+            size = len(buffer) - len(buffer) % align
+            if size:
+                with memoryview(buffer) as view:
+                    block = cipher.encrypt(view[:size])
+                del buffer[:size]
+                yield block
+        yield cipher.encrypt(pad(bytes(buffer), AES.block_size))
+    finally:
+        # e.g., release the dictionary lock and the connection if the client disconnects
+        chunks.close()
+
+
+def encrypt_stream(chunks):
+    """
+    Encrypts a stream of strings or bytes like `encrypt_data` encrypts their concatenation.
+    The ciphertext is encrypted in multiples of 48 bytes (a multiple of both the AES block
+    size and the 3 byte groups of base64) so the concatenated output is the same as the
+    output of `encrypt_data`.
+
+    :param chunks: The generator of chunks to encrypt.
+    :return: A generator of base64 encoded ciphertext strings.
+    """
+    blocks = encrypt_blocks(chunks, 48)
+    try:
+        for block in blocks:
+            yield base64.b64encode(block).decode("utf-8")
+    finally:
+        blocks.close()
+
+
+def compression_encodings():
+    """
+    List the compression encodings the server supports in order of preference.
+    gzip is always available, br and zstd need the optional brotli and zstandard packages.
+
+    :return: The list of encodings.
+    """
+    res = []
+    if zstandard is not None:
+        res.append("zstd")
+    if brotli is not None:
+        res.append("br")
+    res.append("gzip")
+    return res
+
+
+def negotiate_encoding(accepted):
+    """
+    Choose the compression encoding for a client.
+
+    :param accepted: The comma separated encodings the client accepts, e.g., the value of an
+        Accept-Encoding header. Quality values are ignored except for q=0.
+    :return: The preferred encoding supported by both or None.
+    """
+    if not accepted:
+        return None
+    names = set()
+    for part in accepted.split(","):
+        params = [ p.strip() for p in part.split(";") ]
+        if any(p.replace(" ", "") in ("q=0", "q=0.0") for p in params[1:]):
+            continue
+        names.add(params[0].lower())
+    for encoding in compression_encodings():
+        if encoding in names:
+            return encoding
+    return None
+
+
+class Compressor:
+    def __init__(self, encoding, level):
+        """
+        Incremental compressor with the same interface for all encodings.
+
+        :param encoding: The encoding, i.e., "gzip", "br", or "zstd".
+        :param level: The compression level. Levels 1 to 9 are valid for every encoding.
+        """
+        if encoding == "gzip":
+            # wbits 31 writes the gzip container
+            c = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._compress = c.compress
+            self._flush = c.flush
+        elif encoding == "br":
+            c = brotli.Compressor(quality=level)
+            self._compress = c.process
+            self._flush = c.finish
+        elif encoding == "zstd":
+            c = zstandard.ZstdCompressor(level=level).compressobj()
+            self._compress = c.compress
+            self._flush = c.flush
+        else:
+            raise ValueError("unknown encoding: {0}".format(encoding))
+
+    def compress(self, data):
+        """
+        Compress some data.
+
+        :param data: The bytes to compress.
+        :return: The compressed bytes that are available so far.
+        """
+        return self._compress(data)
+
+    def flush(self):
+        """
+        Finish the compressed stream.
+
+        :return: The remaining compressed bytes.
+        """
+        return self._flush()
+
+
+def compress(data, encoding, level):
+    """
+    Compress bytes at once.
+
+    :param data: The bytes to compress.
+    :param encoding: The encoding.
+    :param level: The compression level.
+    :return: The compressed bytes.
+    """
+    c = Compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compress a stream of strings or bytes.
+
+    :param chunks: The generator of chunks to compress. It is closed when the compressed
+        stream is closed.
+    :param encoding: The encoding.
+    :param level: The compression level.
+    :return: A generator of compressed bytes.
+    """
+    c = Compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = c.compress(chunk)
+            if data:
+                yield data
+        yield c.flush()
+    finally:
+        chunks.close()
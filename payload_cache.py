@@ -0,0 +1,154 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from flask_caching.backends.base import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, default_timeout=300, touch_interval=60, **kwargs):
+        """
+        Cache backend for Flask-Caching that keeps the entries in a SQLite file, so all
+        worker processes of the server share one cache that survives restarts. The
+        least recently used entries are evicted once the cache holds more than
+        `max_bytes` bytes of values. Use it with `CACHE_TYPE: payload_cache.SQLiteCache`.
+        Reads only write to the file when the recorded access time of an entry is older
+        than `touch_interval` seconds, so cache hits of different processes do not wait
+        for the write lock of SQLite. The total size of the values is kept up to date by
+        triggers in the table cache_size, so writes do not sum up the sizes.
+
+        :param path: Path of the SQLite file, e.g., json/cache.sqlite.
+        :param max_bytes: The maximum total size of the cached values.
+        :param default_timeout: The timeout of entries in seconds (0 for no timeout).
+        :param touch_interval: The precision in seconds of the access times the least
+            recently used entries are determined by.
+        """
+        super().__init__(default_timeout=default_timeout, **kwargs)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                size INTEGER,
+                expires REAL,
+                accessed REAL
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            db.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)")
+            db.execute("""CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN
+                UPDATE cache_size SET total = total + new.size;
+            END""")
+            db.execute("""CREATE TRIGGER IF NOT EXISTS cache_update AFTER UPDATE OF size ON cache BEGIN
+                UPDATE cache_size SET total = total + new.size - old.size;
+            END""")
+            db.execute("""CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN
+                UPDATE cache_size SET total = total - old.size;
+            END""")
+            # the total of a cache file of a version without cache_size
+            db.execute("INSERT OR IGNORE INTO cache_size SELECT 0, COALESCE(SUM(size), 0) FROM cache")
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        args.insert(0, config.get("CACHE_SQLITE_PATH", "json/cache.sqlite"))
+        if "CACHE_MAX_BYTES" in config:
+            kwargs["max_bytes"] = int(config["CACHE_MAX_BYTES"])
+        return cls(*args, **kwargs)
+
+    def _connect(self):
+        """
+        The connection of the current thread and process. Connections are not shared
+        between threads and are opened again after a fork.
+        """
+        db = getattr(self._local, "db", None)
+        if db is not None and self._local.pid == os.getpid():
+            return db
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        self._local.db = db
+        self._local.pid = os.getpid()
+        return db
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else 0
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute("SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] and row[1] <= now:
+                db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            if now - row[2] > self.touch_interval:
+                db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        try:
+            return pickle.loads(row[0])
+        except (pickle.PickleError, EOFError, AttributeError, ImportError):
+            return None
+
+    def has(self, key):
+        with self._connect() as db:
+            row = db.execute("SELECT expires FROM cache WHERE key = ?", (key,)).fetchone()
+        return row is not None and (not row[0] or row[0] > time.time())
+
+    def set(self, key, value, timeout=None):
+        # an upsert instead of INSERT OR REPLACE, whose deletes do not fire triggers
+        return self._set(key, value, timeout, """INSERT INTO cache VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size,
+            expires = excluded.expires, accessed = excluded.accessed""")
+
+    def add(self, key, value, timeout=None):
+        with self._connect() as db:
+            db.execute("DELETE FROM cache WHERE key = ? AND expires > 0 AND expires <= ?", (key, time.time()))
+        return self._set(key, value, timeout, "INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?, ?)")
+
+    def _set(self, key, value, timeout, insert):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._connect() as db:
+            cur = db.execute(insert, (key, data, len(data), self._expires(timeout), now))
+            added = cur.rowcount > 0
+            if added:
+                self._evict(db)
+        return added
+
+    def _total(self, db):
+        return db.execute("SELECT total FROM cache_size").fetchone()[0]
+
+    def _evict(self, db):
+        """
+        Remove expired entries and then the least recently used entries until the
+        cache holds at most 90% of `max_bytes`.
+        """
+        if self._total(db) <= self.max_bytes:
+            return
+        db.execute("DELETE FROM cache WHERE expires > 0 AND expires <= ?", (time.time(),))
+        total = self._total(db)
+        limit = self.max_bytes * 0.9
+        evict = []
+        for (key, size) in db.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if total <= limit:
+                break
+            evict.append((key,))
+            total -= size
+        db.executemany("DELETE FROM cache WHERE key = ?", evict)
+
+    def delete(self, key):
+        with self._connect() as db:
+            return db.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount > 0
+
+    def clear(self):
+        with self._connect() as db:
+            db.execute("DELETE FROM cache")
+        return True
@@ -1,27 +1,28 @@
-<<<<<<< HEAD
-=======
-# server.py
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
 import math
-from flask import Flask, jsonify, request, send_from_directory, render_template
+from flask import Flask, Response, jsonify, request, send_from_directory, render_template
 import os
 import json
 import logging
+import time
 from omop import OMOP  # Importing the OMOP module
+from config import cache_settings, omop_settings
+from dictionary_store import DictionaryStore, slice_dictionary
+from patient_cache import PatientCache, retrieve_patient
+from warmup import WarmupScheduler
+from payload import (
+    BINARY_MIMETYPE, RAW_MIMETYPE, compress, compress_stream, encode_patient,
+    encrypt_blocks, encrypt_bytes, encrypt_stream, negotiate_encoding,
+)
 from flask_caching import Cache
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad
 import base64
+from urllib.parse import urlencode
+import util
 
-<<<<<<< HEAD
 # Intialize the flask app
 app = Flask(__name__, static_folder="static", template_folder="templates")
-=======
-app = Flask(__name__, static_folder='static', template_folder='templates')
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
 
-# Configure cache to use simple in-memory caching
-cache = Cache(app, config={"CACHE_TYPE": "simple"})
+# Configure the cache of responses; by default it is shared by all worker processes
+cache = Cache(app, config=cache_settings())
 
 # Configure logging
 logging.basicConfig(
@@ -33,41 +34,118 @@ logger = logging.getLogger(__name__)
 if not os.path.exists("json"):
     os.makedirs("json")
 
-# Generate a key and initialization vector for encryption
-ENCRYPTION_KEY = b"ThisIsA16ByteKey"
-IV = b"ThisIsA16ByteIV!"
+# Load settings from environment variables
+settings = omop_settings()
+# Number of database rows turned into events per chunk of a streamed response
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "1000"))
+# Compression level (1-9) and minimum size in bytes of compressed payloads and responses
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# Initialize OMOP instance with settings
+omop = OMOP(settings, True)
+if os.getenv("OMOP_HIERARCHY_PRELOAD", "false").lower() == "true":
+    omop.preload_hierarchy()
 
+# Dictionary shared by all requests; loaded once and persisted incrementally
+dictionary_store = DictionaryStore(
+    "json/dictionary.json",
+    compact_after=int(os.getenv("DICTIONARY_COMPACT_AFTER", "10000")),
+)
 
-def encrypt_data(data):
+if not os.path.exists("json"):
+    os.makedirs("json")
+
+
+def extract_patient(person_id, group, entry=None):
     """
-    Encrypts the provided data using AES encryption in CBC mode.
+    Retrieves a patient with interval events and the dictionary entries it refers to from
+    the database and stores it in the patient cache (see patient_cache.retrieve_patient).
     """
-    cipher = AES.new(ENCRYPTION_KEY, AES.MODE_CBC, IV)
-    padded_data = pad(data.encode(), AES.block_size)
-    encrypted = cipher.encrypt(padded_data)
-    return base64.b64encode(encrypted).decode("utf-8")
+    return retrieve_patient(omop, dictionary_store, patient_cache, person_id, group, entry)
 
 
-# Load settings from environment variables
-settings = {
-    "omop_user": os.getenv("OMOP_USER", "etl_viz"),
-    "omop_passwd": os.getenv("OMOP_PASSWD", "prem123"),
-    "omop_host": os.getenv("OMOP_HOST", "localhost"),
-    "omop_port": os.getenv("OMOP_PORT", "5432"),
-    "omop_db": os.getenv("OMOP_DB", "synthea10"),
-    "omop_schema": os.getenv("OMOP_SCHEMA", "cdm_synthea10"),
-    "omop_engine": os.getenv("OMOP_ENGINE", "postgresql"),
-    "omop_use_alt_hierarchies": True,
-    "use_cache": True,
-    "ccs_diag": os.getenv("CCS_DIAG", "path/to/ccs_diag/file"),
-    "ccs_proc": os.getenv("CCS_PROC", "path/to/ccs_proc/file"),
-}
-# Initialize OMOP instance with settings
-omop = OMOP(settings, True)
+def refresh_patient(person_id, group):
+    """
+    Updates a cached patient with the rows added since it was retrieved or retrieves it
+    again if PATIENT_CACHE_INCREMENTAL is disabled.
+    """
+    entry = patient_cache.load(person_id, group) if PATIENT_CACHE_INCREMENTAL else None
+    extract_patient(person_id, group, entry)
 
-<<<<<<< HEAD
-if not os.path.exists("json"):
-    os.makedirs("json")
+
+# Patients are cached in PATIENT_CACHE_DIR (empty to disable) and refreshed in the
+# background once they are older than PATIENT_CACHE_TTL seconds; refreshes only retrieve
+# new rows unless PATIENT_CACHE_INCREMENTAL is false
+PATIENT_CACHE_DIR = os.getenv("PATIENT_CACHE_DIR", "json/patients")
+PATIENT_CACHE_INCREMENTAL = os.getenv("PATIENT_CACHE_INCREMENTAL", "true").lower() == "true"
+patient_cache = PatientCache(
+    PATIENT_CACHE_DIR,
+    int(os.getenv("PATIENT_CACHE_TTL", "3600")),
+    refresh_patient,
+    workers=int(os.getenv("PATIENT_CACHE_WORKERS", "1")),
+) if PATIENT_CACHE_DIR else None
+
+# Seconds between checks of the vocabulary versions and CCS files (0 checks every request)
+SOURCES_CHECK_INTERVAL = int(os.getenv("SOURCES_CHECK_INTERVAL", "300"))
+sources_checked = None
+
+
+@app.before_request
+def check_dictionary_sources():
+    """
+    Removes dictionary and hierarchy entries of vocabularies that changed since they were
+    added (see DictionaryStore.update_sources). This changes the dictionary version which
+    is part of the cache keys, so cached payloads with outdated entries are not used anymore.
+    """
+    global sources_checked
+    now = time.time()
+    if sources_checked is not None and now - sources_checked < SOURCES_CHECK_INTERVAL:
+        return
+    sources_checked = now
+    try:
+        sources = omop.get_dictionary_sources()
+        omop.update_sources(sources)
+        changed = dictionary_store.update_sources(sources)
+        if changed:
+            logger.info(f"Dictionary sources changed: {', '.join(sorted(changed))}")
+    except Exception as e:
+        logger.error(f"Error checking the dictionary sources: {e}")
+
+
+# Patients listed in WARMUP_PIDS_FILE are prefetched into the patient cache every
+# WARMUP_INTERVAL seconds at a rate of at most WARMUP_RATE patients per second
+WARMUP_PIDS_FILE = os.getenv("WARMUP_PIDS_FILE", "")
+warmup = None
+if WARMUP_PIDS_FILE and patient_cache is not None:
+    warmup = WarmupScheduler(
+        omop, dictionary_store, patient_cache, WARMUP_PIDS_FILE,
+        int(os.getenv("WARMUP_INTERVAL", "3600")),
+        float(os.getenv("WARMUP_RATE", "1")),
+        "json/warmup.lock",
+        incremental=PATIENT_CACHE_INCREMENTAL,
+        prepare=check_dictionary_sources,
+    )
+    warmup.start()
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses JSON responses, e.g., the dictionary, with the encoding negotiated via the
+    Accept-Encoding header. Patient payloads are compressed before they are encrypted
+    (see get_patient_data) and are not compressed again.
+    """
+    if (response.is_streamed or response.status_code != 200 or response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers or "X-Payload-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress(data, encoding, COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    return response
 
 
 # Route to render the main index page
@@ -78,15 +156,7 @@ def index():
     """
     return render_template("index.html")
 
-=======
-if not os.path.exists('json'):
-    os.makedirs('json')
 
-# Route to render the main index page
-@app.route('/')
-def index():
-    return render_template('index.html')
-    
 # Route to serve the patients list file
 # @app.route('/patients.txt')
 # @app.route('/patient-viz/patients.txt')
@@ -132,7 +202,6 @@ def index():
 #     except Exception as e:
 #         logger.error(f"Error sending json file {filename}: {e}")
 #         return jsonify({"error": "File not found"}), 404
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
 
 # Route to serve the dictionary JSON file
 @app.route("/json/dictionary.json")
@@ -140,23 +209,8 @@ def get_json_dictionary():
     """
     Serves the dictionary JSON file if it exists, dictionary.json contains hierarchical data. 
     """
-    dictionary_path = "json/dictionary.json"
-    if os.path.exists(dictionary_path):
-        try:
-<<<<<<< HEAD
-            with open(dictionary_path, "r") as file:
-=======
-            with open(dictionary_path, 'r') as file:
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
-                dictionary = json.load(file)
-            return jsonify(dictionary)
-        except Exception as e:
-            logger.error(f"Error reading dictionary.json: {e}")
-            return jsonify({})
-    else:
-        return jsonify({})
-<<<<<<< HEAD
-=======
+    with dictionary_store.lock:
+        return jsonify(dictionary_store.dictionary)
 
 # Route to serve the dictionary JSON file with caching
 # @app.route('/patient-viz/dictionary.json')
@@ -173,7 +227,6 @@ def get_json_dictionary():
 #             return jsonify({})
 #     else:
 #         return jsonify({})
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
 
 # Route to serve static files from the patient-viz directory
 @app.route("/patient-viz/<path:filename>")
@@ -186,10 +239,15 @@ def static_files(filename):
 def custom_static(filename):
     return send_from_directory(app.static_folder, filename)
 
-<<<<<<< HEAD
+# Returns the cache key of a dictionary type: the query arguments and the dictionary version.
+def dictionary_cache_key():
+    args = sorted(request.args.items(multi=True))
+    return "get_dictionary_by_type?{0}#{1}".format(urlencode(args), dictionary_store.version)
+
+
 # Route to get the dictionary domain types
 @app.route("/get_dictionary_by_type", methods=["GET"])
-@cache.cached(timeout=300, query_string=True)
+@cache.cached(timeout=300, make_cache_key=dictionary_cache_key)
 def get_dictionary_by_type():
     """
     Fetches and returns the dictionary data filtered by a specific event type.
@@ -199,173 +257,189 @@ def get_dictionary_by_type():
         return jsonify({"error": "No event type provided"}), 400
 
     try:
-        dictionary = load_or_create_dictionary()
-        if event_type in dictionary:
-            return jsonify({event_type: dictionary[event_type]})
-        else:
-            return jsonify({}), 404
+        with dictionary_store.lock:
+            dictionary = load_or_create_dictionary()
+            if event_type in dictionary:
+                return jsonify({event_type: dictionary[event_type]})
+            else:
+                return jsonify({}), 404
     except Exception as e:
         logger.error(f"Error fetching dictionary data for type {event_type}: {e}")
         return jsonify({"error": f"Failed to fetch dictionary data: {str(e)}"}), 500
 
+def patient_json_chunks(person_id, group, intervals):
+    """
+    Generates the JSON text of a patient in chunks as its events are retrieved.
+    The events come first and the rest of the patient, including the dictionary slice,
+    follows once all events are known. The patient is extracted into a snapshot of the
+    dictionary whose new entries are merged and persisted after the last event, so no
+    lock is held while chunks are sent to the client.
+    """
+    snapshot = dictionary_store.snapshot()
+    dictionary = snapshot.dictionary
+    refs = set()
+    sep = ""
+    yield '{"events": ['
+    for (kind, value) in omop.iter_patient(person_id, dictionary, None, None, group, intervals=intervals, chunk_size=STREAM_CHUNK_SIZE):
+        if kind == "patient":
+            patient_data = value
+            continue
+        if not value:
+            continue
+        refs.update((e["group"], e["id"]) for e in value)
+        yield sep + json.dumps(value)[1:-1]
+        sep = ", "
+    snapshot.merge()
+    patient_data["dictionary"] = slice_dictionary(dictionary, patient_data, refs)
+    del patient_data["events"]
+    yield "], " + json.dumps(patient_data)[1:]
+
+
+# Returns the media type of the patient payload negotiated via the Accept header.
+def negotiate_payload():
+    return request.accept_mimetypes.best_match(["application/json", BINARY_MIMETYPE, RAW_MIMETYPE], "application/json")
+
+
+# Returns whether the patient data is streamed; streamed responses are not cached.
+# The columnar and binary formats are never streamed.
+def is_streamed():
+    return (request.args.get("stream") == "1" and request.args.get("format") != "columnar"
+            and negotiate_payload() != BINARY_MIMETYPE)
+
+
+# Describes the encrypted patient payload of a response in its headers.
+def add_payload_headers(response, payload_type, encoding):
+    response.vary.add("Accept")
+    response.vary.add("X-Accept-Payload-Encoding")
+    response.headers["X-Payload-Type"] = payload_type
+    response.headers["X-Payload-Cipher"] = "AES-CBC"
+    if encoding is not None:
+        response.headers["X-Payload-Encoding"] = encoding
+
+
+# Returns the compression encoding of the patient payload negotiated via the
+# X-Accept-Payload-Encoding header. The payload is compressed before it is encrypted.
+def payload_encoding():
+    return negotiate_encoding(request.headers.get("X-Accept-Payload-Encoding"))
+
+
+# Returns the cache key of the patient data: the query arguments, the payload type,
+# the compression encoding, and the dictionary version (payloads embed dictionary entries).
+def patient_cache_key():
+    args = sorted(request.args.items(multi=True))
+    return "get_patient_data?{0}#{1}#{2}#{3}".format(
+        urlencode(args), negotiate_payload(), payload_encoding(), dictionary_store.version)
+
+
 # Route to get the patient data from omop module
 @app.route("/get_patient_data", methods=["GET"])
-@cache.cached(timeout=300, query_string=True)
+@cache.cached(timeout=300, make_cache_key=patient_cache_key, unless=is_streamed)
 def get_patient_data():
     """
     Fetches patient's detail based on the patient id and group parameter.
+    With `intervals=1` multi-day events are sent as one event with an "end" time.
+    With `stream=1` the response is generated while the events are retrieved instead of
+    after the whole patient is assembled.
+    With `format=columnar` the events are sent as parallel arrays.
+    With `Accept: application/x-patient-viz` the patient is sent as encrypted binary
+    payload (see payload.pack_patient) with the events as packed int32 arrays.
+    With `Accept: application/octet-stream` the encrypted JSON is sent as raw body instead
+    of base64 encoded inside a JSON object.
+    The X-Payload-Type header names the media type of the decrypted payload.
+    Payloads are compressed before encryption with an encoding listed in the
+    X-Accept-Payload-Encoding header; the X-Payload-Encoding header of the response
+    names the encoding used.
     """
     person_id = request.args.get("id")
     group = request.args.get("group")
+    # Multi-day conditions and drugs as a single event with an "end" time
+    intervals = request.args.get("intervals") == "1"
+    # Events as parallel arrays instead of event objects
+    columnar = request.args.get("format") == "columnar"
+    payload_type = negotiate_payload()
+    binary = payload_type == BINARY_MIMETYPE
 
-=======
-# Route to get patient data with caching 
-# @app.route('/get_patient_data', methods=['GET'])
-# @cache.cached(timeout=300, query_string=True)
-# def get_patient_data():
-#     person_id = request.args.get('id')
-    
-#     if not person_id:
-#         return jsonify({"error": "No patient ID provided"}), 400
-
-#     if person_id.startswith('json/') and person_id.endswith('.json'):
-#         person_id = person_id[5:-5]
-
-#     try:
-#         # Load or create the dictionary with hierarchies
-#         dictionary = load_or_create_dictionary()
-
-#         # Fetch patient data
-#         patient_data = omop.get_patient(person_id, dictionary, None, None)
-        
-#         # Save the updated dictionary
-#         dictionary_path = 'json/dictionary.json'
-#         with open(dictionary_path, 'w') as f:
-#             json.dump(dictionary, f)
-        
-#         return jsonify(patient_data)
-    
-#     except Exception as e:
-#         logger.error(f"Error fetching patient data: {e}")
-#         return jsonify({"error": f"Failed to fetch patient data: {str(e)}"}), 500
-
-@app.route('/get_patient_data', methods=['GET'])
-@cache.cached(timeout=300, query_string=True)
-def get_patient_data():
-    person_id = request.args.get('id')
-    page = int(request.args.get('page', 1))
-    page_size = int(request.args.get('page_size', 100))
-    
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
     if not person_id:
         return jsonify({"error": "No patient ID provided"}), 400
 
     if person_id.startswith("json/") and person_id.endswith(".json"):
         person_id = person_id[5:-5]
 
-    try:
-        dictionary = load_or_create_dictionary()
-        # Get patient data from the omop class
-        patient_data = omop.get_patient(person_id, dictionary, None, None, group)
+    if is_streamed():
+        return stream_patient_data(person_id, group, intervals, payload_encoding(), payload_type == RAW_MIMETYPE)
 
-        dictionary_path = "json/dictionary.json"
-        with open(dictionary_path, "w") as f:
-            json.dump(dictionary,f)
-
-        # Include only the relevant dictionary data
-        if group and group in dictionary:
-            patient_data["dictionary"] = {group: dictionary[group]}
+    try:
+        patient_data = None
+        if patient_cache is not None:
+            patient_data = patient_cache.get(person_id, group, dictionary_store.version)
+        if patient_data is None:
+            patient_data = extract_patient(person_id, group)
+
+        if not intervals:
+            patient_data["events"] = omop.expand_intervals([ dict(e) for e in patient_data["events"] ])
+        if columnar or binary:
+            patient_data["events"] = util.columnar_events(patient_data["events"])
+
+        (patient_bytes, encoding) = encode_patient(patient_data, binary, payload_encoding(), COMPRESS_LEVEL, COMPRESS_MIN_SIZE)
+
+        if payload_type == "application/json":
+            encrypted_data = base64.b64encode(encrypt_bytes(patient_bytes)).decode("utf-8")
+            response = jsonify({"encrypted_data": encrypted_data})
         else:
-            patient_data["dictionary"] = dictionary
+            response = Response(encrypt_bytes(patient_bytes), mimetype=payload_type)
+        add_payload_headers(response, BINARY_MIMETYPE if binary else "application/json", encoding)
+        return response
 
-        encrypted_data = encrypt_data(json.dumps(patient_data))
-
-        return jsonify({"encrypted_data": encrypted_data})
-
-<<<<<<< HEAD
-=======
-        # Fetch patient data
-        full_patient_data = omop.get_patient(person_id, dictionary, None, None)
+    except Exception as e:
+        logger.error(f"Error fetching patient data: {e}")
+        return jsonify({"error": f"Failed to fetch patient data: {str(e)}"}), 500
 
-        # Calculate total pages
-        total_events = len(full_patient_data['events'])
-        total_pages = math.ceil(total_events / page_size)
-        
-        # Paginate the events
-        start = (page - 1) * page_size
-        end = start + page_size
-        paginated_events = full_patient_data['events'][start:end]
-
-        paginated_data = {
-            'info': full_patient_data['info'],
-            'events': paginated_events,
-            'start': full_patient_data['start'],
-            'end': full_patient_data['end'],
-            'h_bars': full_patient_data.get('h_bars', []),
-            'v_bars': full_patient_data.get('v_bars', []),
-            'v_spans': full_patient_data.get('v_spans', []),
-            'classes': full_patient_data.get('classes', {}),
-            'pagination': {
-                'page': page,
-                'page_size': page_size,
-                'total_pages': total_pages,
-                'total_events': total_events
-            }
-        }
-        
-        # Save the updated dictionary
-        dictionary_path = 'json/dictionary.json'
-        with open(dictionary_path, 'w') as f:
-            json.dump(dictionary, f)
 
-        
-        return jsonify(paginated_data)
-    
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
+def stream_patient_data(person_id, group, intervals, encoding, raw):
+    """
+    Streams the encrypted patient data. The response is the same as the response of
+    get_patient_data but memory is bounded by the chunk size instead of the patient size.
+    Streamed payloads are compressed regardless of their size if an encoding is given.
+    """
+    chunks = patient_json_chunks(person_id, group, intervals)
+    if encoding is not None:
+        chunks = compress_stream(chunks, encoding, COMPRESS_LEVEL)
+    chunks = encrypt_blocks(chunks) if raw else encrypt_stream(chunks)
+    try:
+        # errors before the first chunk, e.g., an unknown patient, are reported as usual
+        first = next(chunks)
     except Exception as e:
+        chunks.close()
         logger.error(f"Error fetching patient data: {e}")
         return jsonify({"error": f"Failed to fetch patient data: {str(e)}"}), 500
 
-<<<<<<< HEAD
-
-# Load the existing dictionary.json file or create a new one with hierarchies.
-def load_or_create_dictionary():
-    dictionary_path = "json/dictionary.json"
-=======
-# Load the existing dictionary.json file or create a new one with hierarchies.
+    def generate():
+        try:
+            if not raw:
+                yield '{"encrypted_data": "'
+            yield first
+            for chunk in chunks:
+                yield chunk
+            if not raw:
+                yield '"}'
+        except Exception:
+            # the status was sent already; raising makes the server abort the connection
+            # instead of ending the body cleanly, so clients see an incomplete response
+            logger.exception(f"Error streaming patient data of {person_id}")
+            raise
+        finally:
+            chunks.close()
+
+    response = Response(generate(), mimetype=RAW_MIMETYPE if raw else "application/json")
+    add_payload_headers(response, "application/json", encoding)
+    return response
+
+
+# Returns the in-memory dictionary; callers must hold dictionary_store.lock.
 def load_or_create_dictionary():
-    dictionary_path = 'json/dictionary.json'
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
-    if os.path.exists(dictionary_path):
-        with open(dictionary_path, "r") as file:
-            dictionary = json.load(file)
-    else:
-        # Create a new dictionary with hierarchies
-        dictionary = {}
-        new_dict_entries = set()
-        omop.update_hierarchies(dictionary, new_dict_entries)
-
-    return dictionary
+    return dictionary_store.dictionary
 
 
-<<<<<<< HEAD
 if __name__ == "__main__":
     app.run(debug=True, host="127.0.0.1", port=8080)
-=======
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
 
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
@@ -1,10 +1,6 @@
 // Filtering data based on event-types and encrypted the data
 
-<<<<<<< HEAD
-=======
-const pageSize = 5000;
 let currentPatientId = null;
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
 let isLoading = false;
 var SLOW_MODE = false; // Flag to control slow mode behavior
 var DEBUG_V_SEGMENTS = false; // Flag to control debug view segments
@@ -28,6 +24,48 @@ function decryptData(encryptedData) {
   return JSON.parse(decrypted.toString(CryptoJS.enc.Utf8));
 }
 
+// Function to decrypt a binary payload (ArrayBuffer) using the WebCrypto API
+async function decryptBytes(encryptedBytes) {
+  const key = await window.crypto.subtle.importKey(
+    'raw', new TextEncoder().encode('ThisIsA16ByteKey'), { name: 'AES-CBC' }, false, ['decrypt']);
+  return window.crypto.subtle.decrypt(
+    { name: 'AES-CBC', iv: new TextEncoder().encode('ThisIsA16ByteIV!') }, key, encryptedBytes);
+}
+
+// The binary payload needs the WebCrypto API which is only available in secure contexts
+const USE_BINARY_PAYLOAD = !!(window.crypto && window.crypto.subtle);
+
+// Encodings of compressed payloads the browser can decompress; the server compresses
+// payloads before encrypting them and names the encoding in the X-Payload-Encoding header
+const PAYLOAD_ENCODINGS = typeof DecompressionStream !== 'undefined' ? ['gzip'] : [];
+
+// Function to decompress a payload (ArrayBuffer or typed array) with the given encoding
+async function decompressBytes(bytes, encoding) {
+  if (!encoding) {
+    return bytes;
+  }
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream(encoding));
+  return new Response(stream).arrayBuffer();
+}
+
+// Function to decrypt (and decompress) a base64 encoded JSON payload
+async function decryptPayload(encryptedData, encoding) {
+  if (!encoding) {
+    return decryptData(encryptedData);
+  }
+  const decrypted = CryptoJS.AES.decrypt(
+    { ciphertext: CryptoJS.enc.Base64.parse(encryptedData) },
+    ENCRYPTION_KEY,
+    { iv: IV, mode: CryptoJS.mode.CBC, padding: CryptoJS.pad.Pkcs7 }
+  );
+  // CryptoJS word arrays hold the bytes as big-endian 32 bit words
+  const bytes = new Uint8Array(decrypted.sigBytes);
+  for (let ix = 0; ix < decrypted.sigBytes; ix += 1) {
+    bytes[ix] = (decrypted.words[ix >>> 2] >>> (24 - (ix % 4) * 8)) & 0xff;
+  }
+  return JSON.parse(new TextDecoder().decode(await decompressBytes(bytes, encoding)));
+}
+
 // Main function to start application
 async function start() {
   // Configure busy images
@@ -220,17 +258,11 @@ async function start() {
   histogram = views[4];
   labels = views[5];
 
-<<<<<<< HEAD
   // Load the initial dictionary data
   await fetchDictionary();
 
   // Set event listeners for various controls
   d3.select("#pVSel").on("change", function () {
-=======
-  setupLoadMoreButton();
-
-  d3.select("#pVSel").on("change", function() {
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
     pool.verticalSelection(d3.select("#pVSel").node().checked);
   });
   d3.select("#pShow").on("change", function () {
@@ -266,7 +298,6 @@ async function start() {
   var dictionary = null;
   var lastDictionaryFile = null;
 
-<<<<<<< HEAD
   // Function to load patient data dynamically based on ID and group
   async function loadFile(pid, dictionaryFile, createState, group = null) {
     document.getElementById('timelineContainer').style.display = 'none';
@@ -294,19 +325,34 @@ async function start() {
 
     try {
       // Fetch the patient data from the server
-      const response = await fetch(`/get_patient_data?id=${encodeURIComponent(personId)}${group ? '&group=' + encodeURIComponent(group) : ''}`);
-      const data = await response.json();
-
-      if (data.error) {
-        throw new Error(data.error);
+      // Multi-day events are sent as intervals and expanded by the pool
+      // Events are sent as parallel arrays that loadPerson reads without decoding them first
+      // Events are sent as packed int32 arrays if the binary payload can be decrypted
+      const headers = {};
+      if (USE_BINARY_PAYLOAD) {
+        headers['Accept'] = BINARY_MIMETYPE;
+      }
+      if (PAYLOAD_ENCODINGS.length) {
+        headers['X-Accept-Payload-Encoding'] = PAYLOAD_ENCODINGS.join(', ');
       }
+      const response = await fetch(`/get_patient_data?id=${encodeURIComponent(personId)}&intervals=1&format=columnar${group ? '&group=' + encodeURIComponent(group) : ''}`,
+        { headers: headers });
+      const encoding = response.headers.get('X-Payload-Encoding');
+      let json_patient;
+      if ((response.headers.get('Content-Type') || '').startsWith(BINARY_MIMETYPE)) {
+        json_patient = unpackPatient(await decompressBytes(await decryptBytes(await response.arrayBuffer()), encoding));
+      } else {
+        const data = await response.json();
 
-      const json_patient = decryptData(data.encrypted_data); // Decrypt the patient data
+        if (data.error) {
+          throw new Error(data.error);
+        }
+
+        json_patient = await decryptPayload(data.encrypted_data, encoding); // Decrypt the patient data
+      }
 
       console.log("Received patient data for group:", group, json_patient);
-      console.log("Number of events:", json_patient.events.length);
-      console.log("First event:", json_patient.events[0]);
-      console.log("Last event:", json_patient.events[json_patient.events.length - 1]);
+      console.log("Number of events:", json_patient.events.time.length);
 
       if (json_patient.start === undefined || json_patient.end === undefined) {
         console.error("Missing start or end time in patient data");
@@ -476,118 +522,6 @@ async function start() {
       console.error("Error during type change:", error);
     }
   });
-=======
-// Dynamic Patient ID Creation
-function loadFile(pid, dictionaryFile, createState, page = 1) {
-  if (createState) {
-      var url = jkjs.util.getOwnURL() + "?p=" + encodeURIComponent(pid) + "&d=" + encodeURIComponent(dictionaryFile);
-      window.history.pushState({
-          pid: pid,
-          dictionary: dictionaryFile
-      }, "", url);
-  }
-  console.log("Loading patient file from:", pid);
-  busy.setState(jkjs.busy.state.busy);
-  if (page === 1) {
-    overview.clearShadow();
-    typeList.clearLists();
-    eventList.setEvents([], false, false);
-    pool.clearEvents();
-    currentPatientId = pid;
-    hasMoreEvents = true;
-  } else {
-    // Clear previous events before loading new ones
-    eventList.setEvents([], false, false);
-    pool.clearEvents();
-  }
-
-  // Extract person_id if it's a filename
-  var personId = pid;
-  if (pid.startsWith('json/') && pid.endsWith('.json')) {
-      personId = pid.substring(5, pid.length - 5);
-  }
-
-    // Use the new endpoint to get patient data
-    d3.json(`/get_patient_data?id=${encodeURIComponent(personId)}&page=${page}&page_size=${pageSize}`, function(err, json_patient) {
-      if (err) {
-          console.error("Failed loading patient:", pid, err);
-          busy.setState(jkjs.busy.state.warn, "Failed loading file: '" + pid + "'. Error: " + err.statusText);
-          return;
-      }
-      console.log("Received patient data:", json_patient);
-      if (json_patient.start === undefined || json_patient.end === undefined) {
-          console.error("Missing start or end time in patient data");
-          busy.setState(jkjs.busy.state.warn, "Missing start or end time in patient data");
-          return;
-      }
-
-      d3.json(dictionaryFile, function(err_dict, json_dictionary) {
-          if (err_dict) {
-              console.error("Failed loading dictionary:", dictionaryFile, err_dict);
-              busy.setState(jkjs.busy.state.warn, "Invalid dictionary file. Error: " + err_dict.statusText);
-              return;
-          }
-          dictionary = json_dictionary;
-          lastDictionaryFile = dictionaryFile;
-          var error = true;
-          try {
-              loadPerson(pid, json_patient, pool, eventList, typeList, linechart, histogram, dictionary, suppl);
-
-              currentPage = json_patient.pagination.page;
-              hasMoreEvents = currentPage < json_patient.pagination.total_pages;
-
-              busy.setState(jkjs.busy.state.norm);
-              relayout();
-              if (page==1){
-              zui.showAll(false);
-              }
-              error = false;
-
-              var loadingIndicator = document.getElementById('loadingIndicator');
-              if (loadingIndicator) loadingIndicator.style.display = 'none';
-              
-              isLoading = false;
-          } 
-          finally {
-              if (error) {
-                  busy.setState(jkjs.busy.state.warn, "Error while loading file.");
-              }
-          }
-      });
-  });
-}
-
-function setupLoadMoreButton() {
-  var loadMoreButton = document.getElementById('loadMoreButton');
-  if (loadMoreButton) {
-      loadMoreButton.addEventListener('click', function() {
-          if (!isLoading && hasMoreEvents) {
-              loadMoreEvents();
-          }
-      });
-  }
-}
-
-  function loadMoreEvents() {
-  if (isLoading || !hasMoreEvents) return;
-  
-  isLoading = true;
-  currentPage++;
-  
-  // Show loading indicator
-  var loadingIndicator = document.getElementById('loadingIndicator');
-  if (loadingIndicator) loadingIndicator.style.display = 'block';
-
-  // Hide the Load More button while loading
-  // var loadMoreButton = document.getElementById('loadMoreButton');
-  // if (loadMoreButton) loadMoreButton.style.display = 'none';
-
-  // Call loadFile function to fetch more data
-  loadFile(currentPatientId, lastDictionaryFile, false, currentPage);
-  }
-
-
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
   // Handle browser back/forward navigation
   window.onpopstate = function (e) {
     if (e.state) {
@@ -667,20 +601,4 @@ function setupLoadMoreButton() {
       alert("Please enter a valid Patient ID.");
     }
   });
-<<<<<<< HEAD
-}
-=======
 }
-
-
-
-
-
-
-  
-
-
-
-
-
->>>>>>> 35ef72a74a97dbc3c1826de4c7102110a9d5cca3
@@ -141,8 +141,99 @@ function setupModes(pool) {
     });
   }
 }
+// Events in the columnar format (parallel arrays, see util.columnar_events). The columns,
+// e.g., the Int32Arrays of a binary payload, are kept as they are and an event object is
+// only created when the event is visited; times are sent as days and converted back to
+// seconds
+function ColumnarEvents(events) {
+  this.strings = events["strings"];
+  this.flags = events["flags"];
+  this.time = events["time"];
+  this.end = events["end"];
+  this.group = events["group"];
+  this.id = events["id"];
+  this.rowId = events["row_id"];
+  this.flag = events["flag"];
+  this.flagValue = events["flag_value"];
+  this.length = this.time.length;
+}
+
+// Creates the object of the event at an index; with a day (in days since the epoch) the
+// event of that day of an interval event is created instead, i.e., without 'end'
+ColumnarEvents.prototype.get = function(ix, day) {
+  var strings = this.strings;
+  var e = {
+    "id": strings[this.id[ix]],
+    "group": strings[this.group[ix]],
+    "time": (day === undefined ? this.time[ix] : day) * TypePool.DAY_SECONDS
+  };
+  if(day === undefined && this.end[ix] > this.time[ix]) {
+    e["end"] = this.end[ix] * TypePool.DAY_SECONDS;
+  }
+  if(this.rowId[ix] >= 0) {
+    e["row_id"] = strings[this.rowId[ix]];
+  }
+  if(this.flag[ix] >= 0) {
+    e["flag"] = this.flags[this.flag[ix]];
+    e["flag_value"] = this.flagValue[ix] >= 0 ? strings[this.flagValue[ix]] : null;
+  }
+  return e;
+};
+
+// Calls the callback with the object of every event
+ColumnarEvents.prototype.forEach = function(cb) {
+  for(var ix = 0; ix < this.length; ix += 1) {
+    cb(this.get(ix), ix);
+  }
+};
+
+// Calls the callback with one object per day of every event (see TypePool.expandIntervals)
+ColumnarEvents.prototype.forEachDay = function(cb) {
+  var time = this.time;
+  var end = this.end;
+  for(var ix = 0; ix < this.length; ix += 1) {
+    if(end[ix] > time[ix]) {
+      for(var day = time[ix]; day <= end[ix]; day += 1) {
+        cb(this.get(ix, day));
+      }
+    } else {
+      cb(this.get(ix));
+    }
+  }
+};
+
+// Function to wrap events in the columnar format without decoding them
+function decodeEvents(events) {
+  if(Array.isArray(events)) {
+    return events;
+  }
+  return new ColumnarEvents(events);
+}
+
+// Media type of the binary patient payload (see payload.py)
+var BINARY_MIMETYPE = "application/x-patient-viz";
+
+// Function to unpack a binary patient payload (see payload.pack_patient) whose events are
+// little-endian int32 columns; the columns are wrapped as typed arrays without copying
+function unpackPatient(buffer) {
+  var magic = String.fromCharCode.apply(null, new Uint8Array(buffer, 0, 4));
+  if(magic !== "PVZ1") {
+    throw new Error("invalid patient payload: " + magic);
+  }
+  var headerLength = new DataView(buffer).getUint32(4, true);
+  var person = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+  var events = person["events"];
+  Object.keys(events["columns"]).forEach(function(name) {
+    var column = events["columns"][name];
+    events[name] = new Int32Array(buffer, column[0], column[1]);
+  });
+  delete events["columns"];
+  return person;
+}
+
 // Function to load a person's data into the visualization
 function loadPerson(pid, person, pool, eventView, typeView, linechart, histogram, dictionary, suppl) {
+  person["events"] = decodeEvents(person["events"]);
   var selId = refreshInfo(("" + pid).trim(), person); // Refresh the info section with the person's data
   pool.clearEvents();
   pool.setTimeRange(person.start, person.end);
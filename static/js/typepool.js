@@ -409,7 +409,7 @@ function TypePool(busy, overview, setBox, onVC, cw, rh) {
     startTime = timeSpan[0];
     endTime = timeSpan[1];
     var allTimes = [];
-    person["events"].forEach(function(e) {
+    TypePool.expandIntervals(person["events"], function(e) {
       var eve = new Event(e, that, dictionary);
       var time = eve.getTime();
       allTimes = jkjs.util.join(allTimes, [time]);
@@ -1722,6 +1722,36 @@ TypePool.HIGHLIGHT_NONE = 0;
 TypePool.HIGHLIGHT_HOR = 1;
 TypePool.HIGHLIGHT_VER = 2;
 TypePool.HIGHLIGHT_BOTH = TypePool.HIGHLIGHT_HOR | TypePool.HIGHLIGHT_VER;
+TypePool.DAY_SECONDS = 24 * 60 * 60;
+
+/**
+ * Calls cb for every event where interval events, i.e., events with an "end" time,
+ * are expanded into one event per day from "time" to "end".
+ */
+TypePool.expandIntervals = function(events, cb) {
+  if(typeof events.forEachDay === "function") {
+    // columnar events create the objects of the days directly (see ColumnarEvents)
+    events.forEachDay(cb);
+    return;
+  }
+  events.forEach(function(e) {
+    if(!("end" in e)) {
+      cb(e);
+      return;
+    }
+    var end = parseInt(e["end"]);
+    for(var time = parseInt(e["time"]); time <= end; time += TypePool.DAY_SECONDS) {
+      var day = {};
+      Object.keys(e).forEach(function(key) {
+        if(key !== "end") {
+          day[key] = e[key];
+        }
+      });
+      day["time"] = time;
+      cb(day);
+    }
+  });
+};
 
 /**
  * Sets the time range for the TypePool, updating the visualization accordingly.
@@ -0,0 +1,166 @@
+import datetime
+import importlib
+import os
+import random
+import sys
+
+import pytest
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omop import OMOP
+
+tables = [
+    "CREATE TABLE person (person_id INTEGER, person_source_value TEXT, year_of_birth INTEGER, gender_concept_id INTEGER)",
+    "CREATE TABLE concept (concept_id INTEGER, domain_id TEXT, concept_name TEXT, vocabulary_id TEXT, concept_code TEXT)",
+    "CREATE TABLE concept_ancestor (ancestor_concept_id INTEGER, descendant_concept_id INTEGER, min_levels_of_separation INTEGER)",
+    "CREATE TABLE vocabulary (vocabulary_id TEXT, vocabulary_version TEXT)",
+    "CREATE TABLE condition_occurrence (condition_occurrence_id INTEGER, person_id INTEGER, condition_start_date DATE, condition_end_date DATE, condition_concept_id INTEGER, condition_source_value TEXT)",
+    "CREATE TABLE procedure_occurrence (procedure_occurrence_id INTEGER, person_id INTEGER, procedure_date DATE, procedure_concept_id INTEGER, procedure_source_value TEXT)",
+    "CREATE TABLE observation (observation_id INTEGER, person_id INTEGER, observation_date DATE, observation_concept_id INTEGER, observation_source_value TEXT, value_as_concept_id INTEGER, value_as_string TEXT, value_as_number REAL)",
+    "CREATE TABLE drug_exposure (drug_exposure_id INTEGER, person_id INTEGER, drug_exposure_start_date DATE, drug_exposure_end_date DATE, drug_concept_id INTEGER, drug_source_value TEXT)",
+    "CREATE TABLE measurement (measurement_id INTEGER, person_id INTEGER, measurement_date DATE, measurement_concept_id INTEGER, measurement_source_value TEXT, value_source_value TEXT, value_as_number REAL, range_low REAL, range_high REAL)",
+    "CREATE TABLE visit_occurrence (visit_occurrence_id INTEGER, person_id INTEGER, visit_start_date DATE, visit_end_date DATE, visit_concept_id INTEGER)",
+]
+
+domain_vocabularies = [ ("Condition", "SNOMED"), ("Drug", "RxNorm"), ("Measurement", "LOINC"), ("Observation", "SNOMED"), ("Procedure", "SNOMED") ]
+
+
+class Database:
+    def __init__(self, path, seed=1):
+        """
+        SQLite database with the OMOP tables the queries use and random patients.
+
+        :param path: The path of the database file.
+        :param seed: The seed of the random rows.
+        """
+        self.path = path
+        self.url = "sqlite:///" + path
+        self.engine = sqlalchemy.create_engine(self.url)
+        self._random = random.Random(seed)
+        self._row_id = 0
+        self.concepts = {}
+        with self.engine.begin() as connection:
+            for query in tables:
+                connection.exec_driver_sql(query)
+            connection.exec_driver_sql("INSERT INTO vocabulary VALUES ('SNOMED', 'v1'), ('RxNorm', 'v2'), ('LOINC', 'v3')")
+            concept_id = 100
+            for (domain, vocabulary) in domain_vocabularies:
+                self.concepts[domain] = []
+                for _ in range(6):
+                    concept_id += 1
+                    connection.exec_driver_sql("INSERT INTO concept VALUES (?, ?, ?, ?, ?)",
+                        (concept_id, domain, "{0} {1}".format(domain, concept_id), vocabulary, "C{0}".format(concept_id)))
+                    self.concepts[domain].append(concept_id)
+                # the first concept of a domain is the ancestor of the others
+                root = self.concepts[domain][0]
+                for child in self.concepts[domain][1:]:
+                    connection.exec_driver_sql("INSERT INTO concept_ancestor VALUES (?, ?, 1)", (root, child))
+                    connection.exec_driver_sql("INSERT INTO concept_ancestor VALUES (?, ?, 0)", (child, child))
+            connection.exec_driver_sql("INSERT INTO concept VALUES (8507, 'Gender', 'MALE', 'Gender', 'M')")
+            connection.exec_driver_sql("INSERT INTO concept VALUES (9201, 'Visit', 'Inpatient Visit', 'Visit', 'IP')")
+
+    def _date(self):
+        return datetime.date(2000, 1, 1) + datetime.timedelta(days=self._random.randint(0, 4000))
+
+    def _id(self):
+        self._row_id += 1
+        return self._row_id
+
+    def add_person(self, pid):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("INSERT INTO person VALUES (?, ?, ?, 8507)", (pid, "src{0}".format(pid), 1950 + pid))
+
+    def add_rows(self, pid, count):
+        """
+        Add `count` rows to every domain table for a person.
+        """
+        rnd = self._random
+        with self.engine.begin() as connection:
+            x = connection.exec_driver_sql
+            for _ in range(count):
+                # some rows end before they start
+                start = self._date()
+                end = start + datetime.timedelta(days=rnd.randint(-3, 20))
+                x("INSERT INTO condition_occurrence VALUES (?, ?, ?, ?, ?, 'src')",
+                    (self._id(), pid, str(start), None if rnd.random() < .3 else str(end), rnd.choice(self.concepts["Condition"])))
+                start = self._date()
+                end = start + datetime.timedelta(days=rnd.randint(-3, 40))
+                x("INSERT INTO drug_exposure VALUES (?, ?, ?, ?, ?, 'src')",
+                    (self._id(), pid, str(start), str(end), rnd.choice(self.concepts["Drug"])))
+                x("INSERT INTO procedure_occurrence VALUES (?, ?, ?, ?, 'src')",
+                    (self._id(), pid, str(self._date()), rnd.choice(self.concepts["Procedure"])))
+                x("INSERT INTO observation VALUES (?, ?, ?, ?, 'src', ?, ?, ?)",
+                    (self._id(), pid, str(self._date()), rnd.choice(self.concepts["Observation"]),
+                        rnd.choice([ None, rnd.choice(self.concepts["Observation"]) ]), rnd.choice([ None, "str" ]), rnd.choice([ None, 3.5 ])))
+                x("INSERT INTO measurement VALUES (?, ?, ?, ?, 'src', 'v', ?, 2, 8)",
+                    (self._id(), pid, str(self._date()), rnd.choice(self.concepts["Measurement"]), rnd.choice([ None, 1, 5, 9 ])))
+                start = self._date()
+                x("INSERT INTO visit_occurrence VALUES (?, ?, ?, ?, 9201)",
+                    (self._id(), pid, str(start), str(start + datetime.timedelta(days=2))))
+
+    def settings(self, **settings):
+        """
+        The OMOP settings of the database.
+        """
+        res = {
+            "omop_user": "", "omop_passwd": "", "omop_host": "", "omop_port": "", "omop_db": "",
+            "omop_url": self.url,
+            "omop_schema": "main",
+            "omop_use_alt_hierarchies": False,
+        }
+        res.update(settings)
+        return res
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = Database(str(tmp_path / "omop.sqlite"))
+    for pid in range(1, 5):
+        db.add_person(pid)
+        db.add_rows(pid, 3 + pid)
+    yield db
+    db.engine.dispose()
+
+
+@pytest.fixture
+def omop(database):
+    res = OMOP(database.settings(), False)
+    yield res
+    res.db.dispose()
+
+
+@pytest.fixture
+def load_server(tmp_path, database, monkeypatch):
+    """
+    Import a server module (server or async_server) with the settings of the database.
+    Its files (json/...) are in a temporary directory.
+
+    :return: Function (module name, **environment variables) returning the module.
+    """
+    modules = []
+
+    def load(name, **env):
+        monkeypatch.chdir(tmp_path)
+        env = dict({
+            "OMOP_URL": database.url,
+            "OMOP_SCHEMA": "main",
+            "OMOP_ENGINE": "sqlite",
+            "OMOP_POOL_PRE_PING": "false",
+            "CACHE_SQLITE_PATH": str(tmp_path / "json" / "cache.sqlite"),
+            "PATIENT_CACHE_DIR": str(tmp_path / "json" / "patients"),
+        }, **env)
+        for (key, value) in env.items():
+            monkeypatch.setenv(key, value)
+        monkeypatch.delitem(sys.modules, name, raising=False)
+        module = importlib.import_module(name)
+        modules.append(module)
+        return module
+
+    yield load
+    for module in modules:
+        # the synchronous engine is only created if it was used
+        if module.omop._db is not None:
+            module.omop.db.dispose()
+        sys.modules.pop(module.__name__, None)
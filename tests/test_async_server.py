@@ -0,0 +1,114 @@
+import asyncio
+import base64
+import gzip
+import json
+
+import httpx
+import pytest
+
+import payload
+from test_server import decrypt, patient_data
+
+queries = [ "id=1", "id=2&intervals=1", "id=3&group=Drug", "id=4&format=columnar" ]
+header_sets = [ {}, { "Accept": payload.RAW_MIMETYPE }, { "X-Accept-Payload-Encoding": "gzip" } ]
+
+
+def async_patient_data(response):
+    assert response.status_code == 200
+    if response.headers["Content-Type"] == payload.RAW_MIMETYPE:
+        data = decrypt(response.content)
+    else:
+        data = decrypt(base64.b64decode(response.json()["encrypted_data"]))
+    if response.headers.get("X-Payload-Encoding") == "gzip":
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+@pytest.fixture
+def servers(load_server, database):
+    server = load_server("server", PATIENT_CACHE_DIR="")
+    async_server = load_server("async_server", OMOP_ASYNC_URL="sqlite+aiosqlite:///" + database.path, SOURCES_CHECK_INTERVAL="0")
+    return (server, async_server)
+
+
+def run(async_server, fn):
+    """
+    Call `fn` with an httpx client of the ASGI app on a new event loop.
+    """
+    async def main():
+        transport = httpx.ASGITransport(app=async_server.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await fn(client)
+        finally:
+            await async_server.async_omop.close()
+
+    return asyncio.run(main())
+
+
+def test_same_responses(servers):
+    (server, async_server) = servers
+    client = server.app.test_client()
+
+    async def requests(async_client):
+        for query in queries:
+            for headers in header_sets:
+                expected = patient_data(client.get("/get_patient_data?" + query, headers=headers))
+                response = await async_client.get("/get_patient_data?" + query, headers=headers)
+                assert async_patient_data(response) == expected, (query, headers)
+        for event_type in [ "Condition", "Drug", "Visit" ]:
+            expected = client.get("/get_dictionary_by_type?type=" + event_type)
+            response = await async_client.get("/get_dictionary_by_type?type=" + event_type)
+            assert response.status_code == expected.status_code
+            assert response.json() == expected.get_json()
+        response = await async_client.get("/get_patient_data")
+        assert response.status_code == 400
+        response = await async_client.get("/missing")
+        assert response.status_code == 404
+
+    run(async_server, requests)
+    # the patients were extracted without the synchronous engine
+    assert async_server.omop._db is None
+
+
+def test_incremental_refresh(servers, database):
+    (server, async_server) = servers
+
+    async def refresh(async_client):
+        response = await async_client.get("/get_patient_data?id=2&intervals=1")
+        assert response.status_code == 200
+        database.add_rows(2, 2)
+        entry = async_server.patient_cache.load("2", None)
+        return await async_server.extract_patient("2", None, entry)
+
+    patient = run(async_server, refresh)
+    expected = patient_data(server.app.test_client().get("/get_patient_data?id=2&intervals=1"))
+    key = lambda e: json.dumps(e, sort_keys=True)
+    assert sorted(patient.pop("events"), key=key) == sorted(expected.pop("events"), key=key)
+    assert patient == expected
+    entry = async_server.patient_cache.load("2", None)
+    assert entry["version"] == async_server.dictionary_store.version
+    watermarks = {}
+    server.omop.get_patient("2", {}, None, None, watermarks=watermarks)
+    assert entry["watermarks"] == watermarks
+
+
+def test_changed_version(servers):
+    (_, async_server) = servers
+    store = async_server.dictionary_store
+
+    async def extract(async_client):
+        snapshot = store.snapshot
+        # another process resets the dictionary while the patient is extracted
+        def reset():
+            res = snapshot()
+            store._set_version("other", store.sources)
+            return res
+
+        store.snapshot = reset
+        return await async_server.extract_patient("1", None)
+
+    patient = run(async_server, extract)
+    assert patient["dictionary"]
+    # the entries of the outdated snapshot are not merged
+    assert store.dictionary == {}
@@ -0,0 +1,165 @@
+import json
+import threading
+
+from dictionary_store import DictionaryStore, dictionary_delta, slice_dictionary
+
+
+def entry(id, parent=""):
+    return { "id": id, "name": "concept {0}".format(id), "parent": parent }
+
+
+def test_dictionary_delta():
+    dictionary = { "Condition": { "": entry("") } }
+    sizes = {}
+    assert list(dictionary_delta(dictionary, sizes)) == [ ("Condition", "", entry("")) ]
+    assert list(dictionary_delta(dictionary, sizes)) == []
+    dictionary["Condition"]["SNOMED1"] = entry("1")
+    dictionary["Drug"] = { "RxNorm2": entry("2") }
+    assert list(dictionary_delta(dictionary, sizes)) == [ ("Condition", "SNOMED1", entry("1")), ("Drug", "RxNorm2", entry("2")) ]
+    assert sizes == { "Condition": 2, "Drug": 1 }
+
+
+def test_persist_and_load(tmp_path):
+    path = str(tmp_path / "dictionary.json")
+    store = DictionaryStore(path, compact_after=3)
+    store.merge([ ("Condition", "", entry("")), ("Condition", "SNOMED1", entry("1", "")) ])
+    assert store.persist() == 2
+    assert store.persist() == 0
+    assert DictionaryStore(path).dictionary == store.dictionary
+    # existing entries are kept
+    store.merge([ ("Condition", "SNOMED1", entry("other")), ("Drug", "RxNorm2", entry("2")) ])
+    assert store.dictionary["Condition"]["SNOMED1"] == entry("1")
+    # the third journal entry triggers a compaction
+    assert store.persist() == 1
+    with open(path) as file:
+        assert json.load(file) == store.dictionary
+    assert open(store.journal_path).read() == ""
+    assert DictionaryStore(path).dictionary == store.dictionary
+    assert DictionaryStore(path).version == store.version
+
+
+def test_snapshot_merge(tmp_path):
+    store = DictionaryStore(str(tmp_path / "dictionary.json"))
+    store.merge([ ("Condition", "", entry("")) ])
+    store.persist()
+    snapshot = store.snapshot()
+    snapshot.dictionary["Condition"]["SNOMED1"] = entry("1", "")
+    snapshot.dictionary["Drug"] = { "": entry("") }
+    assert "SNOMED1" not in store.dictionary["Condition"]
+    assert "Drug" not in store.dictionary
+    # the view falls through to the entries of the store
+    assert snapshot.dictionary["Condition"][""] is store.dictionary["Condition"][""]
+    assert "SNOMED1" in snapshot.dictionary["Condition"]
+    assert snapshot.dictionary.get("Drug").get("") == entry("")
+    assert snapshot.dictionary.get("Procedure") is None
+    # the store is not locked while the snapshot changes
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(store.lock.acquire(timeout=1)) or store.lock.release())
+    thread.start()
+    thread.join()
+    assert acquired == [ True ]
+    assert snapshot.merge() == 2
+    assert snapshot.merge() == 0
+    assert store.dictionary == {
+        "Condition": { "": entry(""), "SNOMED1": entry("1", "") },
+        "Drug": { "": entry("") },
+    }
+    assert DictionaryStore(store.path).dictionary == store.dictionary
+
+
+def test_snapshot_of_old_version(tmp_path):
+    store = DictionaryStore(str(tmp_path / "dictionary.json"))
+    store.update_sources({ "vocabulary:SNOMED": "v1" })
+    snapshot = store.snapshot()
+    store.update_sources({ "vocabulary:SNOMED": "v2" })
+    snapshot.dictionary["Condition"] = { "SNOMED1": entry("1") }
+    assert not snapshot.is_current()
+    assert snapshot.merge() == 0
+    assert store.dictionary == {}
+
+
+def test_other_process(tmp_path):
+    path = str(tmp_path / "dictionary.json")
+    store = DictionaryStore(path, compact_after=4)
+    other = DictionaryStore(path, compact_after=4)
+    other.merge([ ("Condition", "", entry("")), ("Condition", "SNOMED1", entry("1")) ])
+    other.persist()
+    # entries of the journal are read when taking a snapshot
+    snapshot = store.snapshot()
+    assert snapshot.dictionary["Condition"]["SNOMED1"] == entry("1")
+    # and are not written to the journal again
+    store.merge([ ("Drug", "RxNorm2", entry("2")) ])
+    assert store.persist() == 1
+    assert len(open(store.journal_path).readlines()) == 3
+    other.snapshot()
+    assert other.dictionary == store.dictionary
+    # entries compacted into the dictionary file by another process
+    other.merge([ ("Drug", "RxNorm3", entry("3")) ])
+    other.persist()
+    assert open(store.journal_path).read() == ""
+    store.merge([ ("Drug", "RxNorm4", entry("4")) ])
+    store.persist()
+    assert store.dictionary == dict(other.dictionary, Drug={ "RxNorm2": entry("2"), "RxNorm3": entry("3"), "RxNorm4": entry("4") })
+    assert DictionaryStore(path).dictionary == store.dictionary
+
+
+def test_other_process_version(tmp_path):
+    path = str(tmp_path / "dictionary.json")
+    store = DictionaryStore(path)
+    store.update_sources({ "vocabulary:SNOMED": "v1", "vocabulary:RxNorm": "v1" })
+    store.merge([ ("Condition", "SNOMED1", entry("1")), ("Drug", "RxNorm2", entry("2")) ])
+    store.persist()
+    other = DictionaryStore(path)
+    other.update_sources({ "vocabulary:SNOMED": "v2", "vocabulary:RxNorm": "v1" })
+    snapshot = store.snapshot()
+    assert snapshot.version == other.version
+    assert store.dictionary == { "Condition": {}, "Drug": { "RxNorm2": entry("2") } }
+
+
+def test_extract_into_snapshot(tmp_path, omop):
+    store = DictionaryStore(str(tmp_path / "dictionary.json"))
+    dictionary = {}
+    for pid in [ "1", "2", "3" ]:
+        expected = omop.get_patient(pid, dictionary, None, None)
+        snapshot = store.snapshot()
+        assert omop.get_patient(pid, snapshot.dictionary, None, None) == expected
+        snapshot.merge()
+    assert store.dictionary == dictionary
+    assert DictionaryStore(store.path).dictionary == dictionary
+
+
+def test_slice_dictionary():
+    dictionary = {
+        "Condition": {
+            "": entry(""),
+            "SNOMED1": entry("1", ""),
+            "SNOMED2": entry("2", "SNOMED1"),
+            "SNOMED3": entry("3", ""),
+        },
+        "Drug": { "": entry(""), "RxNorm4": entry("4", "") },
+    }
+    patient = { "events": [ { "group": "Condition", "id": "SNOMED2" } ], "h_bars": [] }
+    assert slice_dictionary(dictionary, patient) == {
+        "Condition": { "": entry(""), "SNOMED2": entry("2", "SNOMED1"), "SNOMED1": entry("1", "") },
+    }
+    assert slice_dictionary(dictionary, patient, [ ("Drug", "RxNorm4") ])["Drug"] == { "": entry(""), "RxNorm4": entry("4", "") }
+
+
+def test_slice_patient(tmp_path, omop):
+    store = DictionaryStore(str(tmp_path / "dictionary.json"))
+    for pid in [ "1", "2" ]:
+        snapshot = store.snapshot()
+        omop.get_patient(pid, snapshot.dictionary, None, None)
+        snapshot.merge()
+    snapshot = store.snapshot()
+    patient = omop.get_patient("3", snapshot.dictionary, None, None)
+    res = slice_dictionary(snapshot.dictionary, patient)
+    # every entry of an event is in the slice together with its chain of parents
+    for e in patient["events"]:
+        group = res[e["group"]]
+        key = e["id"]
+        while key != "":
+            assert group[key] is snapshot.dictionary[e["group"]][key]
+            key = group[key]["parent"]
+        assert "" in group
+    assert set(res) == set(e["group"] for e in patient["events"])
@@ -0,0 +1,159 @@
+import json
+import os
+
+import pytest
+
+from omop import OMOP
+
+pids = [ "1", "2", "3", "4" ]
+groups = [ None, "Condition", "Drug" ]
+
+# The patients and dictionaries of the `database` fixture as returned by get_patient
+# with one query per domain, before batched extraction was added. Keys are
+# "<pid>/<group>" with an empty group for all groups.
+with open(os.path.join(os.path.dirname(__file__), "data", "baseline_patients.json")) as file:
+    baseline = json.load(file)
+
+
+def extract(omop, pid, group=None, **kwargs):
+    dictionary = {}
+    patient = omop.get_patient(pid, dictionary, None, None, group, **kwargs)
+    return (patient, dictionary)
+
+
+def sorted_events(events):
+    return sorted(events, key=lambda e: json.dumps(e, sort_keys=True))
+
+
+@pytest.mark.parametrize("key", sorted(baseline.keys()))
+@pytest.mark.parametrize("batched", [ False, True ])
+def test_baseline(omop, key, batched):
+    (pid, group) = key.split("/")
+    (patient, dictionary) = extract(omop, pid, group or None, batched=batched)
+    assert json.loads(json.dumps(patient)) == baseline[key]["patient"]
+    assert json.loads(json.dumps(dictionary)) == baseline[key]["dictionary"]
+
+
+@pytest.mark.parametrize("group", groups)
+@pytest.mark.parametrize("pid", pids)
+def test_batched(omop, pid, group):
+    (expected, expected_dictionary) = extract(omop, pid, group, batched=False)
+    assert expected["events"]
+    (patient, dictionary) = extract(omop, pid, group, batched=True)
+    assert patient == expected
+    assert dictionary == expected_dictionary
+
+
+@pytest.mark.parametrize("key", sorted(baseline.keys()))
+def test_parallel(omop, key):
+    (pid, group) = key.split("/")
+    (patient, dictionary) = extract(omop, pid, group or None, parallel=True)
+    assert json.loads(json.dumps(patient)) == baseline[key]["patient"]
+    assert json.loads(json.dumps(dictionary)) == baseline[key]["dictionary"]
+
+
+def test_parallel_workers(database):
+    omop = OMOP(database.settings(omop_parallel_workers=3), False)
+    # the threads are only started for parallel extractions
+    extract(omop, "1")
+    assert omop._executor is None
+    extract(omop, "1", parallel=True)
+    assert omop.executor is omop._executor
+    assert omop._parallel_workers == 3
+    omop.db.dispose()
+
+
+@pytest.mark.parametrize("group", groups)
+@pytest.mark.parametrize("pid", pids)
+def test_watermarks(omop, pid, group):
+    (expected, _) = extract(omop, pid, group)
+    results = []
+    for options in [ { "batched": False }, { "batched": True }, { "parallel": True } ]:
+        watermarks = {}
+        (patient, _) = extract(omop, pid, group, watermarks=watermarks, **options)
+        assert patient == expected, options
+        results.append(watermarks)
+    assert results[0]
+    assert results[0] == results[1] == results[2]
+
+
+@pytest.mark.parametrize("parallel", [ False, True ])
+def test_update_patient(database, omop, parallel):
+    omop._parallel = parallel
+    for intervals in [ False, True ]:
+        watermarks = {}
+        patient = omop.get_patient("2", {}, None, None, intervals=intervals, watermarks=watermarks)
+        count = len(patient["events"])
+        assert omop.update_patient("2", patient, {}, watermarks, intervals=intervals) == 0
+        assert len(patient["events"]) == count
+    database.add_rows(2, 2)
+    (expected, _) = extract(omop, "2", intervals=True)
+    assert omop.update_patient("2", patient, {}, watermarks, intervals=True) > 0
+    assert sorted_events(patient["events"]) == sorted_events(expected["events"])
+    for key in [ "start", "end", "info", "v_spans" ]:
+        assert patient[key] == expected[key]
+    expected_watermarks = {}
+    extract(omop, "2", watermarks=expected_watermarks)
+    assert watermarks == expected_watermarks
+
+
+@pytest.mark.parametrize("group", [ None, "Drug" ])
+def test_get_patients(omop, group):
+    dictionary = {}
+    patients = omop.get_patients(pids + [ "99" ], dictionary, None, None, group)
+    assert list(patients.keys()) == pids
+    for pid in pids:
+        assert json.loads(json.dumps(patients[pid])) == baseline["{0}/{1}".format(pid, group or "")]["patient"]
+    for pid in pids:
+        (_, expected_dictionary) = extract(omop, pid, group)
+        for (group_key, entries) in expected_dictionary.items():
+            assert set(entries) <= set(dictionary[group_key])
+
+
+@pytest.mark.parametrize("intervals", [ False, True ])
+def test_iter_patient(omop, intervals):
+    for pid in pids:
+        (expected, expected_dictionary) = extract(omop, pid, intervals=intervals)
+        if not intervals:
+            assert json.loads(json.dumps(expected)) == baseline[pid + "/"]["patient"]
+        dictionary = {}
+        events = []
+        for (kind, value) in omop.iter_patient(pid, dictionary, None, None, intervals=intervals, chunk_size=2):
+            if kind == "events":
+                events.extend(value)
+            else:
+                patient = value
+        assert patient["events"] == []
+        patient["events"] = events
+        assert patient == expected
+        assert dictionary == expected_dictionary
+
+
+def test_stream_options(database):
+    omop = OMOP(database.settings(omop_fetch_size=2), False)
+    with omop.connection() as connection:
+        for (key, expected) in baseline.items():
+            (pid, group) = key.split("/")
+            (patient, _) = extract(omop, pid, group or None)
+            assert json.loads(json.dumps(patient)) == expected["patient"]
+        # the streaming options apply to the statements, not to the shared connection
+        assert "stream_results" not in connection.get_execution_options()
+        assert "yield_per" not in connection.get_execution_options()
+    omop.db.dispose()
+
+
+@pytest.mark.parametrize("pid", pids)
+def test_columnar(omop, pid):
+    (patient, _) = extract(omop, pid, columnar=True)
+    (expected, _) = extract(omop, pid)
+    events = patient["events"]
+    strings = events["strings"]
+    assert events["format"] == "columnar"
+    assert len(events["time"]) == len(expected["events"])
+    assert [ strings[ix] for ix in events["id"] ] == [ e["id"] for e in expected["events"] ]
+    assert [ strings[ix] for ix in events["group"] ] == [ e["group"] for e in expected["events"] ]
+    assert [ strings[ix] for ix in events["row_id"] ] == [ e["row_id"] for e in expected["events"] ]
+    assert [ t * 24 * 3600 for t in events["time"] ] == [ e["time"] for e in expected["events"] ]
+    del patient["events"]
+    del expected["events"]
+    assert patient == expected
@@ -0,0 +1,24 @@
+from omop import OMOP
+
+
+def test_bulk_load(tmp_path, database):
+    bulk = OMOP(database.settings(omop_hierarchy_cache=str(tmp_path / "bulk.sqlite")), False)
+    bulk.preload_hierarchy()
+    assert bulk._hierarchy.complete
+    lookup = OMOP(database.settings(omop_hierarchy_cache=str(tmp_path / "lookup.sqlite")), False)
+    ids = [ str(c) for concepts in database.concepts.values() for c in concepts ]
+    lookup._hierarchy.add_ancestor_rows(ids, lookup.get_ancestors(ids))
+    assert dict(bulk._hierarchy._entries) == dict((k, v) for (k, v) in lookup._hierarchy._entries.items() if v[3] is not None)
+
+
+def test_cached_hierarchies(tmp_path, database, omop):
+    cached = OMOP(database.settings(omop_hierarchy_cache=str(tmp_path / "hierarchy.sqlite")), False)
+    for pid in [ "1", "2", "3", "4" ]:
+        dictionary = {}
+        patient = cached.get_patient(pid, dictionary, None, None)
+        expected_dictionary = {}
+        assert patient == omop.get_patient(pid, expected_dictionary, None, None)
+        # the cache resolves the nearest parent of an entry
+        for (group, entries) in dictionary.items():
+            for (key, entry) in entries.items():
+                assert entry["parent"] == expected_dictionary[group][key]["parent"]
@@ -0,0 +1,50 @@
+import pytest
+
+# (start, end, number of days) of the condition and drug rows of person 10
+spans = [
+    ("2005-03-10", "2005-03-08", 0),
+    ("2005-04-01", "2005-04-01", 1),
+    ("2005-05-01", None, 1),
+    ("2005-06-01", "2005-06-03", 3),
+]
+
+
+@pytest.fixture
+def person(database):
+    database.add_person(10)
+    condition = database.concepts["Condition"][1]
+    drug = database.concepts["Drug"][1]
+    with database.engine.begin() as connection:
+        for (ix, (start, end, _)) in enumerate(spans):
+            connection.exec_driver_sql("INSERT INTO condition_occurrence VALUES (?, 10, ?, ?, ?, 'src')", (1000 + ix, start, end, condition))
+            connection.exec_driver_sql("INSERT INTO drug_exposure VALUES (?, 10, ?, ?, ?, 'src')", (2000 + ix, start, end, drug))
+    return "10"
+
+
+def row_events(patient, row_id):
+    return [ e for e in patient["events"] if e["row_id"] == row_id ]
+
+
+@pytest.mark.parametrize("prefix,first", [ ("c", 1000), ("m", 2000) ])
+def test_day_events(omop, person, prefix, first):
+    patient = omop.get_patient(person, {}, None, None)
+    for (ix, (_, _, days)) in enumerate(spans):
+        events = row_events(patient, prefix + str(first + ix))
+        assert len(events) == days
+        assert all("end" not in e for e in events)
+        assert len(set(e["time"] for e in events)) == days
+
+
+@pytest.mark.parametrize("prefix,first", [ ("c", 1000), ("m", 2000) ])
+def test_interval_events(omop, person, prefix, first):
+    patient = omop.get_patient(person, {}, None, None, intervals=True)
+    expanded = omop.get_patient(person, {}, None, None)
+    for (ix, (_, _, days)) in enumerate(spans):
+        events = row_events(patient, prefix + str(first + ix))
+        assert len(events) == min(days, 1)
+        if days > 1:
+            day_times = [ e["time"] for e in row_events(expanded, prefix + str(first + ix)) ]
+            assert (events[0]["time"], events[0]["end"]) == (day_times[0], day_times[-1])
+        elif days == 1:
+            assert "end" not in events[0]
+    assert sum(len(row_events(patient, "c" + str(1000 + ix))) for ix in range(len(spans))) == 3
@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+
+import pytest
+
+from dictionary_store import DictionaryStore
+from patient_cache import PatientCache, retrieve_patient
+
+
+class Refresh:
+    """
+    Refresh function of a PatientCache that records its calls and blocks until released.
+    """
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, pid, group):
+        self.calls.append((pid, group))
+        self.started.set()
+        assert self.release.wait(10)
+
+
+@pytest.fixture
+def refresh():
+    res = Refresh()
+    yield res
+    res.release.set()
+
+
+@pytest.fixture
+def cache(tmp_path, refresh):
+    return PatientCache(str(tmp_path / "patients"), 60, refresh)
+
+
+def test_put_and_get(cache, refresh):
+    patient = { "events": [ { "id": "x" } ] }
+    assert cache.get("1", None, "v1") is None
+    cache.put("1", None, patient, "v1", { "condition": 5 })
+    cache.put("1", "Drug", { "events": [] }, "v1")
+    assert cache.get("1", None, "v1") == patient
+    assert cache.get("1", "Drug", "v1") == { "events": [] }
+    # entries of other dictionary versions are never served
+    assert cache.get("1", None, "v2") is None
+    entry = cache.load("1", None)
+    assert entry["version"] == "v1"
+    assert entry["watermarks"] == { "condition": 5 }
+    assert sorted(os.listdir(cache.directory)) == [ "1.Drug.json", "1.json" ]
+    assert refresh.calls == []
+
+
+def test_invalid_names(cache):
+    assert cache.path("../1", None) is None
+    assert cache.path("1", "a/b") is None
+    cache.put("../1", None, {}, "v1")
+    assert cache.get("../1", None, "v1") is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_invalid_file(cache):
+    with open(cache.path("1", None), "w") as file:
+        file.write("{")
+    assert cache.load("1", None) is None
+    assert cache.get("1", None, "v1") is None
+
+
+def test_stale_while_revalidate(cache, refresh, monkeypatch):
+    patient = { "events": [] }
+    cache.put("1", None, patient, "v1")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    # the stale entry is served right away and refreshed in the background
+    assert cache.get("1", None, "v1") == patient
+    assert refresh.started.wait(10)
+    assert refresh.calls == [ ("1", None) ]
+
+
+def test_schedule_deduplicates(cache, refresh):
+    future = cache.schedule("1", None)
+    assert future is not None
+    assert refresh.started.wait(10)
+    # a refresh of the same entry is pending, refreshes of other entries are not
+    assert cache.schedule("1", None) is None
+    assert cache.schedule("1", "Drug") is not None
+    refresh.release.set()
+    future.result(10)
+    cache._executor.shutdown(wait=True)
+    assert refresh.calls == [ ("1", None), ("1", "Drug") ]
+    assert not cache._pending
+
+
+def test_failed_refresh(tmp_path):
+    def fail(pid, group):
+        raise RuntimeError("no database")
+
+    cache = PatientCache(str(tmp_path / "patients"), 60, fail)
+    cache.schedule("1", None).result(10)
+    # the next refresh is not blocked by the failed one
+    assert not cache._pending
+
+
+def test_is_fresh(cache):
+    assert not cache.is_fresh("1", None, "v1")
+    cache.put("1", None, {}, "v1")
+    assert cache.is_fresh("1", None, "v1")
+    assert not cache.is_fresh("1", None, "v2")
+    assert not cache.is_fresh("1", "Drug", "v1")
+    old = time.time() - 61
+    os.utime(cache.path("1", None), (old, old))
+    assert not cache.is_fresh("1", None, "v1")
+
+
+def test_retrieve_patient(tmp_path, omop, cache):
+    store = DictionaryStore(str(tmp_path / "dictionary.json"))
+    patient = retrieve_patient(omop, store, cache, "2", None)
+    expected_dictionary = {}
+    expected = omop.get_patient("2", expected_dictionary, None, None, intervals=True)
+    dictionary = patient.pop("dictionary")
+    assert patient == expected
+    # the slice holds the entries the patient refers to, all of which are in the store
+    assert dictionary
+    for (group, entries) in dictionary.items():
+        for (id, entry) in entries.items():
+            assert expected_dictionary[group][id] == entry
+            assert store.dictionary[group][id] == entry
+    assert DictionaryStore(store.path).dictionary == store.dictionary
+    entry = cache.load("2", None)
+    assert entry["version"] == store.version
+    assert entry["patient"]["dictionary"] == dictionary
+    assert cache.get("2", None, store.version)["events"] == expected["events"]
+
+
+def test_incremental_retrieve_patient(tmp_path, database, omop, cache):
+    store = DictionaryStore(str(tmp_path / "dictionary.json"))
+    retrieve_patient(omop, store, cache, "3", None)
+    entry = cache.load("3", None)
+    assert entry["watermarks"]
+    database.add_rows(3, 2)
+    patient = retrieve_patient(omop, store, cache, "3", None, entry)
+    expected = omop.get_patient("3", {}, None, None, intervals=True)
+    key = lambda e: (e["time"], e.get("time_end"), e["group"], e["id"], e["row_id"])
+    assert sorted(patient["events"], key=key) == sorted(expected["events"], key=key)
+    for name in [ "start", "end", "info", "v_spans" ]:
+        assert patient[name] == expected[name]
+    expected_watermarks = {}
+    omop.get_patient("3", {}, None, None, watermarks=expected_watermarks)
+    assert cache.load("3", None)["watermarks"] == expected_watermarks
+    # entries of another dictionary version are retrieved completely
+    entry = cache.load("3", None)
+    entry["version"] = "other"
+    entry["patient"]["events"] = []
+    patient = retrieve_patient(omop, store, cache, "3", None, entry)
+    assert len(patient["events"]) == len(expected["events"])
@@ -0,0 +1,135 @@
+import base64
+import gzip
+import json
+import struct
+
+import numpy as np
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+
+import payload
+from payload import BINARY_MAGIC, binary_columns
+
+
+def decrypt(data):
+    return unpad(AES.new(payload.ENCRYPTION_KEY, AES.MODE_CBC, payload.IV).decrypt(data), AES.block_size)
+
+
+def unpack_patient(data):
+    """
+    Read a binary payload of `pack_patient` the way the browser does.
+    """
+    assert data[:4] == BINARY_MAGIC
+    (length,) = struct.unpack("<I", data[4:8])
+    header = json.loads(data[8:8 + length].decode("utf-8"))
+    events = header["events"]
+    assert events["format"] == "binary"
+    events["format"] = "columnar"
+    for (name, (offset, count)) in events.pop("columns").items():
+        assert offset % 4 == 0
+        events[name] = np.frombuffer(data, dtype="<i4", count=count, offset=offset).tolist()
+    return header
+
+
+@pytest.fixture
+def columnar_patient(omop):
+    return omop.get_patient("2", {}, None, None, columnar=True)
+
+
+def test_pack_patient(columnar_patient):
+    data = payload.pack_patient(columnar_patient)
+    assert (8 + struct.unpack("<I", data[4:8])[0]) % 4 == 0
+    assert unpack_patient(data) == json.loads(json.dumps(columnar_patient))
+
+
+def test_pack_empty_patient():
+    patient = { "info": [], "events": dict([ (name, []) for name in binary_columns ], format="columnar", strings=[], flags=[]) }
+    assert unpack_patient(payload.pack_patient(patient)) == patient
+
+
+def test_binary_response(load_server, columnar_patient):
+    server = load_server("server", PATIENT_CACHE_DIR="")
+    client = server.app.test_client()
+    response = client.get("/get_patient_data?id=2", headers={ "Accept": payload.BINARY_MIMETYPE })
+    assert response.status_code == 200
+    assert response.headers["X-Payload-Type"] == payload.BINARY_MIMETYPE
+    patient = unpack_patient(decrypt(response.get_data()))
+    expected = json.loads(json.dumps(columnar_patient))
+    for key in [ "events", "info", "start", "end" ]:
+        assert patient[key] == expected[key]
+
+
+def chunked(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def decompress(data, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "br":
+        return payload.brotli.decompress(data)
+    return payload.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+@pytest.mark.parametrize("encoding", payload.compression_encodings())
+def test_compress(encoding):
+    data = json.dumps([ { "id": str(i), "group": "Condition" } for i in range(5000) ]).encode("utf-8")
+    compressed = payload.compress(data, encoding, 6)
+    assert len(compressed) < len(data)
+    assert decompress(compressed, encoding) == data
+    streamed = b"".join(payload.compress_stream(chunked(data.decode("utf-8"), 1000), encoding, 6))
+    assert decompress(streamed, encoding) == data
+
+
+def test_encode_patient(columnar_patient):
+    (data, encoding) = payload.encode_patient(columnar_patient, True, "gzip", 6, 1)
+    assert encoding == "gzip"
+    assert unpack_patient(gzip.decompress(data)) == json.loads(json.dumps(columnar_patient))
+    (data, encoding) = payload.encode_patient(columnar_patient, False, "gzip", 6, 1 << 30)
+    assert encoding is None
+    assert json.loads(data) == json.loads(json.dumps(columnar_patient))
+
+
+def test_negotiate_encoding():
+    assert payload.negotiate_encoding(None) is None
+    assert payload.negotiate_encoding("gzip, deflate") == "gzip"
+    assert payload.negotiate_encoding("gzip;q=0, identity") is None
+    assert payload.negotiate_encoding("GZIP;q=0.5") == "gzip"
+    assert payload.negotiate_encoding(", ".join(payload.compression_encodings())) == payload.compression_encodings()[0]
+
+
+@pytest.mark.parametrize("size", [ 1, 7, 16, 48, 1000, 100000 ])
+def test_encrypt_stream(size):
+    text = json.dumps({ "events": [ { "id": str(i), "time": i } for i in range(5000) ] })
+    expected = payload.encrypt_data(text)
+    assert "".join(payload.encrypt_stream(chunked(text, size))) == expected
+    assert json.loads(decrypt(base64.b64decode(expected))) == json.loads(text)
+
+
+@pytest.mark.parametrize("length", [ 0, 1, 15, 16, 17, 100000 ])
+def test_encrypt_blocks(length):
+    data = bytes(bytearray(i % 251 for i in range(length)))
+    expected = payload.encrypt_bytes(data)
+    assert decrypt(expected) == data
+    for min_size in [ 1, 64, 65536 ]:
+        blocks = list(payload.encrypt_blocks(chunked(data, 33), min_size=min_size))
+        assert b"".join(blocks) == expected
+        assert all(len(block) % AES.block_size == 0 for block in blocks)
+
+
+def test_encrypt_blocks_closes_chunks():
+    closed = []
+
+    def chunks():
+        try:
+            yield b"a" * 100
+            yield b"b" * 100
+        finally:
+            closed.append(True)
+
+    blocks = payload.encrypt_blocks(chunks(), min_size=1)
+    next(blocks)
+    blocks.close()
+    assert closed == [ True ]
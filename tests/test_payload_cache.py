@@ -0,0 +1,133 @@
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+
+from payload_cache import SQLiteCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache.sqlite")
+
+
+def stored_total(path):
+    with sqlite3.connect(path) as db:
+        total = db.execute("SELECT total FROM cache_size").fetchone()[0]
+        assert total == db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+    return total
+
+
+def accessed(path, key):
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT accessed FROM cache WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_set_get(path):
+    cache = SQLiteCache(path)
+    assert cache.get("a") is None
+    assert cache.set("a", { "events": [1, 2] })
+    assert cache.get("a") == { "events": [1, 2] }
+    assert cache.has("a")
+    assert cache.set("a", "b" * 100)
+    assert cache.get("a") == "b" * 100
+    assert not cache.add("a", "c")
+    assert cache.add("c", "c")
+    assert stored_total(path) > 100
+    assert cache.delete("a")
+    assert not cache.has("a")
+    assert cache.clear()
+    assert cache.get("c") is None
+    assert stored_total(path) == 0
+    # the entries survive the instance
+    SQLiteCache(path).set("d", 4)
+    assert SQLiteCache(path).get("d") == 4
+
+
+def test_expiry(path, monkeypatch):
+    cache = SQLiteCache(path, default_timeout=10)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.set("a", 1)
+    cache.set("b", 2, timeout=0)
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert not cache.has("a")
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.add("a", 3)
+    assert cache.get("a") == 3
+    stored_total(path)
+
+
+def test_touch_interval(path, monkeypatch):
+    cache = SQLiteCache(path, touch_interval=60)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.set("a", 1)
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    assert cache.get("a") == 1
+    assert accessed(path, "a") == now
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("a") == 1
+    assert accessed(path, "a") == now + 61
+
+
+def test_eviction(path, monkeypatch):
+    cache = SQLiteCache(path, max_bytes=1000, touch_interval=0)
+    now = time.time()
+    for i in range(8):
+        monkeypatch.setattr(time, "time", lambda: now + i)
+        cache.set(str(i), "x" * 100)
+    size = stored_total(path) // 8
+    assert 8 * size <= 1000
+    # reading entry 0 makes entries 1 and 2 the least recently used ones, which are
+    # evicted to get below 90% of max_bytes
+    monkeypatch.setattr(time, "time", lambda: now + 10)
+    assert cache.get("0") is not None
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    cache.set("8", "x" * 100)
+    assert stored_total(path) <= 900
+    assert [ cache.has(str(i)) for i in range(9) ] == [True, False, False] + [True] * 6
+    cache.set("9", "x" * 100)
+    total = stored_total(path)
+    assert total <= 1000
+    assert cache.has("3") and cache.has("9")
+    # replacing an entry counts its new size only
+    cache.set("9", "x")
+    assert stored_total(path) < total
+
+
+def test_existing_file(path):
+    # a file of a version without cache_size
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires REAL, accessed REAL)")
+        db.execute("INSERT INTO cache VALUES ('a', x'00', 50, 0, 0)")
+    cache = SQLiteCache(path)
+    assert stored_total(path) == 50
+    cache.set("b", 2)
+    stored_total(path)
+
+
+def write_entries(path, offset):
+    cache = SQLiteCache(path, max_bytes=20000, touch_interval=0)
+    for i in range(200):
+        key = str(offset + i)
+        cache.set(key, key * 10)
+        assert cache.get(key) == key * 10
+        cache.get(str((offset + 1000 + i) % 2000))
+
+
+def test_processes(path):
+    SQLiteCache(path)
+    context = multiprocessing.get_context("fork")
+    processes = [ context.Process(target=write_entries, args=(path, offset)) for offset in (0, 1000) ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    cache = SQLiteCache(path)
+    assert 0 < stored_total(path) <= 20000
+    assert cache.get("199") == "199" * 10
+    assert cache.get("1199") == "1199" * 10
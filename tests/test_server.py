@@ -0,0 +1,60 @@
+import base64
+import gzip
+import json
+import logging
+
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+
+import payload
+
+
+def decrypt(data):
+    return unpad(AES.new(payload.ENCRYPTION_KEY, AES.MODE_CBC, payload.IV).decrypt(data), AES.block_size)
+
+
+def patient_data(response):
+    assert response.status_code == 200
+    body = response.get_data()
+    if response.mimetype == payload.RAW_MIMETYPE:
+        data = decrypt(body)
+    else:
+        data = decrypt(base64.b64decode(json.loads(body)["encrypted_data"]))
+    if response.headers.get("X-Payload-Encoding") == "gzip":
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server("server", STREAM_CHUNK_SIZE="2", PATIENT_CACHE_DIR="")
+
+
+@pytest.mark.parametrize("headers", [ {}, { "Accept": payload.RAW_MIMETYPE }, { "X-Accept-Payload-Encoding": "gzip" } ])
+@pytest.mark.parametrize("query", [ "id=1", "id=2&intervals=1", "id=3&group=Drug" ])
+def test_stream(server, query, headers):
+    client = server.app.test_client()
+    expected = patient_data(client.get("/get_patient_data?" + query, headers=headers))
+    assert expected["events"]
+    assert patient_data(client.get("/get_patient_data?stream=1&" + query, headers=headers)) == expected
+
+
+def test_stream_error(server, caplog):
+    def iter_patient(pid, dictionary, *args, **kwargs):
+        # enough events for the first encrypted block (see payload.encrypt_blocks)
+        yield ("events", [ { "group": "Condition", "id": "SNOMED101", "time": 0, "row_id": "c{0}".format(i) } for i in range(5000) ])
+        raise RuntimeError("connection lost")
+
+    server.omop.iter_patient = iter_patient
+    client = server.app.test_client()
+    response = client.get("/get_patient_data?stream=1&id=1")
+    assert response.status_code == 200
+    with caplog.at_level(logging.ERROR), pytest.raises(RuntimeError):
+        response.get_data()
+    assert "Error streaming patient data of 1" in caplog.text
+
+
+def test_stream_unknown_patient(server):
+    response = server.app.test_client().get("/get_patient_data?stream=1&id=99")
+    assert response.status_code == 500
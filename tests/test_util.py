@@ -0,0 +1,32 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import util
+
+
+def mktime(dt):
+    # the pytz round trip the day arithmetic replaces
+    res = (dt - util._epoch).total_seconds()
+    return int(res - res % util._day_seconds)
+
+
+days = [ date(1950, 1, 1), date(1969, 12, 31), date(1970, 1, 1), date(2000, 2, 29), date(2016, 3, 13), date(2016, 11, 6), date(2038, 1, 20) ]
+
+
+@pytest.mark.parametrize("day", days)
+def test_date_to_time(day):
+    stamp = mktime(datetime(day.year, day.month, day.day, tzinfo=util._tz))
+    assert util.date_to_time(day) == stamp
+    assert util.date_to_time(day.isoformat()) == stamp
+    assert util.toTime(day.strftime("%Y%m%d")) == stamp
+
+
+@pytest.mark.parametrize("day", days)
+@pytest.mark.parametrize("shift", [ -400, -1, 0, 1, 2, 365 ])
+def test_shift_days(day, shift):
+    stamp = util.date_to_time(day)
+    assert util.shift_days(stamp, shift) == mktime(util._epoch + timedelta(days=shift, seconds=stamp))
+    assert util.shift_days(stamp, shift) == util.date_to_time(day + timedelta(days=shift))
+    assert util.nextDay(stamp) == util.date_to_time(day + timedelta(days=1))
+    assert util.count_days(stamp, util.shift_days(stamp, abs(shift))) == abs(shift) + 1
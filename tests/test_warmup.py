@@ -0,0 +1,125 @@
+import fcntl
+import threading
+import time
+
+import pytest
+
+from dictionary_store import DictionaryStore
+from patient_cache import PatientCache
+from warmup import WarmupScheduler, prefetch
+
+
+class Clock:
+    """
+    Replacement of time.time and time.sleep whose sleeps advance the time.
+    """
+    def __init__(self):
+        self.now = time.time()
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DictionaryStore(str(tmp_path / "dictionary.json"))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PatientCache(str(tmp_path / "patients"), 60, None)
+
+
+def test_prefetch(omop, store, cache):
+    assert prefetch(omop, store, cache, [ "1", "2" ], rate=0) == (2, 0)
+    assert cache.is_fresh("1", None, store.version)
+    assert cache.get("2", None, store.version)["dictionary"]
+    # fresh patients are skipped unless forced
+    assert prefetch(omop, store, cache, [ "1", "2", "3" ], rate=0) == (1, 0)
+    assert prefetch(omop, store, cache, [ "1", "2", "3" ], rate=0, force=True) == (3, 0)
+    assert prefetch(omop, store, cache, [ "1" ], group="Drug", rate=0) == (1, 0)
+    assert cache.is_fresh("1", "Drug", store.version)
+
+
+def test_prefetch_rate(omop, store, cache, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock.time)
+    monkeypatch.setattr(time, "sleep", clock.sleep)
+    assert prefetch(omop, store, cache, [ "1", "2", "3", "4" ], rate=2) == (4, 0)
+    # the extraction takes no time on the clock, so every patient but the first waits
+    assert clock.sleeps == [ 0.5, 0.5, 0.5 ]
+    # skipped patients do not wait
+    clock.sleeps = []
+    assert prefetch(omop, store, cache, [ "1", "2", "3", "4" ], rate=2) == (0, 0)
+    assert clock.sleeps == []
+
+
+def test_prefetch_stop(omop, store, cache):
+    stop = threading.Event()
+    stop.set()
+    assert prefetch(omop, store, cache, [ "1", "2" ], rate=0, stop=stop) == (0, 0)
+    assert not cache.is_fresh("1", None, store.version)
+
+
+def test_prefetch_failure(omop, store, cache, monkeypatch):
+    get_patient = omop.get_patient
+
+    def fail(pid, *args, **kwargs):
+        if pid == "2":
+            raise RuntimeError("lost connection")
+        return get_patient(pid, *args, **kwargs)
+
+    monkeypatch.setattr(omop, "get_patient", fail)
+    assert prefetch(omop, store, cache, [ "1", "2", "3" ], rate=0) == (2, 1)
+    assert cache.is_fresh("3", None, store.version)
+    assert not cache.is_fresh("2", None, store.version)
+
+
+@pytest.fixture
+def scheduler(tmp_path, omop, store, cache):
+    prepared = []
+    res = WarmupScheduler(omop, store, cache, str(tmp_path / "pids.csv"), 3600, 0,
+                          str(tmp_path / "warmup.lock"), prepare=lambda: prepared.append(True))
+    res.prepared = prepared
+    return res
+
+
+def test_scheduler(scheduler, cache, store):
+    # the list of patients does not exist yet
+    assert scheduler.run_once() is None
+    with open(scheduler.pids_file, "w") as file:
+        file.write("person_id,date\n1,2024-01-01\n3,2024-01-01\n")
+    assert scheduler.run_once() == (2, 0)
+    assert scheduler.prepared == [ True ]
+    assert cache.is_fresh("3", None, store.version)
+    assert scheduler.run_once() == (0, 0)
+
+
+def test_scheduler_lock(scheduler):
+    with open(scheduler.pids_file, "w") as file:
+        file.write("1\n")
+    # another process runs the prefetch
+    with open(scheduler.lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert scheduler.run_once() is None
+        assert scheduler.prepared == []
+    assert scheduler.run_once() == (1, 0)
+
+
+def test_scheduler_thread(scheduler, cache, store):
+    with open(scheduler.pids_file, "w") as file:
+        file.write("2\n")
+    scheduler.start()
+    for _ in range(100):
+        if cache.is_fresh("2", None, store.version):
+            break
+        time.sleep(0.05)
+    scheduler.stop.set()
+    scheduler.join(10)
+    assert not scheduler.is_alive()
+    assert cache.is_fresh("2", None, store.version)
@@ -3,7 +3,7 @@ from __future__ import division
 
 import sys
 import os
-from datetime import datetime, timedelta, tzinfo
+from datetime import date, datetime
 import pytz
 import collections
 from operator import itemgetter
@@ -11,21 +11,23 @@ import json
 
 from sqlalchemy import Unicode
 
-_compute_self = "total_seconds" not in dir(timedelta(seconds=1))
 _tz = pytz.timezone('US/Eastern')
 _epoch = datetime(year=1970, month=1, day=1, tzinfo=_tz)
+_epoch_ordinal = _epoch.toordinal()
 _day_seconds = 24 * 3600
-_milli = 10**6
-def _mktime(dt):
-    if not _compute_self:
-        res = (dt - _epoch).total_seconds()
-    else:
-        td = dt - _epoch
-        res = (td.microseconds + (td.seconds + td.days * _day_seconds) * _milli) / _milli
-    return int(res - res % _day_seconds)
+
+# Time stamps are computed relative to an epoch with the same tzinfo as the converted
+# dates so no UTC offset applies and every stamp is a whole number of days after the
+# epoch. This allows plain integer arithmetic on day ordinals and stamps.
 
 def toTime(s):
-    return _mktime(datetime(year=int(s[0:4]), month=int(s[4:6]), day=int(s[6:8]), tzinfo=_tz))
+    return date_to_time(date(year=int(s[0:4]), month=int(s[4:6]), day=int(s[6:8])))
+
+def date_to_time(d):
+    if isinstance(d, str):
+        # drivers without a date type, e.g., SQLite, return ISO dates
+        d = date(year=int(d[0:4]), month=int(d[5:7]), day=int(d[8:10]))
+    return (d.toordinal() - _epoch_ordinal) * _day_seconds
 
 def from_time(stamp):
     return datetime.fromtimestamp(stamp, _tz).strftime("%Y%m%d")
@@ -34,7 +36,57 @@ def nextDay(stamp):
     return shift_days(stamp, 1)
 
 def shift_days(stamp, days):
-    return _mktime(_epoch + timedelta(days=days, seconds=stamp))
+    res = stamp + days * _day_seconds
+    return int(res - res % _day_seconds)
+
+def count_days(stamp_from, stamp_to):
+    return (stamp_to - stamp_from) // _day_seconds + 1
+
+# Result flags of events in the columnar format
+event_flags = [ "", "L", "H", "C", "S", "N" ]
+
+def columnar_events(events):
+    """
+    Convert a list of events into the columnar format of parallel arrays.
+    'time' and 'end' are whole days since the epoch ('end' equals 'time' for events
+    without an end). 'group', 'id', 'row_id', and 'flag_value' are indices into the
+    string table 'strings' and 'flag' is an index into 'flags'. Missing values are -1.
+    """
+    strings = []
+    string_ix = {}
+    flag_ix = dict((f, ix) for (ix, f) in enumerate(event_flags))
+
+    def ref(s):
+        if s is None:
+            return -1
+        ix = string_ix.get(s)
+        if ix is None:
+            ix = string_ix[s] = len(strings)
+            strings.append(s)
+        return ix
+
+    res = {
+        "format": "columnar",
+        "time": [],
+        "end": [],
+        "group": [],
+        "id": [],
+        "row_id": [],
+        "flag": [],
+        "flag_value": [],
+    }
+    for e in events:
+        time = e["time"] // _day_seconds
+        res["time"].append(time)
+        res["end"].append(e["end"] // _day_seconds if "end" in e else time)
+        res["group"].append(ref(e["group"]))
+        res["id"].append(ref(e["id"]))
+        res["row_id"].append(ref(e.get("row_id")))
+        res["flag"].append(flag_ix[e["flag"]] if "flag" in e else -1)
+        res["flag_value"].append(ref(e.get("flag_value")))
+    res["strings"] = strings
+    res["flags"] = event_flags
+    return res
 
 def is_array(v):
     try:
@@ -0,0 +1,170 @@
+from __future__ import print_function
+import argparse
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config import omop_settings
+from dictionary_store import DictionaryStore
+from export import read_pids
+from omop import OMOP
+from patient_cache import PatientCache, retrieve_patient
+
+
+def prefetch(omop, store, cache, pids, group=None, rate=1.0, incremental=True, force=False, stop=None):
+    """
+    Retrieve patients into the patient cache unless they are cached and fresh already.
+    Stale entries are updated incrementally (see OMOP.update_patient). At most `rate`
+    patients are retrieved per second to limit the load on the database. The patients
+    are extracted into one snapshot of the dictionary whose new entries are merged into
+    the store after each patient, so requests served by the same process never wait for
+    the prefetch.
+
+    :param omop: The OMOP instance.
+    :param store: The DictionaryStore.
+    :param cache: The PatientCache.
+    :param pids: The person_ids to prefetch.
+    :param group: The group or None for all groups.
+    :param rate: The maximum number of patients retrieved per second (0 for no limit).
+    :param incremental: Boolean indicating whether stale entries are updated incrementally.
+    :param force: Boolean indicating whether to retrieve fresh patients as well.
+    :param stop: Optional threading.Event that ends the prefetch early.
+    :return: A tuple (number of retrieved patients, number of failed patients).
+    """
+    done = 0
+    failed = 0
+    snapshot = None
+    next_start = time.time()
+    for pid in pids:
+        if stop is not None and stop.is_set():
+            break
+        if not force and cache.is_fresh(pid, group, store.version):
+            continue
+        delay = next_start - time.time()
+        if delay > 0:
+            if stop is not None:
+                if stop.wait(delay):
+                    break
+            else:
+                time.sleep(delay)
+        next_start = time.time() + (1.0 / rate if rate > 0 else 0)
+        if snapshot is None or not snapshot.is_current():
+            snapshot = store.snapshot()
+        try:
+            entry = cache.load(pid, group) if incremental else None
+            retrieve_patient(omop, store, cache, pid, group, entry, snapshot)
+            done += 1
+        except Exception as e:
+            print("prefetching {0} generated an exception: {1}".format(pid, e), file=sys.stderr)
+            failed += 1
+            # the snapshot may hold entries of the failed patient whose hierarchy is incomplete
+            snapshot = None
+    return (done, failed)
+
+
+class WarmupScheduler(threading.Thread):
+    def __init__(self, omop, store, cache, pids_file, interval, rate, lock_path, incremental=True, prepare=None):
+        """
+        Background thread that prefetches the patients listed in a file, e.g., tomorrow's
+        clinic schedule, into the patient cache every `interval` seconds. Only one process
+        of the server runs the prefetch at a time (using a lock file), so the database load
+        does not grow with the number of worker processes.
+
+        :param omop: The OMOP instance.
+        :param store: The DictionaryStore.
+        :param cache: The PatientCache.
+        :param pids_file: The file with one person_id per line (or a CSV file with the
+            person_ids in the first column). It is read again every time.
+        :param interval: The number of seconds between prefetches.
+        :param rate: The maximum number of patients retrieved per second.
+        :param lock_path: The lock file shared by the processes, e.g., json/warmup.lock.
+        :param incremental: Boolean indicating whether stale entries are updated incrementally.
+        :param prepare: Optional function that is called before each prefetch, e.g., to
+            check the dictionary sources.
+        """
+        super().__init__(name="warmup", daemon=True)
+        self.omop = omop
+        self.store = store
+        self.cache = cache
+        self.pids_file = pids_file
+        self.interval = interval
+        self.rate = rate
+        self.lock_path = lock_path
+        self.incremental = incremental
+        self.prepare = prepare
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print("warm-up generated an exception: {0}".format(e), file=sys.stderr)
+            self.stop.wait(self.interval)
+
+    def run_once(self):
+        """
+        Prefetch the listed patients unless another process is doing so.
+
+        :return: The tuple returned by `prefetch` or None if the prefetch was skipped.
+        """
+        if not os.path.exists(self.pids_file):
+            return None
+        with open(self.lock_path, "a") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            if self.prepare is not None:
+                self.prepare()
+            pids = read_pids(self.pids_file)
+            (done, failed) = prefetch(self.omop, self.store, self.cache, pids, rate=self.rate,
+                                      incremental=self.incremental, stop=self.stop)
+            if done or failed:
+                print("warm-up: prefetched {0} of {1} patients ({2} failed)".format(done, len(pids), failed), file=sys.stderr)
+            return (done, failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefetch patients into the patient cache of the server.")
+    parser.add_argument("pids", nargs="*", help="person_ids to prefetch")
+    parser.add_argument("--pids-file", help="file with one person_id per line ('-' for stdin)")
+    parser.add_argument("--all", action="store_true", help="prefetch all patients (see --limit)")
+    parser.add_argument("--limit", type=int, default=None, help="prefetch at most this many patients with --all")
+    parser.add_argument("--group", default=None, help="prefetch only this group")
+    parser.add_argument("--cache-dir", default=os.getenv("PATIENT_CACHE_DIR", "json/patients"), help="directory of the patient cache (default: PATIENT_CACHE_DIR or json/patients)")
+    parser.add_argument("--dictionary", default="json/dictionary.json", help="dictionary file of the server")
+    parser.add_argument("--ttl", type=int, default=int(os.getenv("PATIENT_CACHE_TTL", "3600")), help="seconds after which cached patients are refreshed")
+    parser.add_argument("--rate", type=float, default=1.0, help="maximum number of patients per second (0 for no limit)")
+    parser.add_argument("--full", action="store_true", help="retrieve stale patients completely instead of incrementally")
+    parser.add_argument("--force", action="store_true", help="retrieve patients that are cached and fresh as well")
+    args = parser.parse_args()
+
+    omop = OMOP(omop_settings(), False)
+    pids = list(args.pids)
+    if args.pids_file:
+        pids.extend(read_pids(args.pids_file))
+    if args.all:
+        patients = set()
+        omop.list_patients(patients, limit=args.limit)
+        pids.extend(sorted(patients, key=int))
+    store = DictionaryStore(args.dictionary)
+    sources = omop.get_dictionary_sources()
+    omop.update_sources(sources)
+    store.update_sources(sources)
+    cache = PatientCache(args.cache_dir, args.ttl, None)
+    start = time.time()
+    (done, failed) = prefetch(omop, store, cache, pids, args.group, args.rate, not args.full, args.force)
+    print("prefetched {0} of {1} patients in {2:.1f}s ({3} failed)".format(done, len(pids), time.time() - start, failed), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()